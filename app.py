@@ -48,7 +48,7 @@ if __name__ == '__main__':
     if not app.debug:
         try:
             from scheduler import scheduler
-            scheduler.start()
+            scheduler.start(app)
             print("✅ Планировщик автоматического обновления запущен")
         except Exception as e:
             print(f"⚠️ Ошибка запуска планировщика: {e}")
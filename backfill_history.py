@@ -0,0 +1,36 @@
+"""
+Скрипт первичной загрузки дневной истории всего рынка по датам
+Продолжает загрузку с контрольной точки, поэтому его можно прерывать и запускать повторно:
+    python backfill_history.py [с YYYY-MM-DD] [по YYYY-MM-DD] [площадка]
+"""
+
+import sys
+from datetime import date, datetime
+from app import create_app
+from price_backfill import market_backfill
+
+
+def backfill_history():
+    """Загружает историю площадки до конца периода, печатая скорость каждого пакета дней"""
+    start = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    end = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None
+    board = sys.argv[3] if len(sys.argv) > 3 else 'TQBR'
+    app = create_app()
+
+    with app.app_context():
+        start = start or market_backfill.default_start()
+        print(f"[{datetime.now()}] Загрузка истории {board} с {start}...")
+        while True:
+            result = market_backfill.run(start, end, board=board)
+            if not result['success']:
+                print(f"[{datetime.now()}] Ошибка: {result.get('error')}")
+                sys.exit(1)
+            print(f"[{datetime.now()}] Загружено дней: {result['days']}, строк: {result['rows']}, "
+                  f"{result['rows_per_sec']} строк/с, до {result['last_date']}, осталось дней: {result['remaining_days']}")
+            if not result['remaining_days']:
+                break
+        print(f"[{datetime.now()}] История загружена")
+
+
+if __name__ == "__main__":
+    backfill_history()
@@ -0,0 +1,205 @@
+"""
+Сравнение векторного расчета статистики портфеля (portfolio_engine) с расчетом в циклах
+на синтетическом портфеле
+    python bench_portfolio_engine.py [позиций=10000] [счетов=10]
+Код выхода 1, если результаты расчетов расходятся
+"""
+
+import sys
+import math
+import time
+import random
+from datetime import datetime
+from types import SimpleNamespace
+import portfolio_engine
+
+SECTORS = ('Финансы', 'Нефть и газ', 'Металлургия', 'Технологии', 'Ритейл', 'Энергетика', None)
+# Допустимое относительное расхождение сумм (порядок сложения float в группировках другой)
+TOLERANCE = 1e-9
+
+
+def synthetic_positions(count=10000, accounts=10, seed=1):
+    """Ровно count позиций на accounts счетах (бумаги повторяются между счетами, у части бумаг нет
+    цены или сектора, у части позиций нулевая себестоимость). Как в portfolio_positions, на счете
+    одна позиция по бумаге - поэтому позиций не больше, чем счетов, умноженных на число бумаг.
+    Возвращает (positions, account_ids)
+    """
+    rng = random.Random(seed)
+    stocks = [SimpleNamespace(
+        id=i, ticker=f'T{i:05d}', name=f'Бумага {i}', sector=rng.choice(SECTORS),
+        instrument_type=rng.choice(('share', 'share', 'bond', None)),
+    ) for i in range(1, max(count // 2, 1) + 1)]
+    account_ids = list(range(100, 100 + accounts))
+    count = min(count, len(account_ids) * len(stocks))
+    positions = []
+    seen = set()
+    while len(positions) < count:
+        account_id = account_ids[len(positions) % accounts]
+        stock = stocks[rng.randrange(len(stocks))]
+        if (account_id, stock.id) in seen:
+            continue
+        seen.add((account_id, stock.id))
+        quantity = rng.randint(1, 1000)
+        cost = 0.0 if rng.random() < 0.02 else round(quantity * rng.uniform(1, 5000), 2)
+        price = None if rng.random() < 0.02 else round(rng.uniform(1, 5000), 2)
+        positions.append({'account_id': account_id, 'stock_id': stock.id, 'stock': stock, 'quantity': quantity,
+                          'total_cost': cost, 'realized_pnl': round(rng.uniform(-100, 100), 2), 'price': price})
+    return positions, account_ids
+
+
+def loop_stats(positions, account_ids):
+    """Расчет в циклах, как до portfolio_engine: статистика счетов, позиции по бумагам, анализ портфеля
+    (с calculate_portfolio_stats из utils до portfolio_engine сверяет test_portfolio_engine)"""
+    accounts = {}
+    for account_id in account_ids:
+        active_positions = []
+        total_invested = 0
+        total_current_value = 0
+        for row in positions:
+            if row['account_id'] != account_id:
+                continue
+            position = {k: row[k] for k in ('stock_id', 'stock', 'quantity', 'total_cost', 'realized_pnl')}
+            position['avg_price'] = position['total_cost'] / position['quantity']
+            position['current_value'] = position['quantity'] * (row['price'] or 0.0)
+            position['profit_loss'] = position['current_value'] - position['total_cost']
+            position['profit_loss_percent'] = (position['profit_loss'] / position['total_cost']) * 100 if position['total_cost'] > 0 else 0
+            active_positions.append(position)
+            total_invested += position['total_cost']
+            total_current_value += position['current_value']
+        accounts[account_id] = {
+            'positions': active_positions,
+            'total_invested': total_invested,
+            'total_current_value': total_current_value,
+            'total_profit_loss': total_current_value - total_invested,
+            'total_profit_loss_percent': ((total_current_value - total_invested) / total_invested) * 100 if total_invested > 0 else 0,
+        }
+
+    totals = {'total_invested': 0, 'total_current_value': 0}
+    merged_positions = []
+    for account_id in account_ids:
+        account_stats = accounts[account_id]
+        totals['total_invested'] += account_stats['total_invested']
+        totals['total_current_value'] += account_stats['total_current_value']
+        for position in account_stats['positions']:
+            existing_position = next((p for p in merged_positions if p['stock_id'] == position['stock_id']), None)
+            if existing_position:
+                existing_position['quantity'] += position['quantity']
+                existing_position['total_cost'] += position['total_cost']
+                existing_position['realized_pnl'] += position['realized_pnl']
+                existing_position['current_value'] += position['current_value']
+                existing_position['avg_price'] = existing_position['total_cost'] / existing_position['quantity']
+                existing_position['profit_loss'] = existing_position['current_value'] - existing_position['total_cost']
+                existing_position['profit_loss_percent'] = (existing_position['profit_loss'] / existing_position['total_cost']) * 100 if existing_position['total_cost'] > 0 else 0
+            else:
+                merged_positions.append(position.copy())
+    totals['total_profit_loss'] = totals['total_current_value'] - totals['total_invested']
+    totals['total_profit_loss_percent'] = (totals['total_profit_loss'] / totals['total_invested']) * 100 if totals['total_invested'] > 0 else 0
+
+    sector_analysis = {}
+    total_portfolio_value = 0
+    positions_analysis = []
+    for account_id in account_ids:
+        for position in positions:
+            if position['account_id'] != account_id or position['quantity'] <= 0:
+                continue
+            stock = position['stock']
+            current_price = position['price'] or 0
+            current_value = position['quantity'] * current_price
+            avg_price = position['total_cost'] / position['quantity']
+            profit_loss = current_value - position['total_cost']
+            profit_loss_pct = (profit_loss / position['total_cost'] * 100) if position['total_cost'] > 0 else 0
+            position_data = {'stock': stock, 'quantity': position['quantity'], 'avg_price': avg_price,
+                             'current_price': current_price, 'current_value': current_value,
+                             'total_cost': position['total_cost'], 'profit_loss': profit_loss,
+                             'profit_loss_pct': profit_loss_pct, 'account': account_id}
+            positions_analysis.append(position_data)
+            sector = stock.sector or 'Прочее'
+            if sector not in sector_analysis:
+                sector_analysis[sector] = {'value': 0, 'cost': 0, 'profit_loss': 0, 'positions': []}
+            sector_analysis[sector]['value'] += current_value
+            sector_analysis[sector]['cost'] += position['total_cost']
+            sector_analysis[sector]['profit_loss'] += profit_loss
+            sector_analysis[sector]['positions'].append(position_data)
+            total_portfolio_value += current_value
+    for sector in sector_analysis:
+        if total_portfolio_value > 0:
+            sector_analysis[sector]['percentage'] = (sector_analysis[sector]['value'] / total_portfolio_value) * 100
+        else:
+            sector_analysis[sector]['percentage'] = 0
+    positions_analysis.sort(key=lambda x: x['current_value'], reverse=True)
+    instrument_analysis = {'share': {'value': 0, 'count': 0}, 'bond': {'value': 0, 'count': 0}}
+    for pos in positions_analysis:
+        inst_type = getattr(pos['stock'], 'instrument_type', 'share') or 'share'
+        if inst_type in instrument_analysis:
+            instrument_analysis[inst_type]['value'] += pos['current_value']
+            instrument_analysis[inst_type]['count'] += 1
+
+    return {'accounts': accounts, 'totals': totals, 'positions': merged_positions, 'analysis': positions_analysis,
+            'sectors': sector_analysis, 'instruments': instrument_analysis, 'total_value': total_portfolio_value}
+
+
+def engine_stats(positions, account_ids):
+    """Те же результаты, что у loop_stats, через portfolio_engine"""
+    valuation = portfolio_engine.evaluate(positions, account_ids)
+    analysis, sectors, instruments = valuation.analysis({account_id: account_id for account_id in account_ids})
+    return {
+        'accounts': {account_id: {'positions': valuation.account_positions(account_id),
+                                  **valuation.account_totals(account_id)} for account_id in account_ids},
+        'totals': valuation.totals, 'positions': valuation.stock_positions(), 'analysis': analysis,
+        'sectors': sectors, 'instruments': instruments, 'total_value': valuation.total_value,
+    }
+
+
+def compare(expected, actual, path='stats'):
+    """Список расхождений двух результатов (числа - с относительной точностью TOLERANCE)"""
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if set(expected) != set(actual):
+            return [f"{path}: ключи {sorted(map(str, expected))} != {sorted(map(str, actual))}"]
+        # Сектора выводятся в порядке словаря - порядок тоже должен совпадать
+        if path.endswith("['sectors']") and list(expected) != list(actual):
+            return [f"{path}: порядок {list(expected)} != {list(actual)}"]
+        return [m for key in expected for m in compare(expected[key], actual[key], f"{path}[{key!r}]")]
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [f"{path}: {len(expected)} строк != {len(actual)}"]
+        return [m for i, (e, a) in enumerate(zip(expected, actual)) for m in compare(e, a, f"{path}[{i}]")]
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        if math.isclose(expected, actual, rel_tol=TOLERANCE, abs_tol=TOLERANCE):
+            return []
+        return [f"{path}: {expected} != {actual}"]
+    return [] if expected is actual or expected == actual else [f"{path}: {expected!r} != {actual!r}"]
+
+
+def _best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_portfolio_engine():
+    """Замеряет оба расчета на синтетическом портфеле и сверяет результаты"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    positions, account_ids = synthetic_positions(count, accounts)
+    print(f"[{datetime.now()}] Синтетический портфель: {len(positions)} позиций, {len(account_ids)} счетов")
+
+    loop_time, expected = _best_time(lambda: loop_stats(positions, account_ids), 1 if count > 2000 else 3)
+    engine_time, actual = _best_time(lambda: engine_stats(positions, account_ids), 5)
+    print(f"[{datetime.now()}] Циклы: {loop_time * 1000:.1f} мс, portfolio_engine: {engine_time * 1000:.1f} мс "
+          f"(ускорение x{loop_time / engine_time:.1f})")
+
+    mismatches = compare(expected, actual)
+    if mismatches:
+        print(f"[{datetime.now()}] Расхождений: {len(mismatches)}")
+        for mismatch in mismatches[:20]:
+            print(f"  {mismatch}")
+        sys.exit(1)
+    print(f"[{datetime.now()}] Результаты совпадают")
+
+
+if __name__ == "__main__":
+    bench_portfolio_engine()
@@ -0,0 +1,172 @@
+"""
+Пакетная синхронизация справочных таблиц с данными MOEX
+Существующие строки читаются одним запросом, входящие сравниваются с ними в памяти,
+в БД уходят только новые и изменившиеся строки: в Postgres - INSERT ... ON CONFLICT DO UPDATE,
+в SQLite - executemany для INSERT и UPDATE.
+update_changed - пакетная запись уже отобранных изменившихся строк (котировки в StockQuote),
+insert_ignore - дозапись строк без перезаписи уже сохраненных (дневные свечи)
+"""
+
+import time
+import logging
+from sqlalchemy import bindparam
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк отправляется в одном INSERT ... VALUES (лимит параметров Postgres - 65535)
+CHUNK_SIZE = 500
+
+
+def _is_empty(value):
+    return value is None or value == ''
+
+
+def upsert(model, rows, key='ticker', keep_if_empty=(), insert_defaults=None):
+    """Вставляет новые и обновляет изменившиеся строки model по уникальной колонке key.
+
+    rows - список словарей {колонка: значение}; если одна и та же бумага встречается
+    несколько раз, побеждает последняя строка.
+    keep_if_empty - колонки, пустое входящее значение которых не затирает уже сохраненное.
+    insert_defaults - значения колонок, которых нет во входящих строках, для вставки новых строк.
+    Возвращает {'success', 'added', 'updated', 'unchanged', 'total', 'elapsed'}; commit делает вызывающий.
+    """
+    started = time.perf_counter()
+    insert_defaults = insert_defaults or {}
+    table = model.__table__
+
+    incoming = {}
+    for row in rows:
+        if not _is_empty(row.get(key)):
+            incoming[row[key]] = row
+    update_columns = sorted({c for row in incoming.values() for c in row if c != key})
+    columns = [key] + update_columns + sorted(set(insert_defaults) - set(update_columns) - {key})
+
+    # Все существующие строки одним запросом: {key: {колонка: значение}}
+    existing = {}
+    for values in db.session.execute(db.select(*[table.c[c] for c in columns])).all():
+        existing[values[0]] = dict(zip(columns, values))
+
+    inserts = []
+    updates = []
+    unchanged = 0
+    for ticker, row in incoming.items():
+        current = existing.get(ticker)
+        if current is None:
+            new_row = {c: None for c in columns}
+            new_row.update(insert_defaults)
+            new_row.update(row)
+            inserts.append(new_row)
+            continue
+        target = dict(current)
+        for column in update_columns:
+            value = row.get(column)
+            if column in keep_if_empty and _is_empty(value):
+                continue
+            target[column] = value
+        if target == current:
+            unchanged += 1
+        else:
+            updates.append(target)
+
+    if db.engine.dialect.name.startswith('postgres'):
+        _write_postgres(table, key, update_columns, inserts + updates)
+    else:
+        _write_executemany(table, key, update_columns, inserts, updates)
+
+    elapsed = round(time.perf_counter() - started, 3)
+    result = {
+        'success': True,
+        'added': len(inserts),
+        'updated': len(updates),
+        'unchanged': unchanged,
+        'total': len(existing) + len(inserts),
+        'elapsed': elapsed,
+    }
+    logger.info(f"Пакетная синхронизация {table.name}: добавлено {result['added']}, обновлено {result['updated']}, "
+                f"без изменений {unchanged} за {elapsed} с")
+    return result
+
+
+def _write_postgres(table, key, update_columns, rows):
+    """INSERT ... ON CONFLICT (key) DO UPDATE пачками по CHUNK_SIZE строк"""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    for i in range(0, len(rows), CHUNK_SIZE):
+        stmt = pg_insert(table).values(rows[i:i + CHUNK_SIZE])
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[key], set_={c: stmt.excluded[c] for c in update_columns}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[key])
+        db.session.execute(stmt)
+
+
+def _write_executemany(table, key, update_columns, inserts, updates):
+    """Один executemany на вставки и один на обновления (SQLite и прочие диалекты)"""
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates and update_columns:
+        stmt = table.update().where(table.c[key] == bindparam('_key')).values(
+            {c: bindparam(f'_{c}') for c in update_columns}
+        )
+        db.session.execute(stmt, [
+            {'_key': row[key], **{f'_{c}': row[c] for c in update_columns}} for row in updates
+        ])
+
+
+def update_changed(model, rows, key='id', existing=None):
+    """Одним пакетом обновляет строки model по колонке key: rows - список словарей с одинаковым
+    набором колонок (key + обновляемые). В Postgres - UPDATE ... FROM (VALUES ...) пачками
+    по CHUNK_SIZE строк, в остальных БД - executemany.
+    existing - множество ключей, строки для которых уже есть в таблице; остальные строки вставляются.
+    Возвращает число переданных строк
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    if existing is not None:
+        inserts = [row for row in rows if row[key] not in existing]
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        return len(inserts) + update_changed(model, [row for row in rows if row[key] in existing], key)
+    columns = [c for c in rows[0] if c != key]
+    if not columns:
+        return 0
+    if db.engine.dialect.name.startswith('postgres'):
+        from sqlalchemy import values, column, cast
+        for i in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[i:i + CHUNK_SIZE]
+            data = values(*[column(c, table.c[c].type) for c in [key] + columns], name='changed').data(
+                [tuple(row[c] for c in [key] + columns) for row in chunk]
+            )
+            # cast: если в колонке пачки одни NULL, Postgres выводит для нее тип text
+            stmt = table.update().where(table.c[key] == data.c[key]).values(
+                {c: cast(data.c[c], table.c[c].type) for c in columns}
+            )
+            db.session.execute(stmt)
+    else:
+        stmt = table.update().where(table.c[key] == bindparam('_key')).values(
+            {c: bindparam(f'_{c}') for c in columns}
+        )
+        db.session.execute(stmt, [{'_key': row[key], **{f'_{c}': row[c] for c in columns}} for row in rows])
+    return len(rows)
+
+
+def insert_ignore(model, rows, keys):
+    """Вставляет строки, пропуская те, что уже есть по уникальному ключу keys
+    (ON CONFLICT DO NOTHING в Postgres, INSERT OR IGNORE в SQLite). Возвращает число вставленных строк
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    inserted = 0
+    if db.engine.dialect.name.startswith('postgres'):
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        for i in range(0, len(rows), CHUNK_SIZE):
+            stmt = pg_insert(table).values(rows[i:i + CHUNK_SIZE]).on_conflict_do_nothing(index_elements=list(keys))
+            inserted += db.session.execute(stmt).rowcount or 0
+    else:
+        result = db.session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        inserted = result.rowcount or 0
+    return inserted
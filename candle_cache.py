@@ -0,0 +1,118 @@
+"""
+Кэш внутридневных свечей в памяти процесса
+На каждую пару (тикер, интервал) хранится кольцевой буфер свечей, упорядоченных по begin;
+между парами - вытеснение давно не запрашивавшихся (LRU). Обновление дозапрашивает с MOEX
+только свечи начиная с последней сохраненной (она еще могла измениться), запросы читателей
+отдаются срезом буфера по времени
+"""
+
+import os
+import math
+import time
+import bisect
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Самый длинный период, который отдает /api/stock_intraday (часы)
+MAX_HOURS = 72
+
+
+class CandleSeries:
+    """Свечи одной бумаги с одним интервалом: (begin datetime, begin строкой MOEX, close)"""
+
+    def __init__(self, capacity):
+        self.candles = deque(maxlen=capacity)
+        self.board = None
+        # С какого момента в буфере есть все свечи
+        self.covered_from = None
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def reset(self, candles, board, covered_from):
+        self.candles.clear()
+        self.candles.extend(candles)
+        self.board = board
+        self.covered_from = covered_from
+        self._trim_coverage()
+
+    def merge(self, candles):
+        """Дописывает свежие свечи: сохраненные с тем же или более поздним begin заменяются"""
+        if not candles:
+            return
+        first = candles[0][0]
+        while self.candles and self.candles[-1][0] >= first:
+            self.candles.pop()
+        self.candles.extend(candles)
+        self._trim_coverage()
+
+    def _trim_coverage(self):
+        # Буфер переполнился и вытеснил старые свечи - ранее их начала данных нет
+        if len(self.candles) == self.candles.maxlen and self.candles[0][0] > self.covered_from:
+            self.covered_from = self.candles[0][0]
+
+    def since(self, start):
+        """Свечи с begin >= start (бинарный поиск по упорядоченному буферу)"""
+        index = bisect.bisect_left(self.candles, start, key=lambda candle: candle[0])
+        return list(islice(self.candles, index, None))
+
+
+class CandleCache:
+    """Буферы свечей по (тикер, интервал) с LRU-вытеснением между бумагами"""
+
+    def __init__(self):
+        try:
+            self.max_series = max(1, int(os.environ.get('INTRADAY_CACHE_SERIES', '256')))
+        except ValueError:
+            self.max_series = 256
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def capacity(interval):
+        """Сколько свечей интервала помещается в MAX_HOURS"""
+        return math.ceil(MAX_HOURS * 60 / interval) + 1
+
+    def _get_series(self, key, interval):
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = CandleSeries(self.capacity(interval))
+                if len(self._series) > self.max_series:
+                    evicted, _ = self._series.popitem(last=False)
+                    logger.debug(f"Свечи {evicted} вытеснены из кэша")
+            else:
+                self._series.move_to_end(key)
+            return series
+
+    def get(self, ticker, interval, start, fetch, max_age):
+        """Свечи бумаги с begin >= start.
+        fetch(since, board) -> (board, [(begin datetime, begin строкой, close)]) загружает с MOEX свечи
+        начиная с since (board None - площадка еще не известна). Буфер дозагружается, если он старше
+        max_age секунд; если запрошен период раньше загруженного - загружается заново.
+        Ошибка дозагрузки не мешает отдать то, что уже есть в буфере
+        """
+        series = self._get_series((ticker, interval), interval)
+        with series.lock:
+            now = time.time()
+            if series.covered_from is None or start < series.covered_from:
+                board, candles = fetch(start, None)
+                series.reset(candles, board, start)
+                series.refreshed_at = now
+            elif now - series.refreshed_at >= max_age:
+                since = series.candles[-1][0] if series.candles else series.covered_from
+                try:
+                    board, candles = fetch(since, series.board)
+                    series.board = series.board or board
+                    series.merge(candles)
+                    series.refreshed_at = now
+                except Exception as e:
+                    logger.warning(f"Не удалось дозагрузить свечи {ticker} ({interval} мин): {e}")
+            return series.since(start)
+
+
+# Глобальный кэш внутридневных свечей
+candle_cache = CandleCache()
@@ -0,0 +1,63 @@
+"""
+Общие фикстуры тестов: Flask-приложение с пустой SQLite в памяти
+Файлы, которые приложение держит на диске (каталог instance, кэш оценок портфелей, общая таблица
+котировок), создаются во временном каталоге теста и не задевают общие каталоги запущенного бота
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+
+# Тесты, которые импортируют app.py, создают приложение при импорте модуля: его БД и общие файлы
+# тоже уводим во временный каталог (до импорта модулей, читающих эти переменные)
+TEST_DIR = tempfile.mkdtemp(prefix='investbot-test-')
+atexit.register(shutil.rmtree, TEST_DIR, ignore_errors=True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TEST_DIR, 'investbot.db')
+os.environ['VALUATION_CACHE_DIR'] = os.path.join(TEST_DIR, 'valuations')
+os.environ['SHARED_QUOTES_PATH'] = os.path.join(TEST_DIR, 'quotes.bin')
+
+import pytest
+from flask import Flask
+from database import db
+from shared_quotes import shared_quotes
+from valuation_cache import valuation_cache
+
+
+def _use_dir(tmp_dir):
+    """Переносит кэш оценок и общую таблицу котировок процесса в tmp_dir"""
+    valuation_cache.path = os.path.join(tmp_dir, 'valuations')
+    valuation_cache._identity = None
+    valuation_cache._ready = {}
+    shared_quotes.path = os.path.join(tmp_dir, 'quotes.bin')
+    # Прежний файл котировок больше не читаем: следующее обращение отобразит новый
+    if shared_quotes._fd is not None:
+        os.close(shared_quotes._fd)
+    shared_quotes._mm = None
+    shared_quotes._fd = None
+    shared_quotes._columns = {}
+    shared_quotes.available = True
+
+
+def make_app(tmp_dir=None):
+    """Приложение с SQLite в памяти и созданными таблицами (для запуска тестов без pytest).
+    tmp_dir - каталог для файлов приложения (по умолчанию новый подкаталог TEST_DIR)
+    """
+    tmp_dir = str(tmp_dir or tempfile.mkdtemp(dir=TEST_DIR))
+    _use_dir(tmp_dir)
+    app = Flask(__name__, instance_path=os.path.join(tmp_dir, 'instance'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        # Каталог оценок новый, но в памяти процесса остались оценки предыдущих тестов
+        valuation_cache.clear()
+    return app
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # Экземпляры, созданные в самом тесте, тоже берут пути из временного каталога
+    monkeypatch.setenv('VALUATION_CACHE_DIR', str(tmp_path / 'valuations'))
+    monkeypatch.setenv('SHARED_QUOTES_PATH', str(tmp_path / 'quotes.bin'))
+    return make_app(tmp_path)
@@ -1,7 +1,20 @@
+import os
+import tempfile
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.hybrid import hybrid_property
+
+# fcntl есть только на Unix; без него миграции SQLite не сериализуются между процессами
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 db = SQLAlchemy()
 
+# Ключ advisory lock миграций в Postgres (произвольная константа приложения, не совпадает с ключом планировщика)
+MIGRATION_LOCK_KEY = 7301453
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     telegram_id = db.Column(db.String(80), unique=True, nullable=False)
@@ -15,31 +28,125 @@ class Account(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     transactions = db.relationship('Transaction', backref='account', lazy=True)
 
+def _quote_field(name, default=None):
+    """Поле котировки на Stock для совместимости: чтение и запись идут в связанную строку StockQuote,
+    в запросах (filter/order_by) поле раскрывается в коррелированный подзапрос к stock_quote
+    """
+    def fget(self):
+        quote = self.quote
+        value = getattr(quote, name) if quote is not None else None
+        return default if value is None else value
+
+    def fset(self, value):
+        if self.quote is None:
+            self.quote = StockQuote()
+        setattr(self.quote, name, value)
+
+    def expr(cls):
+        return db.select(getattr(StockQuote, name)).where(StockQuote.stock_id == cls.id).scalar_subquery()
+
+    return hybrid_property(fget, fset, expr=expr)
+
+
 class Stock(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ticker = db.Column(db.String(20), unique=True, nullable=False)
     name = db.Column(db.String(120), nullable=False)
-    price = db.Column(db.Float, default=0.0)
     logo_url = db.Column(db.String(255), nullable=True)
     sector = db.Column(db.String(100), nullable=True)
     description = db.Column(db.Text, nullable=True)
     instrument_type = db.Column(db.String(20), nullable=False, default='share')
     face_value = db.Column(db.Float, nullable=True)
-    # Новые метрики торгов
-    turnover = db.Column(db.Float, nullable=True)  # оборот за день (в валюте котировок, обычно рубли)
-    volume = db.Column(db.BigInteger, nullable=True)  # количество бумаг за день (BIGINT для Postgres)
-    change_pct = db.Column(db.Float, nullable=True)  # изменение цены за день, %
+    # Котировки и метрики торгов живут в узкой таблице StockQuote (см. ниже)
+    quote = db.relationship('StockQuote', uselist=False, lazy='joined', cascade='all, delete-orphan')
+    price = _quote_field('price', 0.0)
+    turnover = _quote_field('turnover')      # оборот за день (в валюте котировок, обычно рубли)
+    volume = _quote_field('volume')          # количество бумаг за день
+    change_pct = _quote_field('change_pct')  # изменение цены за день, %
+    accrued_int = _quote_field('accrued_int')  # НКД (накопленный купонный доход)
     # Купонные/дивидендные метаданные (в основном для облигаций)
     coupon_value = db.Column(db.Float, nullable=True)      # Сумма купона на 1 бумагу (в валюте бумаги)
     coupon_percent = db.Column(db.Float, nullable=True)    # Купонная ставка, % годовых (если доступно)
     coupon_period = db.Column(db.Integer, nullable=True)   # Периодичность купонов (в днях)
-    accrued_int = db.Column(db.Float, nullable=True)       # НКД (накопленный купонный доход)
     next_coupon_date = db.Column(db.Date, nullable=True)   # Дата следующего купона
     maturity_date = db.Column(db.Date, nullable=True)      # Дата погашения
     lot_size = db.Column(db.Integer, nullable=True)        # Размер лота
     currency = db.Column(db.String(12), nullable=True)     # Валюта котировок (обычно SUR)
     isin = db.Column(db.String(36), nullable=True)         # ISIN
 
+# Котировки бумаг: узкая таблица часто обновляемых полей, отдельная от справочных данных Stock.
+# Обновление цены переписывает только эту короткую строку; запас места на странице (fillfactor)
+# позволяет Postgres делать HOT-обновления без изменения индексов
+class StockQuote(db.Model):
+    __tablename__ = 'stock_quote'
+    __table_args__ = {'postgresql_with': {'fillfactor': 70}}
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), primary_key=True, autoincrement=False)
+    price = db.Column(db.Float, nullable=True)
+    change_pct = db.Column(db.Float, nullable=True)
+    turnover = db.Column(db.Float, nullable=True)
+    volume = db.Column(db.BigInteger, nullable=True)
+    accrued_int = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+# Колонки котировок, которые раньше хранились прямо в таблице stock
+LEGACY_QUOTE_COLUMNS = ('price', 'change_pct', 'turnover', 'volume', 'accrued_int')
+
+
+@contextmanager
+def migration_lock():
+    """Сериализует миграции между процессами (воркеры gunicorn стартуют одновременно):
+    pg_advisory_lock на отдельном соединении в режиме autocommit в Postgres, flock на файл для SQLite.
+    Нужен контекст приложения
+    """
+    if db.engine.dialect.name.startswith('postgres'):
+        conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            conn.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_KEY})")
+            try:
+                yield
+            finally:
+                conn.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_KEY})")
+        finally:
+            conn.close()
+        return
+    path = os.environ.get('MIGRATION_LOCK_PATH', os.path.join(tempfile.gettempdir(), 'investbot_migrate.lock'))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def run_migrations():
+    """Создает таблицы и выполняет миграции схемы под migration_lock (нужен контекст приложения).
+    Возвращает (число перенесенных котировок, список добавленных колонок transaction)
+    """
+    with migration_lock():
+        db.create_all()
+        return migrate_stock_quotes(), migrate_transaction_columns()
+
+def migrate_stock_quotes():
+    """Переносит котировки из старых колонок stock в stock_quote для бумаг, у которых строки котировки еще нет
+    (нужен контекст приложения; вызывается после db.create_all). Возвращает число перенесенных строк.
+    Повторный или параллельный запуск ничего не дублирует: уже перенесенные бумаги пропускаются
+    """
+    existing = {c['name'] for c in db.inspect(db.session.connection()).get_columns('stock')}
+    columns = [c for c in LEGACY_QUOTE_COLUMNS if c in existing]
+    if not columns:
+        db.session.commit()
+        return 0
+    names = ', '.join(columns)
+    result = db.session.execute(db.text(
+        f"INSERT INTO stock_quote (stock_id, {names}) "
+        f"SELECT id, {names} FROM stock WHERE id NOT IN (SELECT stock_id FROM stock_quote) "
+        f"ON CONFLICT (stock_id) DO NOTHING"
+    ))
+    db.session.commit()
+    return result.rowcount or 0
+
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(50), nullable=False)  # 'deposit', 'withdrawal', 'buy', 'sell'
@@ -49,9 +156,49 @@ class Transaction(db.Model):
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=True)
+    # False - покупка внесена задним числом (add_historical_buy) и не списывала деньги со счета
+    cash_settled = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())
     # Relationship to access stock from transaction in templates
     stock = db.relationship('Stock', backref='transactions', lazy=True)
 
+def migrate_transaction_columns():
+    """Добавляет в таблицу transaction колонки, появившиеся после ее создания (нужен контекст приложения;
+    вызывается после db.create_all). Возвращает список добавленных колонок
+    """
+    # Колонки проверяются в той же транзакции, в которой добавляются
+    existing = {c['name'] for c in db.inspect(db.session.connection()).get_columns('transaction')}
+    if 'cash_settled' in existing:
+        db.session.commit()
+        return []
+    # transaction - зарезервированное слово, имя таблицы нужно экранировать
+    table = db.engine.dialect.identifier_preparer.quote('transaction')
+    db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN cash_settled BOOLEAN NOT NULL DEFAULT TRUE"))
+    db.session.commit()
+    return ['cash_settled']
+
+# Текущая позиция счета по бумаге: поддерживается при каждой покупке и продаже (см. position_ledger.py),
+# чтобы не пересчитывать ее по всей истории Transaction
+class Position(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    cost_basis = db.Column(db.Float, nullable=False, default=0.0)     # стоимость остатка по средней цене покупки
+    realized_pnl = db.Column(db.Float, nullable=False, default=0.0)   # результат закрытых продаж
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+    __table_args__ = (db.UniqueConstraint('account_id', 'stock_id', name='uq_position_account_stock'),)
+    stock = db.relationship('Stock', lazy=True)
+
+    @property
+    def avg_price(self):
+        return self.cost_basis / self.quantity if self.quantity > 0 else 0.0
+
+# Версия операций пользователя: растет при каждой записи операций по его счетам,
+# входит в ключ кэша оценки портфеля (см. valuation_cache.py)
+class LedgerVersion(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # Избранное (Watchlist)
 class Watchlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -94,3 +241,76 @@ class CashFlow(db.Model):
     # Быстрые связи
     stock = db.relationship('Stock', lazy=True)
     account = db.relationship('Account', lazy=True)
+
+# Справочник бумаг MOEX (обновляется раз в сутки целиком)
+class SecurityMaster(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    secid = db.Column(db.String(36), unique=True, nullable=False)   # актуальный SECID на MOEX
+    market = db.Column(db.String(20), nullable=True)                 # 'shares' | 'bonds'
+    primary_board = db.Column(db.String(12), nullable=True)          # основная площадка (TQBR, TQCB, ...)
+    boards = db.Column(db.String(255), nullable=True)                # все площадки через запятую, основная первой
+    isin = db.Column(db.String(36), nullable=True)
+    lot_size = db.Column(db.Integer, nullable=True)
+    aliases = db.Column(db.String(255), nullable=True)               # прежние тикеры через запятую (YNDX для YDEX)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+# Торговый календарь MOEX (фондовый рынок): рабочие дни и границы торгового дня по Москве
+class TradingDay(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, unique=True, nullable=False)
+    is_work_day = db.Column(db.Boolean, nullable=False, default=True)
+    start_time = db.Column(db.String(8), nullable=True)   # 'HH:MM:SS' по Москве
+    stop_time = db.Column(db.String(8), nullable=True)
+    source = db.Column(db.String(20), nullable=True)      # 'timetable' | 'dailytable' (исключение из расписания)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+# Просмотры страниц бумаг по дням (для приоритета обновления цен)
+class StockView(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('stock_id', 'day', name='uq_stock_view_day'),)
+
+# История запусков фоновых задач планировщика (по ней же планировщик восстанавливает расписание)
+class JobRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(50), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='running')  # 'running' | 'success' | 'error' | 'abandoned'
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration_sec = db.Column(db.Float, nullable=True)
+    rows = db.Column(db.Integer, nullable=True)            # сколько строк БД затронула задача
+    upstream_calls = db.Column(db.Integer, nullable=True)  # сколько запросов к MOEX было сделано за время задачи
+    error = db.Column(db.Text, nullable=True)
+    details = db.Column(db.Text, nullable=True)            # результат задачи (JSON)
+    pid = db.Column(db.Integer, nullable=True)
+
+# Дневные свечи бумаг: локальное хранилище истории цен (прошедшие дни не меняются)
+class PriceBar(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    open = db.Column(db.Float, nullable=True)
+    high = db.Column(db.Float, nullable=True)
+    low = db.Column(db.Float, nullable=True)
+    close = db.Column(db.Float, nullable=True)
+    volume = db.Column(db.BigInteger, nullable=True)
+    # Уникальный ключ - он же индекс для выборки диапазона дат по бумаге
+    __table_args__ = (db.UniqueConstraint('stock_id', 'date', name='uq_price_bar_stock_date'),)
+
+# Какой диапазон истории бумаги уже загружен в PriceBar
+class PriceBarCoverage(db.Model):
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), primary_key=True, autoincrement=False)
+    first_date = db.Column(db.Date, nullable=False)     # с какой даты история запрашивалась с MOEX
+    checked_at = db.Column(db.DateTime, nullable=True)  # когда последний раз дозагружался хвост
+
+# Докуда дошла загрузка дневной истории всей площадки по датам (для продолжения после остановки)
+class BackfillCheckpoint(db.Model):
+    name = db.Column(db.String(40), primary_key=True)      # 'shares:TQBR'
+    start_date = db.Column(db.Date, nullable=False)        # с какой даты идет загрузка
+    last_date = db.Column(db.Date, nullable=True)          # последний полностью загруженный день
+    days = db.Column(db.Integer, nullable=False, default=0)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    elapsed_sec = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
@@ -1,5 +1,6 @@
 from app import app
 from database import db, User, Account, Stock, Transaction
+import position_ledger
 import random
 
 def create_demo_data():
@@ -118,6 +119,8 @@ def create_demo_data():
         
         try:
             db.session.commit()
+            # Позиции счетов по созданным операциям
+            position_ledger.rebuild([main_account.id, second_account.id])
             print("Демонстрационные данные успешно созданы!")
             print(f"Пользователь: {demo_user.username}")
             print(f"Telegram ID: {demo_user.telegram_id}")
@@ -0,0 +1,255 @@
+"""
+Загрузчик длинной дневной истории с MOEX ISS
+MOEX отдает /history страницами по 100 строк и сообщает положение в блоке history.cursor
+(INDEX, TOTAL, PAGESIZE). Период режется на окна по датам, окна загружаются параллельно,
+страницы передаются получателю по мере прихода через ограниченную очередь - многолетняя
+история не собирается целиком в памяти.
+board_days - история всей площадки по торговым дням (одна дата - все бумаги) для первичной загрузки
+"""
+
+import os
+import queue
+import threading
+import logging
+import requests
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import iss_decoder
+from iss_decoder import FLOAT, INT, STR, DATE
+
+logger = logging.getLogger(__name__)
+
+MOEX_BASE_URL = "https://iss.moex.com/iss"
+HISTORY_SCHEMA = {
+    'TRADEDATE': DATE, 'OPEN': FLOAT, 'HIGH': FLOAT, 'LOW': FLOAT, 'CLOSE': FLOAT, 'VOLUME': INT,
+}
+# Та же история по всей площадке за день (запрос .../securities.json?date=)
+BOARD_HISTORY_SCHEMA = {'SECID': STR, **HISTORY_SCHEMA}
+CURSOR_SCHEMA = {'INDEX': INT, 'TOTAL': INT, 'PAGESIZE': INT}
+# Размер страницы MOEX по умолчанию (если блок cursor не пришел)
+DEFAULT_PAGE_SIZE = 100
+# Сколько страниц может ждать получателя, прежде чем загрузчики остановятся
+QUEUE_PAGES = 16
+
+
+def _wake(pages):
+    try:
+        pages.put_nowait(None)
+    except queue.Full:
+        pass
+
+
+class HistoryFetchError(Exception):
+    """Не удалось загрузить историю ни с одной площадки"""
+
+
+class HistoryFetcher:
+    """Постраничная загрузка дневных свечей по одной или нескольким бумагам"""
+
+    def __init__(self):
+        self.moex_base_url = MOEX_BASE_URL
+        try:
+            self.max_workers = max(1, int(os.environ.get('MOEX_HISTORY_WORKERS', '4')))
+        except ValueError:
+            self.max_workers = 4
+        # Длина окна по датам: год - около 250 торговых дней, т.е. 3 страницы
+        self.window_days = 365
+        self._local = threading.local()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """HTTP-сессия текущего потока"""
+        sess = getattr(self._local, 'session', None)
+        if sess is None:
+            sess = requests.Session()
+            sess.headers.update({'User-Agent': 'InvestBot/1.0'})
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2)
+            sess.mount('https://', adapter)
+            iss_decoder.upstream_calls.attach(sess)
+            self._local.session = sess
+        return sess
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='moex-history')
+        return self._executor
+
+    def windows(self, start, end):
+        """Режет [start, end] на окна не длиннее window_days"""
+        result = []
+        window_start = start
+        while window_start <= end:
+            window_end = min(end, window_start + timedelta(days=self.window_days - 1))
+            result.append((window_start, window_end))
+            window_start = window_end + timedelta(days=1)
+        return result
+
+    def _iter_cursor(self, url, params, schema):
+        """Записи всех страниц запроса /history по курсору history.cursor (страница - список записей)"""
+        index = 0
+        while True:
+            page_params = dict(params, start=index)
+            page_params.update({
+                'iss.meta': 'off',
+                'iss.only': 'history,history.cursor',
+                'history.columns': ','.join(schema),
+            })
+            data = iss_decoder.get_json(self.session, url, params=page_params, timeout=15) or {}
+            table = iss_decoder.decode_block(data.get('history'), schema)
+            yield table.records()
+            cursor = iss_decoder.decode_block(data.get('history.cursor'), CURSOR_SCHEMA).records()
+            if cursor and cursor[0]['TOTAL'] is not None:
+                page_size = cursor[0]['PAGESIZE'] or DEFAULT_PAGE_SIZE
+                index = (cursor[0]['INDEX'] or 0) + page_size
+                if index >= cursor[0]['TOTAL']:
+                    return
+            else:
+                # Курсора нет: неполная страница - последняя
+                if len(table) < DEFAULT_PAGE_SIZE:
+                    return
+                index += len(table)
+
+    @staticmethod
+    def _bar(row):
+        return {'date': row['TRADEDATE'], 'open': row['OPEN'], 'high': row['HIGH'],
+                'low': row['LOW'], 'close': row['CLOSE'], 'volume': row['VOLUME']}
+
+    def iter_pages(self, secid, board, start, end, market='shares'):
+        """Страницы свечей за [start, end] по курсору history.cursor: [{date, open, high, low, close, volume}]"""
+        url = f"{self.moex_base_url}/history/engines/stock/markets/{market}/boards/{board}/securities/{secid}.json"
+        params = {'from': start.isoformat(), 'till': end.isoformat()}
+        for records in self._iter_cursor(url, params, HISTORY_SCHEMA):
+            page = [self._bar(row) for row in records if row['TRADEDATE']]
+            if page:
+                yield page
+
+    def iter_board_pages(self, board, trade_date, market='shares'):
+        """Страницы свечей всех бумаг площадки за один торговый день: [{secid, date, open, ...}]"""
+        url = f"{self.moex_base_url}/history/engines/stock/markets/{market}/boards/{board}/securities.json"
+        params = {'date': trade_date.isoformat()}
+        for records in self._iter_cursor(url, params, BOARD_HISTORY_SCHEMA):
+            page = [dict(self._bar(row), secid=row['SECID']) for row in records if row['SECID'] and row['TRADEDATE']]
+            if page:
+                yield page
+
+    def _load_board_day(self, board, trade_date, market):
+        return [bar for page in self.iter_board_pages(board, trade_date, market) for bar in page]
+
+    def board_days(self, board, dates, market='shares'):
+        """Свечи всех бумаг площадки по дням: генератор (date, [{secid, date, open, ...}]) в порядке dates.
+        Следующие дни загружаются в пуле заранее (не больше max_workers вперед), ошибка дня - исключение
+        """
+        dates = list(dates)
+        executor = self._get_executor()
+        pending = {}
+        try:
+            for i, trade_date in enumerate(dates):
+                for ahead in dates[i:i + self.max_workers]:
+                    if ahead not in pending:
+                        pending[ahead] = executor.submit(self._load_board_day, board, ahead, market)
+                yield trade_date, pending.pop(trade_date).result()
+        finally:
+            # Остановка на середине (ошибка или лимит дней) - загруженные заранее дни не нужны
+            for future in pending.values():
+                future.cancel()
+
+    def _load_window(self, secid, board, window, market, pages, cancel):
+        """Загружает одно окно в потоке пула и кладет страницы в очередь (ошибка - через future)"""
+        for page in self.iter_pages(secid, board, window[0], window[1], market):
+            while True:
+                if cancel.is_set():
+                    return
+                try:
+                    pages.put(page, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def _fetch_board(self, secid, board, start, end, sink, market):
+        """Все окна одной площадки параллельно; sink(page) вызывается в текущем потоке.
+        Возвращает число переданных строк, при ошибке любого окна - исключение
+        """
+        windows = self.windows(start, end)
+        rows = 0
+        if len(windows) == 1:
+            # Короткий период (например, хвост истории) грузим без пула
+            for page in self.iter_pages(secid, board, start, end, market):
+                sink(page)
+                rows += len(page)
+            return rows
+
+        pages = queue.Queue(maxsize=QUEUE_PAGES)
+        cancel = threading.Event()
+        executor = self._get_executor()
+        futures = [
+            executor.submit(self._load_window, secid, board, window, market, pages, cancel)
+            for window in windows
+        ]
+        for future in futures:
+            # Завершение окна будит получателя (None в очереди), чтобы он не ждал таймаута
+            future.add_done_callback(lambda f: _wake(pages))
+        try:
+            while True:
+                try:
+                    page = pages.get(timeout=1)
+                except queue.Empty:
+                    page = None
+                if page:
+                    sink(page)
+                    rows += len(page)
+                    continue
+                if any(f.done() and f.exception() for f in futures):
+                    break
+                if all(f.done() for f in futures) and pages.empty():
+                    break
+        finally:
+            # Ошибка окна или получателя - останавливаем остальные загрузчики
+            cancel.set()
+        for future in futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        return rows
+
+    def fetch(self, secid, boards, start, end, sink, market='shares'):
+        """Загружает свечи бумаги за [start, end], передавая страницы в sink(page) по мере прихода.
+        Площадки перебираются по очереди, пока одна не вернет данные.
+        Возвращает число строк (0 - торгов в периоде не было); HistoryFetchError - ни одна площадка не ответила
+        """
+        answered = False
+        last_error = None
+        for board in boards:
+            try:
+                rows = self._fetch_board(secid, board, start, end, sink, market)
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Ошибка загрузки истории {secid} с площадки {board}: {e}")
+                continue
+            answered = True
+            if rows:
+                logger.info(f"Загружено {rows} свечей истории {secid} с площадки {board} ({start}..{end})")
+                return rows
+        if answered:
+            return 0
+        raise HistoryFetchError(f"История {secid} не загружена: {last_error}")
+
+    def fetch_many(self, items, start, end, sink, market='shares'):
+        """Загружает историю нескольких бумаг: items - [(key, secid, boards)], sink(key, page).
+        Возвращает {key: число строк или None, если загрузка не удалась}
+        """
+        result = {}
+        for key, secid, boards in items:
+            try:
+                result[key] = self.fetch(secid, boards, start, end, lambda page, key=key: sink(key, page), market)
+            except HistoryFetchError as e:
+                logger.warning(str(e))
+                result[key] = None
+        return result
+
+
+# Глобальный экземпляр загрузчика истории
+history_fetcher = HistoryFetcher()
@@ -33,9 +33,18 @@ def init_database(app):
     """Инициализирует базу данных"""
     try:
         with app.app_context():
-            # Создаем все таблицы
-            db.create_all()
+            # Создаем все таблицы и выполняем миграции (под той же блокировкой, что и воркеры)
+            from database import run_migrations
+            moved, added = run_migrations()
             logger.info("✅ База данных инициализирована")
+            if moved:
+                logger.info(f"✅ Котировки перенесены в stock_quote: {moved} бумаг")
+            if added:
+                logger.info(f"✅ В таблицу transaction добавлены колонки: {', '.join(added)}")
+            import position_ledger
+            built = position_ledger.ensure_built()
+            if built:
+                logger.info(f"✅ Позиции счетов пересчитаны по истории операций: {built}")
             return True
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации базы данных: {e}")
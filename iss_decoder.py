@@ -0,0 +1,181 @@
+"""
+Колоночный декодер ответов MOEX ISS
+Превращает блок {columns, data} в типизированные массивы NumPy за один проход
+вместо dict(zip(columns, row)) и try/except на каждое поле каждой строки
+"""
+
+import json
+import threading
+import numpy as np
+import pandas as pd
+
+# Быстрый JSON-парсер (необязательная зависимость)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Правила приведения полей
+FLOAT = 'float'        # float64, пустые значения -> NaN
+INT = 'int'            # float64 с NaN внутри, наружу отдается как int
+STR = 'str'            # object, пустые строки -> None
+DATE = 'date'          # datetime64[ns], '0000-00-00' и мусор -> NaT
+DATETIME = 'datetime'  # datetime64[ns] из 'YYYY-MM-DD HH:MM:SS'
+
+
+class UpstreamCounter:
+    """Счетчик HTTP-запросов к MOEX (подключается к requests.Session как response-hook)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def __call__(self, response, *args, **kwargs):
+        with self._lock:
+            self.value += 1
+        return response
+
+    def attach(self, session):
+        """Подключает счетчик к сессии"""
+        session.hooks['response'].append(self)
+        return session
+
+
+# Общий счетчик запросов процесса к ISS
+upstream_calls = UpstreamCounter()
+
+
+def loads(content):
+    """Разбирает JSON (bytes или str), используя orjson при наличии"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def get_json(session, url, params=None, timeout=10):
+    """GET-запрос к ISS с разбором ответа быстрым парсером"""
+    response = session.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    content = getattr(response, 'content', None)
+    if isinstance(content, (bytes, str)):
+        return loads(content)
+    return response.json()
+
+
+def as_float(value):
+    """Элемент числового массива -> float или None (для NaN)"""
+    if value is None or value != value:
+        return None
+    return float(value)
+
+
+def as_int(value):
+    """Элемент числового массива -> int или None (для NaN)"""
+    if value is None or value != value:
+        return None
+    return int(value)
+
+
+def _coerce(series, kind):
+    """Приводит колонку к нужному типу одной векторной операцией"""
+    if kind in (FLOAT, INT):
+        return pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64')
+    if kind == DATE:
+        return pd.to_datetime(series, errors='coerce', format='%Y-%m-%d').to_numpy()
+    if kind == DATETIME:
+        return pd.to_datetime(series, errors='coerce', format='%Y-%m-%d %H:%M:%S').to_numpy()
+    values = series.to_numpy(dtype=object)
+    mask = pd.isna(values) | (values == '')
+    if mask.any():
+        values = values.copy()
+        values[mask] = None
+    return values
+
+
+def _empty(kind, length):
+    """Колонка-заглушка для поля, которого нет в ответе"""
+    if kind in (FLOAT, INT):
+        return np.full(length, np.nan)
+    if kind in (DATE, DATETIME):
+        return np.full(length, np.datetime64('NaT'), dtype='datetime64[ns]')
+    return np.full(length, None, dtype=object)
+
+
+class ISSTable:
+    """Типизированная таблица ISS: словарь колонка -> массив NumPy"""
+
+    def __init__(self, columns, kinds, length, present=None):
+        self.columns = columns
+        self.kinds = kinds
+        self.length = length
+        # Поля, которые реально пришли в ответе (а не подставлены заглушкой)
+        self.present = set(columns) if present is None else set(present)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name):
+        return name in self.present
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def first_valid(self, *names, positive=False):
+        """Построчно берет первое непустое значение из числовых колонок names (приоритет слева направо).
+        positive=True дополнительно пропускает нули и отрицательные значения.
+        """
+        result = np.full(self.length, np.nan)
+        for name in reversed(names):
+            col = self.columns.get(name)
+            if col is None:
+                continue
+            valid = ~np.isnan(col)
+            if positive:
+                valid &= col > 0
+            result = np.where(valid, col, result)
+        return result
+
+    def value(self, name, i):
+        """Значение ячейки в виде обычного Python-типа (None вместо NaN/NaT)"""
+        return _to_python(self.columns[name][i], self.kinds.get(name))
+
+    def records(self, names=None):
+        """Список словарей с Python-типами (для кода, которому нужны построчные записи)"""
+        names = list(names or self.columns.keys())
+        cols = [[_to_python(v, self.kinds.get(n)) for v in self.columns[n]] for n in names]
+        return [dict(zip(names, row)) for row in zip(*cols)]
+
+
+def _to_python(value, kind):
+    """Переводит элемент массива в Python-значение"""
+    if kind in (FLOAT, INT):
+        if value is None or np.isnan(value):
+            return None
+        return int(value) if kind == INT else float(value)
+    if kind in (DATE, DATETIME):
+        if pd.isna(value):
+            return None
+        ts = pd.Timestamp(value)
+        return ts.date() if kind == DATE else ts.to_pydatetime()
+    return value
+
+
+def decode_block(block, schema):
+    """Декодирует блок ISS {columns, data} по схеме {имя поля: правило приведения}.
+    Поля, которых нет в ответе, заполняются пустыми значениями; лишние колонки игнорируются.
+    """
+    block = block or {}
+    columns = block.get('columns') or []
+    data = block.get('data') or []
+    length = len(data)
+    frame = pd.DataFrame(data, columns=columns) if length else None
+
+    decoded = {}
+    present = set()
+    for name, kind in schema.items():
+        if frame is not None and name in frame.columns:
+            decoded[name] = _coerce(frame[name], kind)
+            present.add(name)
+        else:
+            decoded[name] = _empty(kind, length)
+    return ISSTable(decoded, dict(schema), length, present)
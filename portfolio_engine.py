@@ -0,0 +1,150 @@
+"""
+Векторный расчет статистики портфеля (NumPy/pandas)
+Позиции пользователя (результат utils.portfolio_positions) переводятся в колонки, после чего
+стоимость, средняя цена и результат всех позиций считаются одним проходом по массивам, а итоги
+по счетам, бумагам, секторам и типам инструментов - группировками. Формулы и порядок строк те же,
+что у прежнего расчета в циклах: позиции идут в порядке счетов пользователя, внутри счета -
+в порядке открытия, проценты при нулевой себестоимости равны 0
+"""
+
+import numpy as np
+import pandas as pd
+
+# Сектор бумаги без сектора и тип бумаги без типа
+DEFAULT_SECTOR = 'Прочее'
+DEFAULT_INSTRUMENT_TYPE = 'share'
+
+
+def _percent(part, base):
+    """part / base * 100 поэлементно, 0 там, где base <= 0"""
+    part = np.asarray(part, dtype='float64')
+    base = np.asarray(base, dtype='float64')
+    safe = np.where(base > 0, base, 1.0)
+    return np.where(base > 0, part / safe * 100, 0.0)
+
+
+def _frame(positions, account_ids):
+    """Колонки позиций счетов account_ids в порядке счетов, внутри счета - в исходном порядке"""
+    rank = {account_id: i for i, account_id in enumerate(account_ids)}
+    rows = [p for p in positions if p['account_id'] in rank]
+    stocks = [p['stock'] for p in rows]
+    frame = pd.DataFrame({
+        'account_id': np.array([p['account_id'] for p in rows], dtype='int64'),
+        'stock_id': np.array([p['stock_id'] for p in rows], dtype='int64'),
+        'stock': pd.Series(stocks, dtype='object'),
+        'quantity': np.array([p['quantity'] for p in rows], dtype='int64'),
+        'total_cost': np.array([p['total_cost'] or 0.0 for p in rows], dtype='float64'),
+        'realized_pnl': np.array([p.get('realized_pnl') or 0.0 for p in rows], dtype='float64'),
+        'current_price': np.array([p['price'] or 0.0 for p in rows], dtype='float64'),
+        'sector': pd.Series([getattr(s, 'sector', None) or DEFAULT_SECTOR for s in stocks], dtype='object'),
+        'instrument_type': pd.Series(
+            [getattr(s, 'instrument_type', None) or DEFAULT_INSTRUMENT_TYPE for s in stocks], dtype='object'
+        ),
+        'rank': np.array([rank[p['account_id']] for p in rows], dtype='int64'),
+    })
+    return frame.sort_values('rank', kind='stable', ignore_index=True)
+
+
+def _with_results(frame):
+    """Добавляет стоимость, среднюю цену и результат (в рублях и процентах) к строкам с quantity и total_cost"""
+    quantity = frame['quantity'].to_numpy(dtype='float64')
+    cost = frame['total_cost'].to_numpy()
+    value = frame['current_value'].to_numpy() if 'current_value' in frame else quantity * frame['current_price'].to_numpy()
+    frame['current_value'] = value
+    frame['avg_price'] = cost / np.where(quantity > 0, quantity, 1.0)
+    frame['profit_loss'] = value - cost
+    frame['profit_loss_percent'] = _percent(value - cost, cost)
+    return frame
+
+
+class PortfolioValuation:
+    """Результат расчета: позиции по счетам, объединенные по бумагам позиции, итоги по счетам,
+    секторам и типам инструментов (DataFrame) и общие итоги (dict)
+    """
+
+    def __init__(self, positions, account_ids):
+        self.positions = _with_results(_frame(positions, account_ids))
+        sums = {'total_cost': 'sum', 'current_value': 'sum'}
+
+        # Итоги по счетам: все счета пользователя, в том числе без позиций
+        accounts = self.positions.groupby('account_id', sort=False).agg(sums).reindex(list(account_ids), fill_value=0.0)
+        accounts.columns = ['total_invested', 'total_current_value']
+        accounts['total_profit_loss'] = accounts['total_current_value'] - accounts['total_invested']
+        accounts['total_profit_loss_percent'] = _percent(accounts['total_profit_loss'], accounts['total_invested'])
+        self.accounts = accounts
+
+        # Одна строка на бумагу по всем счетам, в порядке первой позиции
+        stocks = self.positions.groupby('stock_id', sort=False).agg(
+            stock=('stock', 'first'), quantity=('quantity', 'sum'), total_cost=('total_cost', 'sum'),
+            realized_pnl=('realized_pnl', 'sum'), current_value=('current_value', 'sum'),
+        ).reset_index()
+        self.stocks = _with_results(stocks)
+
+        # Сектора в порядке первой позиции, доля - от стоимости всего портфеля
+        self.total_value = float(self.positions['current_value'].sum())
+        sectors = self.positions.groupby('sector', sort=False).agg(
+            value=('current_value', 'sum'), cost=('total_cost', 'sum'), profit_loss=('profit_loss', 'sum'),
+        )
+        sectors['percentage'] = _percent(sectors['value'], np.full(len(sectors), self.total_value))
+        self.sectors = sectors
+
+        self.instrument_types = self.positions.groupby('instrument_type', sort=False).agg(
+            value=('current_value', 'sum'), count=('stock_id', 'size'),
+        )
+
+        invested = float(accounts['total_invested'].sum())
+        current_value = float(accounts['total_current_value'].sum())
+        self.totals = {
+            'total_invested': invested,
+            'total_current_value': current_value,
+            'total_profit_loss': current_value - invested,
+            'total_profit_loss_percent': (current_value - invested) / invested * 100 if invested > 0 else 0,
+        }
+
+    def account_totals(self, account_id):
+        """Итоги счета: total_invested, total_current_value, total_profit_loss, total_profit_loss_percent"""
+        if account_id not in self.accounts.index:
+            return {'total_invested': 0, 'total_current_value': 0, 'total_profit_loss': 0, 'total_profit_loss_percent': 0}
+        return {name: float(value) for name, value in self.accounts.loc[account_id].items()}
+
+    def account_positions(self, account_id):
+        """Позиции счета в формате calculate_account_stats"""
+        frame = self.positions[self.positions['account_id'] == account_id]
+        return frame[['stock_id', 'stock', 'quantity', 'total_cost', 'realized_pnl', 'avg_price',
+                      'current_value', 'profit_loss', 'profit_loss_percent']].to_dict('records')
+
+    def stock_positions(self):
+        """Позиции, объединенные по бумагам всех счетов, в формате calculate_portfolio_stats"""
+        return self.stocks[['stock_id', 'stock', 'quantity', 'total_cost', 'realized_pnl', 'avg_price',
+                            'current_value', 'profit_loss', 'profit_loss_percent']].to_dict('records')
+
+    def analysis(self, accounts):
+        """Позиции для анализа портфеля по убыванию стоимости ({'stock', 'account', ..., 'profit_loss_pct'}),
+        позиции каждого сектора (в порядке счетов) и итоги по типам инструментов.
+        accounts - {account_id: Account}
+        """
+        frame = self.positions.rename(columns={'profit_loss_percent': 'profit_loss_pct'})
+        records = frame[['account_id', 'stock', 'quantity', 'avg_price', 'current_price', 'current_value',
+                         'total_cost', 'profit_loss', 'profit_loss_pct', 'sector']].to_dict('records')
+        by_sector = {}
+        for record in records:
+            record['account'] = accounts.get(record.pop('account_id'))
+            by_sector.setdefault(record.pop('sector'), []).append(record)
+        order = np.argsort(-frame['current_value'].to_numpy(), kind='stable')
+        positions = [records[i] for i in order]
+        sectors = {
+            sector: {**{name: float(value) for name, value in row.items()}, 'positions': by_sector[sector]}
+            for sector, row in self.sectors.iterrows()
+        }
+        instruments = {name: {'value': 0, 'count': 0} for name in ('share', 'bond')}
+        for name, row in self.instrument_types.iterrows():
+            if name in instruments:
+                instruments[name] = {'value': float(row['value']), 'count': int(row['count'])}
+        return positions, sectors, instruments
+
+
+def evaluate(positions, account_ids):
+    """Статистика позиций счетов account_ids (порядок счетов задает порядок позиций).
+    positions - [{'account_id', 'stock_id', 'stock', 'quantity', 'total_cost', 'realized_pnl', 'price'}]
+    """
+    return PortfolioValuation(positions, account_ids)
@@ -0,0 +1,244 @@
+"""
+История стоимости портфеля по операциям
+Датированные операции пользователя превращаются в матрицу количества бумаг по дням (накопленная
+сумма покупок и продаж, в том числе внесенных задним числом) и умножаются на матрицу цен закрытия
+из PriceBar; деньги на счетах и вложенный капитал - накопленные суммы денежных операций.
+Весь период считается векторно сразу, поэтому один запрос отдает историю за годы.
+Цены закрытия бумаг кэшируются в памяти процесса и перечитываются из БД не чаще, чем price_bars
+проверяет у MOEX новый хвост истории. Запрос отдает то, что уже есть в PriceBar, а недостающие
+диапазоны дозагружаются с MOEX в фоне - их увидят следующие запросы
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+from flask import current_app
+from database import db, Account, Stock, Transaction, PriceBar
+from price_bars import price_bars
+from shared_quotes import shared_quotes
+from trading_calendar import trading_calendar
+
+logger = logging.getLogger(__name__)
+
+# На сколько дней раньше начала периода читать цены - чтобы была цена на первый день (после праздников)
+PRICE_LOOKBACK_DAYS = 14
+# Знак суммы операции для денег на счете и для вложенного капитала
+CASH_SIGN = {'deposit': 1, 'withdrawal': -1, 'buy': -1, 'sell': 1}
+INVESTED_SIGN = {'deposit': 1, 'withdrawal': -1}
+QUANTITY_SIGN = {'buy': 1, 'sell': -1}
+
+
+def _cumulative(values, days):
+    """Накопленная на каждый день из days сумма values (Series или DataFrame с индексом-датой,
+    даты могут повторяться и быть раньше days)
+    """
+    summed = values.groupby(level=0).sum()
+    return summed.reindex(summed.index.union(days), fill_value=0).cumsum().reindex(days)
+
+
+class CloseCache:
+    """Цены закрытия бумаг (Series по датам) в памяти процесса с вытеснением давно не запрашивавшихся"""
+
+    def __init__(self, size=None):
+        try:
+            self.size = int(size or os.environ.get('PORTFOLIO_REPLAY_CACHE_SERIES', '1024'))
+        except ValueError:
+            self.size = 1024
+        # Сколько бумаг одновременно дозагружается с MOEX в фоне
+        try:
+            self.workers = max(1, int(os.environ.get('PORTFOLIO_REPLAY_FETCH_WORKERS', '2')))
+        except ValueError:
+            self.workers = 2
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        # Бумаги, история которых сейчас дозагружается, и задачи дозагрузки
+        self._fetching = set()
+        self._futures = set()
+        self._executor = None
+
+    def _cached(self, stock_id, start, now):
+        with self._lock:
+            entry = self._series.get(stock_id)
+            if entry is None:
+                return None
+            self._series.move_to_end(stock_id)
+        loaded_from, loaded_at, series = entry
+        if loaded_from <= start and now - loaded_at < price_bars.tail_ttl:
+            return series
+        return None
+
+    def _store(self, stock_id, start, now, series):
+        with self._lock:
+            self._series[stock_id] = (start, now, series)
+            self._series.move_to_end(stock_id)
+            while len(self._series) > self.size:
+                self._series.popitem(last=False)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='replay-history')
+            return self._executor
+
+    def _fetch(self, app, stock_id, ticker, start, end, fetch_for):
+        """Дозагружает историю бумаги в потоке пула; после успешной загрузки цены перечитаются из БД"""
+        try:
+            with app.app_context():
+                price_bars.ensure(stock_id, start, end, fetch_for(ticker))
+                if not price_bars.missing_ranges(stock_id, start, end):
+                    with self._lock:
+                        self._series.pop(stock_id, None)
+        except Exception as e:
+            logger.warning(f"Не удалось дозагрузить историю бумаги {stock_id}: {e}")
+        finally:
+            with self._lock:
+                self._fetching.discard(stock_id)
+
+    def _fetch_in_background(self, stocks, start, end, fetch_for):
+        """Ставит дозагрузку бумаг в пул (бумаги, которые уже загружаются, пропускаются)"""
+        app = current_app._get_current_object()
+        with self._lock:
+            stocks = [stock for stock in stocks if stock.id not in self._fetching]
+            self._fetching.update(stock.id for stock in stocks)
+        executor = self._get_executor()
+        for stock in stocks:
+            future = executor.submit(self._fetch, app, stock.id, stock.ticker, start, end, fetch_for)
+            with self._lock:
+                self._futures.add(future)
+            future.add_done_callback(self._futures.discard)
+
+    def wait(self, timeout=None):
+        """Ждет завершения фоновых дозагрузок (для тестов и скриптов)"""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+
+    def matrix(self, stocks, start, end, fetch_for):
+        """Цены закрытия [start, end]: строки - даты свечей, колонки - id бумаг.
+        Цены бумаг не из кэша читаются из БД одним запросом; недостающие в PriceBar диапазоны
+        дозагружаются с MOEX в фоне (fetch_for(ticker) -> fetch для price_bars), запрос их не ждет
+        """
+        now = time.time()
+        columns = {}
+        stale = []
+        for stock in stocks:
+            series = self._cached(stock.id, start, now)
+            if series is None:
+                stale.append(stock)
+            else:
+                columns[stock.id] = series
+        if stale:
+            missing = price_bars.missing_ranges_many([stock.id for stock in stale], start, end)
+            rows = db.session.query(PriceBar.stock_id, PriceBar.date, PriceBar.close).filter(
+                PriceBar.stock_id.in_([stock.id for stock in stale]),
+                PriceBar.date >= start, PriceBar.date <= end, PriceBar.close > 0
+            ).all()
+            frame = pd.DataFrame(rows, columns=['stock_id', 'date', 'close'])
+            frame['date'] = pd.to_datetime(frame['date'])
+            loaded = {stock_id: group.set_index('date')['close'] for stock_id, group in frame.groupby('stock_id')}
+            for stock in stale:
+                series = loaded.get(stock.id, pd.Series(dtype='float64', index=pd.DatetimeIndex([])))
+                # Неполная история тоже кэшируется: после дозагрузки запись удаляется, а если MOEX
+                # недоступен, следующая попытка будет не раньше, чем через tail_ttl
+                self._store(stock.id, start, now, series)
+                columns[stock.id] = series
+            incomplete = [stock for stock in stale if missing.get(stock.id)]
+            if incomplete:
+                self._fetch_in_background(incomplete, start, end, fetch_for)
+        if not columns:
+            return pd.DataFrame(index=pd.DatetimeIndex([]))
+        matrix = pd.concat(columns, axis=1).sort_index()
+        return matrix[(matrix.index >= pd.Timestamp(start)) & (matrix.index <= pd.Timestamp(end))]
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class PortfolioReplay:
+    """Стоимость бумаг, деньги на счетах и вложенный капитал пользователя по торговым дням"""
+
+    def __init__(self):
+        self.closes = CloseCache()
+
+    @staticmethod
+    def _ledger(user_id, end):
+        """Операции всех счетов пользователя до конца дня end включительно"""
+        rows = db.session.query(
+            Transaction.timestamp, Transaction.type, Transaction.amount, Transaction.quantity,
+            Transaction.stock_id, Transaction.cash_settled,
+        ).join(Account, Account.id == Transaction.account_id).filter(
+            Account.user_id == user_id
+        ).order_by(Transaction.timestamp, Transaction.id).all()
+        ledger = pd.DataFrame(rows, columns=['timestamp', 'type', 'amount', 'quantity', 'stock_id', 'cash_settled'])
+        # Операция без времени считается сегодняшней (так же их показывает страница счета)
+        ledger['day'] = pd.to_datetime(ledger['timestamp']).fillna(pd.Timestamp.now()).dt.normalize()
+        ledger['amount'] = ledger['amount'].astype('float64').fillna(0.0)
+        return ledger[ledger['day'] <= pd.Timestamp(end)].set_index('day')
+
+    def history(self, user_id, start, end=None, fetch_for=None):
+        """[{'date', 'value', 'cash', 'invested'}] по торговым дням [start, end] (и за сегодня):
+        value - стоимость бумаг по цене закрытия дня (сегодня - по текущей цене), cash - деньги на счетах,
+        invested - внесенный капитал (пополнения минус выводы плюс покупки, внесенные задним числом)
+        """
+        end = end or date.today()
+        days = trading_calendar.trading_dates(start, end)
+        # Сегодняшний день есть в истории всегда - с операциями, сделанными и в неторговый день
+        if end == date.today() and start <= end and (not days or days[-1] != end):
+            days.append(end)
+        days = pd.DatetimeIndex(days)
+        if not len(days):
+            return []
+        if fetch_for is None:
+            from stock_api import stock_api_service
+            fetch_for = stock_api_service.history_fetch
+
+        ledger = self._ledger(user_id, end)
+        tx_type = ledger['type']
+        # Покупка задним числом не списывала деньги: капитал внесен бумагами
+        brought_in = (tx_type == 'buy') & ~ledger['cash_settled'].astype(bool)
+        cash_flow = tx_type.map(CASH_SIGN).fillna(0) * ledger['amount'] * ~brought_in
+        invested_flow = tx_type.map(INVESTED_SIGN).fillna(0) * ledger['amount'] + ledger['amount'] * brought_in
+        cash = _cumulative(cash_flow, days).to_numpy(dtype='float64')
+        invested = _cumulative(invested_flow, days).to_numpy(dtype='float64')
+
+        # Матрица количества: строки - дни, колонки - бумаги
+        trades = ledger[tx_type.isin(list(QUANTITY_SIGN)) & ledger['stock_id'].notna()]
+        per_day = pd.DataFrame({
+            'day': trades.index.to_numpy(),
+            'stock_id': trades['stock_id'].to_numpy(dtype='int64'),
+            'quantity': (trades['type'].map(QUANTITY_SIGN) * trades['quantity'].fillna(0)).to_numpy(dtype='float64'),
+        }).pivot_table(index='day', columns='stock_id', values='quantity', aggfunc='sum')
+        quantities = _cumulative(per_day, days) if len(trades) else pd.DataFrame(index=days)
+        held = [int(stock_id) for stock_id in quantities.columns if quantities[stock_id].any()]
+        quantities = quantities[held]
+
+        value = np.zeros(len(days))
+        if held:
+            stocks = Stock.query.filter(Stock.id.in_(held)).all()
+            closes = self.closes.matrix(stocks, start - timedelta(days=PRICE_LOOKBACK_DAYS), end, fetch_for)
+            closes = closes.reindex(columns=held)
+            closes = closes.reindex(closes.index.union(days)).ffill().reindex(days)
+            # Сегодняшней свечи в истории нет - текущая цена; ее же берем для бумаг без истории
+            current = pd.Series({stock.id: stock.price for stock in stocks}, dtype='float64').reindex(held)
+            live = pd.Series(shared_quotes.prices(held), dtype='float64').reindex(held)
+            current = live.fillna(current)
+            if days[-1] == pd.Timestamp(date.today()):
+                closes.iloc[-1] = current.fillna(closes.iloc[-1])
+            closes = closes.bfill().fillna(current).fillna(0.0)
+            value = (quantities.to_numpy(dtype='float64') * closes.to_numpy(dtype='float64')).sum(axis=1)
+
+        return [
+            {'date': day.date().isoformat(), 'value': round(v, 2), 'cash': round(c, 2), 'invested': round(i, 2)}
+            for day, v, c, i in zip(days, value.tolist(), cash.tolist(), invested.tolist())
+        ]
+
+
+# Глобальный экземпляр расчета истории портфеля
+portfolio_replay = PortfolioReplay()
@@ -0,0 +1,224 @@
+"""
+Материализованные позиции счетов (таблица Position)
+Покупки и продажи обновляют позицию в той же транзакции БД, что и запись Transaction, поэтому
+страницы портфеля читают только открытые позиции, а не всю историю операций.
+Себестоимость считается по средней цене: продажа уменьшает ее пропорционально проданному
+количеству, разница с ценой продажи идет в реализованный результат.
+rebuild/verify пересчитывают позиции по истории Transaction в порядке времени операций (timestamp, затем id).
+Операция, внесенная задним числом, меняет среднюю цену и результат более поздних продаж, поэтому
+такую позицию пересчитывает reapply, а не apply.
+touch увеличивает версию операций пользователя (LedgerVersion) - по ней устаревает кэш оценки портфеля
+"""
+
+import logging
+from sqlalchemy.exc import IntegrityError
+from database import db, Position, Transaction, Account, LedgerVersion
+import bulk_upsert
+
+logger = logging.getLogger(__name__)
+
+# Допустимое расхождение сумм при сверке с историей операций (ошибка округления float)
+TOLERANCE = 1e-6
+
+
+def _apply(state, tx_type, quantity, price):
+    """Применяет операцию к состоянию позиции {'quantity', 'cost_basis', 'realized_pnl'}"""
+    quantity = quantity or 0
+    price = price or 0.0
+    if tx_type == 'buy':
+        state['quantity'] += quantity
+        state['cost_basis'] += quantity * price
+    elif tx_type == 'sell':
+        held = state['quantity']
+        avg_price = state['cost_basis'] / held if held > 0 else 0.0
+        closed = min(quantity, max(held, 0))
+        state['realized_pnl'] += closed * (price - avg_price)
+        state['quantity'] -= quantity
+        state['cost_basis'] = state['quantity'] * avg_price if state['quantity'] > 0 else 0.0
+    return state
+
+
+def _empty():
+    return {'quantity': 0, 'cost_basis': 0.0, 'realized_pnl': 0.0}
+
+
+def lock(account_id, stock_id):
+    """Позиция счета по бумаге, заблокированная до конца транзакции (SELECT ... FOR UPDATE в Postgres);
+    None - позиции нет
+    """
+    return Position.query.filter_by(account_id=account_id, stock_id=stock_id).with_for_update().first()
+
+
+def _lock_or_create(account_id, stock_id):
+    position = lock(account_id, stock_id)
+    if position is None:
+        # Строки еще нет, и FOR UPDATE ее не блокирует: пустую позицию создает INSERT ... ON CONFLICT DO NOTHING
+        # (параллельная первая покупка ждет его, а не падает на уникальном ключе), затем строка блокируется
+        bulk_upsert.insert_ignore(Position, [
+            {'account_id': account_id, 'stock_id': stock_id, 'quantity': 0, 'cost_basis': 0.0, 'realized_pnl': 0.0}
+        ], ('account_id', 'stock_id'))
+        position = lock(account_id, stock_id)
+    return position
+
+
+def apply(account_id, stock_id, tx_type, quantity, price):
+    """Обновляет позицию счета после покупки/продажи. Вызывается рядом с db.session.add(Transaction(...));
+    commit делает вызывающий, так что операция и позиция записываются вместе
+    """
+    position = _lock_or_create(account_id, stock_id)
+    state = _apply(
+        {'quantity': position.quantity or 0, 'cost_basis': position.cost_basis or 0.0, 'realized_pnl': position.realized_pnl or 0.0},
+        tx_type, quantity, price
+    )
+    position.quantity = state['quantity']
+    position.cost_basis = state['cost_basis']
+    position.realized_pnl = state['realized_pnl']
+    return position
+
+
+def reapply(account_id, stock_id):
+    """Пересчитывает позицию счета по бумаге по всей ее истории - после операции, внесенной задним числом.
+    Вызывается после db.session.add(Transaction(...)); commit делает вызывающий
+    """
+    position = _lock_or_create(account_id, stock_id)
+    state = replay([account_id], [stock_id]).get((account_id, stock_id), _empty())
+    position.quantity = state['quantity']
+    position.cost_basis = state['cost_basis']
+    position.realized_pnl = state['realized_pnl']
+    return position
+
+
+def touch(*user_ids):
+    """Увеличивает версию операций пользователей; вызывается при любой записи операций по счетам,
+    commit делает вызывающий
+    """
+    user_ids = sorted({u for u in user_ids if u is not None})
+    if not user_ids:
+        return
+    bump = {'version': LedgerVersion.version + 1}
+    LedgerVersion.query.filter(LedgerVersion.user_id.in_(user_ids)).update(bump, synchronize_session=False)
+    existing = {row[0] for row in db.session.query(LedgerVersion.user_id).filter(LedgerVersion.user_id.in_(user_ids))}
+    for user_id in user_ids:
+        if user_id in existing:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(LedgerVersion(user_id=user_id, version=1))
+        except IntegrityError:
+            # Строку успел вставить другой воркер - увеличиваем его версию
+            LedgerVersion.query.filter_by(user_id=user_id).update(bump, synchronize_session=False)
+
+
+def version(user_id):
+    """Текущая версия операций пользователя (0 - операций еще не было)"""
+    return db.session.query(LedgerVersion.version).filter_by(user_id=user_id).scalar() or 0
+
+
+def open_positions(account_ids, stock_ids=None):
+    """Открытые позиции (quantity > 0) счетов, с бумагой (Stock) одним запросом"""
+    if not account_ids:
+        return []
+    query = Position.query.options(db.joinedload(Position.stock)).filter(
+        Position.account_id.in_(list(account_ids)), Position.quantity > 0
+    )
+    if stock_ids is not None:
+        query = query.filter(Position.stock_id.in_(list(stock_ids)))
+    return query.all()
+
+
+def replay(account_ids=None, stock_ids=None):
+    """Позиции по истории Transaction в порядке времени операций:
+    {(account_id, stock_id): {'quantity', 'cost_basis', 'realized_pnl'}}
+    """
+    query = db.session.query(
+        Transaction.account_id, Transaction.stock_id, Transaction.type, Transaction.quantity, Transaction.price
+    ).filter(Transaction.type.in_(['buy', 'sell']), Transaction.stock_id.isnot(None))
+    if account_ids is not None:
+        query = query.filter(Transaction.account_id.in_(list(account_ids)))
+    if stock_ids is not None:
+        query = query.filter(Transaction.stock_id.in_(list(stock_ids)))
+    states = {}
+    ordered = query.order_by(Transaction.timestamp, Transaction.id)
+    for account_id, stock_id, tx_type, quantity, price in ordered.yield_per(1000):
+        _apply(states.setdefault((account_id, stock_id), _empty()), tx_type, quantity, price)
+    return states
+
+
+def _stored(account_ids=None):
+    query = db.session.query(
+        Position.account_id, Position.stock_id, Position.quantity, Position.cost_basis, Position.realized_pnl
+    )
+    if account_ids is not None:
+        query = query.filter(Position.account_id.in_(list(account_ids)))
+    return {
+        (account_id, stock_id): {'quantity': quantity, 'cost_basis': cost_basis, 'realized_pnl': realized_pnl}
+        for account_id, stock_id, quantity, cost_basis, realized_pnl in query.all()
+    }
+
+
+def _differs(expected, actual):
+    if expected['quantity'] != actual['quantity']:
+        return True
+    return any(abs(expected[k] - actual[k]) > TOLERANCE * max(1.0, abs(expected[k])) for k in ('cost_basis', 'realized_pnl'))
+
+
+def verify(account_ids=None):
+    """Сверяет позиции с историей операций. Возвращает {'success', 'checked', 'mismatches': [...]}"""
+    expected = replay(account_ids)
+    stored = _stored(account_ids)
+    mismatches = []
+    for key in sorted(set(expected) | set(stored)):
+        want = expected.get(key, _empty())
+        have = stored.get(key, _empty())
+        if _differs(want, have):
+            mismatches.append({
+                'account_id': key[0],
+                'stock_id': key[1],
+                'expected': want,
+                'stored': have,
+            })
+    if mismatches:
+        logger.warning(f"Позиции расходятся с историей операций: {len(mismatches)}")
+    return {'success': not mismatches, 'checked': len(set(expected) | set(stored)), 'mismatches': mismatches}
+
+
+def rebuild(account_ids=None):
+    """Пересчитывает позиции по истории операций и перезаписывает таблицу Position.
+    Возвращает {'success', 'positions', 'open'}; ошибка - {'success': False, 'error'}
+    """
+    try:
+        states = replay(account_ids)
+        query = Position.query
+        if account_ids is not None:
+            query = query.filter(Position.account_id.in_(list(account_ids)))
+        query.delete(synchronize_session=False)
+        rows = [
+            {'account_id': account_id, 'stock_id': stock_id, **state}
+            for (account_id, stock_id), state in states.items()
+        ]
+        if rows:
+            db.session.execute(Position.__table__.insert(), rows)
+        # Позиции могли измениться - оценки портфелей этих пользователей устарели
+        users = db.session.query(Account.user_id)
+        if account_ids is not None:
+            users = users.filter(Account.id.in_(list(account_ids)))
+        touch(*[row[0] for row in users.distinct()])
+        db.session.commit()
+        opened = sum(1 for state in states.values() if state['quantity'] > 0)
+        logger.info(f"Позиции пересчитаны по истории операций: {len(rows)}, открытых {opened}")
+        return {'success': True, 'positions': len(rows), 'open': opened}
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка пересчета позиций: {e}")
+        return {'success': False, 'error': str(e)}
+
+
+def ensure_built():
+    """Заполняет Position по истории операций, если таблица только что создана (после деплоя).
+    Возвращает число созданных позиций
+    """
+    if db.session.query(Position.id).first() is not None:
+        return 0
+    if db.session.query(Transaction.id).filter(Transaction.type.in_(['buy', 'sell'])).first() is None:
+        return 0
+    return rebuild().get('positions', 0)
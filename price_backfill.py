@@ -0,0 +1,182 @@
+"""
+Первичная загрузка дневной истории всего рынка по датам
+Вместо запросов по каждой бумаге история площадки берется по торговым дням: один запрос
+/history/.../boards/{board}/securities.json?date= (постранично) возвращает свечи всех бумаг за день.
+Свечи дня пишутся в PriceBar одной транзакцией вместе с отметкой в BackfillCheckpoint,
+поэтому загрузка после остановки продолжается со следующего дня
+"""
+
+import os
+import time
+import logging
+from datetime import date, timedelta
+from database import db, Stock, PriceBar, PriceBarCoverage, BackfillCheckpoint
+from history_fetcher import history_fetcher
+from price_bars import BAR_FIELDS
+from security_master import security_master
+from trading_calendar import trading_calendar
+import bulk_upsert
+
+logger = logging.getLogger(__name__)
+
+# Сколько лет истории загружать, если HISTORY_BACKFILL_START не задан
+DEFAULT_BACKFILL_YEARS = 5
+
+
+def _env_date(name):
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        logger.warning(f"Некорректная дата в {name}: {value}")
+        return None
+
+
+class MarketBackfill:
+    """Загрузка дневных свечей всей площадки по торговым дням с продолжением с контрольной точки"""
+
+    def __init__(self):
+        # С какой даты загружать историю (YYYY-MM-DD); по умолчанию - с 1 января пять лет назад
+        self.start_date = _env_date('HISTORY_BACKFILL_START')
+        # Сколько дней загружать за один запуск фоновой задачи
+        try:
+            self.days_per_run = max(1, int(os.environ.get('HISTORY_BACKFILL_DAYS_PER_RUN', '250')))
+        except ValueError:
+            self.days_per_run = 250
+
+    def default_start(self):
+        if self.start_date:
+            return self.start_date
+        return date(trading_calendar.today().year - DEFAULT_BACKFILL_YEARS, 1, 1)
+
+    @staticmethod
+    def _stock_ids():
+        """{SECID: id бумаги}; прежние тикеры (YNDX) сопоставляются через справочник бумаг"""
+        ids = dict(db.session.query(Stock.ticker, Stock.id).all())
+        return lambda secid: ids.get(secid) or ids.get(security_master.resolve(secid))
+
+    @staticmethod
+    def _checkpoint(name, start):
+        """Контрольная точка загрузки; если запрошен более ранний старт - загрузка начинается заново"""
+        checkpoint = db.session.get(BackfillCheckpoint, name)
+        if checkpoint is None:
+            checkpoint = BackfillCheckpoint(name=name, start_date=start, days=0, rows=0, elapsed_sec=0.0)
+            db.session.add(checkpoint)
+        elif start < checkpoint.start_date:
+            logger.info(f"Загрузка истории {name}: старт сдвинут на {start}, контрольная точка сброшена")
+            checkpoint.start_date = start
+            checkpoint.last_date = None
+            checkpoint.days = checkpoint.rows = 0
+            checkpoint.elapsed_sec = 0.0
+        db.session.commit()
+        return checkpoint
+
+    @staticmethod
+    def _extend_coverage(checkpoint):
+        """Бумаги, история которых загружена без пропусков с start_date, не запрашиваются
+        с MOEX по отдельности за этот период (см. PriceBarStore.missing_ranges)
+        """
+        if checkpoint.last_date is None:
+            return 0
+        stock_ids = [row[0] for row in db.session.query(PriceBar.stock_id).filter(
+            PriceBar.date >= checkpoint.start_date, PriceBar.date <= checkpoint.last_date
+        ).distinct()]
+        coverage = {c.stock_id: c for c in PriceBarCoverage.query.filter(PriceBarCoverage.stock_id.in_(stock_ids)).all()}
+        extended = 0
+        for stock_id in stock_ids:
+            current = coverage.get(stock_id)
+            if current is None:
+                # Хвост после последней свечи дозагрузится при первом чтении
+                db.session.add(PriceBarCoverage(stock_id=stock_id, first_date=checkpoint.start_date))
+                extended += 1
+            elif checkpoint.start_date < current.first_date <= checkpoint.last_date + timedelta(days=1):
+                current.first_date = checkpoint.start_date
+                extended += 1
+        db.session.commit()
+        return extended
+
+    def run(self, start=None, end=None, board='TQBR', market='shares', max_days=None):
+        """Загружает дни [start, end] после контрольной точки (не больше max_days за запуск).
+        Возвращает {'success', 'days', 'rows', 'elapsed', 'rows_per_sec', 'last_date', 'remaining_days', ...}
+        """
+        name = f'{market}:{board}'
+        start = start or self.default_start()
+        # Свеча текущего дня до конца торгов не окончательная
+        end = min(end or date.max, trading_calendar.today() - timedelta(days=1))
+        max_days = max_days or self.days_per_run
+        started = time.perf_counter()
+        days = rows = fetched = 0
+        remaining = None
+        checkpoint = None
+        error = None
+        try:
+            checkpoint = self._checkpoint(name, start)
+            resume_from = checkpoint.last_date + timedelta(days=1) if checkpoint.last_date else checkpoint.start_date
+            pending = trading_calendar.trading_dates(max(resume_from, start), end)
+            stock_id = self._stock_ids()
+            logger.info(f"Загрузка истории {name}: {len(pending)} торговых дней с {resume_from}, за запуск - до {max_days}")
+
+            mark = time.perf_counter()
+            for trade_date, bars in history_fetcher.board_days(board, pending[:max_days], market):
+                day_rows = []
+                for bar in bars:
+                    sid = stock_id(bar['secid'])
+                    if sid:
+                        day_rows.append({'stock_id': sid, 'date': bar['date'], **{f: bar[f] for f in BAR_FIELDS}})
+                inserted = bulk_upsert.insert_ignore(PriceBar, day_rows, ('stock_id', 'date'))
+                # Свечи дня и контрольная точка - в одной транзакции; время дня включает ожидание MOEX
+                now = time.perf_counter()
+                checkpoint.last_date = trade_date
+                checkpoint.days += 1
+                checkpoint.rows += inserted
+                checkpoint.elapsed_sec += now - mark
+                db.session.commit()
+                mark = now
+                days += 1
+                rows += inserted
+                fetched += len(bars)
+                logger.info(f"История {name} за {trade_date}: {len(bars)} свечей, записано {inserted} "
+                            f"({rows / (now - started):.0f} строк/с)")
+            remaining = max(0, len(pending) - days)
+            self._extend_coverage(checkpoint)
+        except Exception as e:
+            db.session.rollback()
+            error = str(e)
+            logger.error(f"Ошибка загрузки истории {name}: {e}")
+
+        elapsed = round(time.perf_counter() - started, 3)
+        result = {
+            'success': error is None,
+            'days': days,
+            'rows': rows,
+            'fetched': fetched,
+            'elapsed': elapsed,
+            'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+            'last_date': checkpoint.last_date.isoformat() if checkpoint is not None and checkpoint.last_date else None,
+            'remaining_days': remaining,
+        }
+        if error:
+            result['error'] = error
+        logger.info(f"Загрузка истории {name}: {days} дней, {rows} строк за {elapsed} с "
+                    f"({result['rows_per_sec']} строк/с), осталось дней: {remaining}")
+        return result
+
+    @staticmethod
+    def status():
+        """Контрольные точки загрузки (для админки): докуда дошла загрузка и средняя скорость"""
+        return [{
+            'name': c.name,
+            'start_date': c.start_date.isoformat(),
+            'last_date': c.last_date.isoformat() if c.last_date else None,
+            'days': c.days,
+            'rows': c.rows,
+            'elapsed_sec': round(c.elapsed_sec or 0, 1),
+            'rows_per_sec': round(c.rows / c.elapsed_sec, 1) if c.elapsed_sec else None,
+            'updated_at': c.updated_at.isoformat(timespec='seconds') if c.updated_at else None,
+        } for c in BackfillCheckpoint.query.order_by(BackfillCheckpoint.name).all()]
+
+
+# Глобальный экземпляр загрузчика истории рынка
+market_backfill = MarketBackfill()
@@ -0,0 +1,171 @@
+"""
+Локальное хранилище дневных свечей (таблица PriceBar)
+История цен читается из БД одним запросом по диапазону дат; с MOEX дозагружаются только
+недостающие куски: хвост после последней сохраненной свечи и начало, если запрошен более
+ранний период, чем уже загружался.
+Свеча текущего дня в БД не пишется (до конца торгов она меняется), но добавляется в конец истории:
+из ответа MOEX, если она там уже есть, иначе по живой котировке
+"""
+
+import os
+import logging
+from datetime import date, datetime, timedelta
+from database import db, Stock, StockQuote, PriceBar, PriceBarCoverage
+import bulk_upsert
+from shared_quotes import shared_quotes
+from trading_calendar import trading_calendar
+
+logger = logging.getLogger(__name__)
+
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+class PriceBarStore:
+    """Дневные свечи бумаг из БД с дозагрузкой недостающих диапазонов с MOEX"""
+
+    def __init__(self):
+        # Как часто проверять у MOEX новый хвост истории (секунды): свеча текущего дня
+        # появляется в /history только после завершения торгов
+        try:
+            self.tail_ttl = max(60, int(os.environ.get('PRICE_BARS_TAIL_TTL', '900')))
+        except ValueError:
+            self.tail_ttl = 900
+        # Свечи текущего дня, полученные с MOEX: {stock_id: {date, open, high, low, close, volume}}
+        self._today_bars = {}
+
+    @staticmethod
+    def load(stock_id, start, end):
+        """Свечи бумаги за [start, end] из БД (один запрос по уникальному индексу)"""
+        return PriceBar.query.filter(
+            PriceBar.stock_id == stock_id, PriceBar.date >= start, PriceBar.date <= end
+        ).order_by(PriceBar.date).all()
+
+    @staticmethod
+    def save(stock_id, bars):
+        """Дописывает свечи [{date, open, high, low, close, volume}], уже сохраненные даты пропускаются.
+        Свеча текущего дня не сохраняется: до конца торгов она еще может измениться
+        """
+        today = date.today()
+        rows = [
+            {'stock_id': stock_id, 'date': bar['date'], **{f: bar.get(f) for f in BAR_FIELDS}}
+            for bar in bars if bar.get('date') and bar['date'] < today
+        ]
+        return bulk_upsert.insert_ignore(PriceBar, rows, ('stock_id', 'date'))
+
+    def _sink(self, stock_id):
+        """Приемник страниц свечей для fetch: сохраняет их в БД и запоминает свечу текущего дня"""
+        def sink(page):
+            today = date.today()
+            for bar in page:
+                if bar.get('date') == today:
+                    self._today_bars[stock_id] = dict(bar)
+            return self.save(stock_id, page)
+        return sink
+
+    def today_bar(self, stock_id):
+        """Свеча текущего дня (PriceBar вне сессии БД): с MOEX или по котировке, обновленной сегодня.
+        None - сегодня не торговый день или котировки за сегодня нет
+        """
+        today = date.today()
+        bar = self._today_bars.get(stock_id)
+        if bar and bar['date'] == today and bar.get('close'):
+            return PriceBar(stock_id=stock_id, date=today, **{f: bar.get(f) for f in BAR_FIELDS})
+        if not trading_calendar.trading_day(today)[0]:
+            return None
+        quote = shared_quotes.get(stock_id)
+        if quote and quote['price'] and quote['updated_at'] and date.fromtimestamp(quote['updated_at']) == today:
+            return PriceBar(stock_id=stock_id, date=today, close=quote['price'])
+        row = db.session.get(StockQuote, stock_id)
+        if row is not None and row.price and row.updated_at and row.updated_at.date() == today:
+            return PriceBar(stock_id=stock_id, date=today, close=row.price)
+        return None
+
+    def missing_ranges(self, stock_id, start, end, now=None):
+        """Диапазоны [(from, till)], которых нет в хранилище и которые нужно запросить с MOEX"""
+        return self.missing_ranges_many([stock_id], start, end, now)[stock_id]
+
+    def missing_ranges_many(self, stock_ids, start, end, now=None):
+        """missing_ranges для нескольких бумаг двумя запросами: {stock_id: [(from, till)]}"""
+        now = now or datetime.now()
+        stock_ids = list(stock_ids)
+        if not stock_ids:
+            return {}
+        coverages = {c.stock_id: c for c in PriceBarCoverage.query.filter(PriceBarCoverage.stock_id.in_(stock_ids))}
+        tail_due = [
+            stock_id for stock_id, c in coverages.items()
+            if c.checked_at is None or (now - c.checked_at).total_seconds() >= self.tail_ttl
+        ]
+        last_dates = dict(db.session.query(PriceBar.stock_id, db.func.max(PriceBar.date)).filter(
+            PriceBar.stock_id.in_(tail_due)
+        ).group_by(PriceBar.stock_id).all()) if tail_due else {}
+        result = {}
+        for stock_id in stock_ids:
+            coverage = coverages.get(stock_id)
+            if coverage is None:
+                result[stock_id] = [(start, end)]
+                continue
+            ranges = []
+            if start < coverage.first_date:
+                ranges.append((start, coverage.first_date - timedelta(days=1)))
+            if stock_id in tail_due:
+                last = last_dates.get(stock_id)
+                # Хвост - всегда от последней сохраненной свечи, даже если запрошен более короткий период:
+                # после проверки хвоста покрытие считается сплошным до end, пропуск потом не дозагрузится
+                tail_start = last + timedelta(days=1) if last else coverage.first_date
+                if tail_start <= end:
+                    ranges.append((tail_start, end))
+            result[stock_id] = ranges
+        return result
+
+    def _mark_covered(self, stock_id, start, checked_tail, now):
+        coverage = db.session.get(PriceBarCoverage, stock_id)
+        if coverage is None:
+            coverage = PriceBarCoverage(stock_id=stock_id, first_date=start)
+            db.session.add(coverage)
+        elif start < coverage.first_date:
+            coverage.first_date = start
+        if checked_tail:
+            coverage.checked_at = now
+
+    def ensure(self, stock_id, start, end, fetch):
+        """Дозагружает недостающие диапазоны [start, end] через fetch(from, till, sink), который передает
+        страницы свечей в sink по мере прихода (они сразу пишутся в БД). Если MOEX недоступен, в БД
+        остается то, что уже есть. Возвращает число загруженных свечей
+        """
+        now = datetime.now()
+        ranges = self.missing_ranges(stock_id, start, end, now)
+        if not ranges:
+            return 0
+        fetched = 0
+        try:
+            for range_start, range_end in ranges:
+                # Ошибка загрузки (исключение) - диапазон не считаем загруженным, попробуем в следующий раз
+                fetched += fetch(range_start, range_end, self._sink(stock_id)) or 0
+            self._mark_covered(stock_id, start, any(r[1] >= end for r in ranges), now)
+            db.session.commit()
+            logger.debug(f"История бумаги {stock_id}: дозагружено {fetched} свечей за {ranges}")
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Не удалось дозагрузить историю бумаги {stock_id}: {e}")
+        return fetched
+
+    def history(self, stock_id, start, end, fetch):
+        """Свечи за [start, end]: недостающие диапазоны дозагружаются (ensure), затем все читается из БД.
+        Если период включает сегодня, в конец добавляется свеча текущего дня (today_bar)
+        """
+        self.ensure(stock_id, start, end, fetch)
+        bars = self.load(stock_id, start, end)
+        if start <= date.today() <= end:
+            bar = self.today_bar(stock_id)
+            if bar is not None:
+                bars.append(bar)
+        return bars
+
+    @staticmethod
+    def stock_id(ticker):
+        """id бумаги в таблице Stock (None - бумаги нет)"""
+        return db.session.query(Stock.id).filter(Stock.ticker == ticker).scalar()
+
+
+# Глобальный экземпляр хранилища свечей
+price_bars = PriceBarStore()
@@ -0,0 +1,250 @@
+"""
+Снимок котировок в памяти процесса
+Один фоновый обновлятель (лидер планировщика) забирает рынок с MOEX и пишет цены в БД,
+а клиенты читают готовый снимок через /api/quotes без обращений к MOEX
+"""
+
+import os
+import threading
+import time
+import logging
+from datetime import datetime
+from database import db, Stock, StockQuote
+import bulk_upsert
+from stock_api import stock_api_service
+from shared_quotes import shared_quotes, TIERS
+from trading_calendar import trading_calendar
+
+logger = logging.getLogger(__name__)
+
+
+class QuoteSnapshot:
+    """Последние известные котировки всех бумаг: ticker -> {price, change_pct, turnover, volume}"""
+
+    def __init__(self):
+        self.quotes = {}
+        # Номер версии снимка: растет при каждой публикации новых данных
+        self.epoch = 0
+        # Когда снимок последний раз обновлялся с MOEX этим процессом (целиком и по уровням) и когда публиковался вообще
+        self.refreshed_at = 0
+        self.tiers_refreshed_at = {tier: 0 for tier in TIERS}
+        self.loaded_at = 0
+        self.updated_at = None
+        # Условие, на котором ждут читатели новых версий снимка
+        self.cond = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self.last_result = {}
+        # Минимальный возраст снимка, после которого нужно обновление с MOEX (дальше решает торговый календарь)
+        try:
+            self.max_age = max(10, int(os.environ.get('QUOTES_MAX_AGE', '120')))
+        except ValueError:
+            self.max_age = 120
+        # Как часто перечитывать цены из БД (их могут обновлять другие процессы)
+        self.db_reload_interval = 30
+        # Версия общей таблицы котировок, с которой снимок был последний раз сверен,
+        # и версия, которой соответствуют опубликованные цены (одинакова во всех воркерах)
+        self._shared_epoch = 0
+        self.shared_epoch = 0
+
+    @staticmethod
+    def _quote(price, change_pct=None, turnover=None, volume=None):
+        return {'price': price, 'change_pct': change_pct, 'turnover': turnover, 'volume': volume}
+
+    def _publish(self, quotes, shared_epoch=0):
+        """Публикует новую версию снимка и будит ожидающих читателей.
+        shared_epoch - версия общей таблицы котировок, не старше которой цены quotes
+        """
+        with self.cond:
+            self.loaded_at = time.time()
+            self.shared_epoch = shared_epoch
+            if quotes == self.quotes:
+                return
+            self.quotes = quotes
+            self.epoch += 1
+            self.updated_at = datetime.now().isoformat(timespec='seconds')
+            self.cond.notify_all()
+
+    def load_from_db(self):
+        """Собирает снимок из таблицы Stock (нужен контекст приложения)"""
+        # Версия читается до БД: цены в БД записываются раньше, чем растет версия общей таблицы
+        shared_epoch = shared_quotes.epoch()
+        rows = db.session.query(
+            Stock.ticker, StockQuote.price, StockQuote.change_pct, StockQuote.turnover, StockQuote.volume
+        ).join(StockQuote, StockQuote.stock_id == Stock.id).all()
+        self._publish({
+            ticker: self._quote(price, change_pct, turnover, volume)
+            for ticker, price, change_pct, turnover, volume in rows
+            if price
+        }, shared_epoch)
+
+    def refresh(self, tickers=None, tier=None):
+        """Забирает котировки с MOEX (всех бумаг или только tickers - бумаг уровня tier), сохраняет в БД
+        и публикует снимок. Если полное обновление уже идет в другом потоке, дожидается его и возвращает его результат.
+        """
+        if tickers is not None:
+            with self._refresh_lock:
+                return self._refresh(tickers, tier)
+        if not self._refresh_lock.acquire(blocking=False):
+            with self._refresh_lock:
+                return self.last_result
+        try:
+            self.last_result = self._refresh()
+            return self.last_result
+        finally:
+            self._refresh_lock.release()
+
+    def mark_fresh(self, tier):
+        """Отмечает уровень обновленным без запроса к MOEX (в уровне нет бумаг)"""
+        shared_quotes.write((), tiers=(tier,))
+        self.tiers_refreshed_at[tier] = time.time()
+
+    def _refresh(self, tickers=None, tier=None):
+        try:
+            start_time = time.time()
+            # Только нужные колонки, без ORM-объектов: справочные поля Stock не читаются и не пишутся
+            query = db.session.query(
+                Stock.id, Stock.ticker, Stock.instrument_type, Stock.face_value, StockQuote.stock_id.label('quote_id'),
+                StockQuote.price, StockQuote.change_pct, StockQuote.turnover, StockQuote.volume
+            ).outerjoin(StockQuote, StockQuote.stock_id == Stock.id)
+            if tickers is None:
+                stocks = query.all()
+            else:
+                stocks = query.filter(Stock.ticker.in_(list(tickers))).all() if tickers else []
+                # Частичное обновление дополняет снимок, поэтому он должен быть заполнен
+                if not self.quotes:
+                    self.load_from_db()
+            updated_count = 0
+            failed_count = 0
+            results = []
+            share_tickers = [s.ticker for s in stocks if (s.instrument_type or 'share') == 'share']
+            bond_tickers = [s.ticker for s in stocks if s.instrument_type == 'bond']
+            face_values_map = {s.ticker: s.face_value for s in stocks if s.instrument_type == 'bond'}
+            metrics = {}
+            if share_tickers:
+                # Метрики торгов для акций (включая цену): при полном обновлении - снимком площадок,
+                # при обновлении части бумаг - пачками по 20 тикеров (не скачивая площадки целиком)
+                if stock_api_service.snapshot_mode and tickers is None:
+                    m = stock_api_service.get_snapshot_trade_metrics(share_tickers)
+                else:
+                    m = stock_api_service.get_multiple_stock_trade_metrics(share_tickers, timeout=10)
+                if m:
+                    metrics.update(m)
+            if bond_tickers:
+                # Для облигаций только цена
+                if stock_api_service.snapshot_mode and tickers is None:
+                    bond_prices = stock_api_service.get_snapshot_bond_prices(bond_tickers, face_values_map=face_values_map)
+                else:
+                    bond_prices = stock_api_service.get_multiple_bond_prices(bond_tickers, face_values_map=face_values_map, timeout=10)
+                for t, p in bond_prices.items():
+                    metrics[t] = {'price': p}
+
+            # rows - итоговые котировки всех бумаг с ценой; changed - только строки, которые нужно записать в БД
+            rows = []
+            changed = []
+            now = datetime.now()
+            for stock in stocks:
+                current = {'price': stock.price, 'change_pct': stock.change_pct, 'turnover': stock.turnover, 'volume': stock.volume}
+                new = dict(current)
+                data = metrics.get(stock.ticker) or {}
+                if data.get('price'):
+                    new['price'] = data['price']
+                    # Дополнительные метрики для акций
+                    if (stock.instrument_type or 'share') == 'share':
+                        for name in ('turnover', 'volume', 'change_pct'):
+                            if name in data:
+                                new[name] = data.get(name)
+                    updated_count += 1
+                    results.append({'ticker': stock.ticker, 'old_price': stock.price, 'new_price': new['price'], 'status': 'updated', 'turnover': new['turnover'], 'volume': new['volume'], 'change_pct': new['change_pct']})
+                    if new != current:
+                        changed.append({'stock_id': stock.id, **new, 'updated_at': now})
+                else:
+                    failed_count += 1
+                    results.append({'ticker': stock.ticker, 'status': 'failed', 'error': 'No price received'})
+                if new['price']:
+                    rows.append((stock.id, stock.ticker, new['price'], new['change_pct'], new['turnover'], new['volume']))
+            # Один пакетный UPDATE узкой таблицы котировок только для изменившихся бумаг
+            changed_count = bulk_upsert.update_changed(
+                StockQuote, changed, key='stock_id', existing={s.id for s in stocks if s.quote_id is not None}
+            )
+            db.session.commit()
+            # Остальные воркеры увидят новые цены через общую таблицу котировок;
+            # свежими отмечаются только обновленные уровни
+            tiers = TIERS if tickers is None else ((tier,) if tier else ())
+            self._shared_epoch = shared_quotes.write(
+                ((stock_id, price, change_pct, turnover, volume)
+                 for stock_id, _, price, change_pct, turnover, volume in rows),
+                tiers=tiers,
+            ) or 0
+
+            quotes = {
+                ticker: self._quote(price, change_pct, turnover, volume)
+                for _, ticker, price, change_pct, turnover, volume in rows
+            }
+            if tickers is not None:
+                quotes = {**self.quotes, **quotes}
+            self._publish(quotes, self._shared_epoch)
+            now = time.time()
+            if tickers is None:
+                self.refreshed_at = now
+            for name in tiers:
+                self.tiers_refreshed_at[name] = now
+            logger.info(f"Снимок котировок обновлен: {updated_count} бумаг, изменилось {changed_count}, ошибок: {failed_count}, версия {self.epoch}")
+            return {
+                'success': True,
+                'updated_count': updated_count,
+                'changed_count': changed_count,
+                'failed_count': failed_count,
+                'total_count': len(stocks),
+                'results': results,
+                'execution_time': round(time.time() - start_time, 2),
+                'epoch': self.epoch,
+            }
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Ошибка обновления снимка котировок: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def is_stale(self):
+        """Какой-то уровень цен давно не обновлялся с MOEX (ни этим процессом, ни писателем общей таблицы).
+        Допустимый возраст зависит от фазы рынка (когда биржа закрыта, цены не меняются)
+        и от уровня: warm и cold обновляются реже hot (см. refresh_planner).
+        """
+        from refresh_planner import refresh_planner
+        max_age = max(self.max_age, trading_calendar.quote_max_age())
+        shared = shared_quotes.tiers_updated_at()
+        now = time.time()
+        return any(
+            now - max(self.tiers_refreshed_at[tier], shared[tier]) > refresh_planner.max_age(tier, max_age)
+            for tier in TIERS
+        )
+
+    def ensure_fresh(self):
+        """Вызывается читателями: подтягивает цены из БД (по таймеру или когда другой процесс
+        записал новую версию в общую таблицу котировок). С MOEX читатели ничего не запрашивают:
+        цены обновляет только лидер планировщика (см. scheduler и refresh_planner)
+        """
+        shared_epoch = shared_quotes.epoch()
+        if shared_epoch != self._shared_epoch or time.time() - self.loaded_at > self.db_reload_interval:
+            self._shared_epoch = shared_epoch
+            try:
+                self.load_from_db()
+            except Exception as e:
+                logger.warning(f"Не удалось перечитать котировки из БД: {e}")
+                db.session.rollback()
+
+    def get(self, tickers=None):
+        """Текущая версия снимка (целиком или по списку тикеров): epoch - версия в этом процессе,
+        shared_epoch - версия общей таблицы котировок, которой соответствуют цены
+        """
+        with self.cond:
+            quotes = self.quotes
+            epoch = self.epoch
+            shared_epoch = self.shared_epoch
+            updated_at = self.updated_at
+        if tickers:
+            quotes = {t: quotes[t] for t in tickers if t in quotes}
+        return {'epoch': epoch, 'shared_epoch': shared_epoch, 'updated_at': updated_at, 'quotes': quotes}
+
+
+# Глобальный экземпляр снимка котировок
+quote_snapshot = QuoteSnapshot()
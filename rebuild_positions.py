@@ -0,0 +1,35 @@
+"""
+Скрипт сверки и пересчета позиций счетов (таблица Position) по истории операций
+    python rebuild_positions.py          - только сверка, код выхода 1 при расхождениях
+    python rebuild_positions.py --fix    - пересчет позиций, если они расходятся
+"""
+
+import sys
+from datetime import datetime
+from app import create_app
+import position_ledger
+
+
+def rebuild_positions():
+    """Сверяет позиции с историей операций и при --fix пересчитывает их"""
+    app = create_app()
+
+    with app.app_context():
+        result = position_ledger.verify()
+        print(f"[{datetime.now()}] Проверено позиций: {result['checked']}, расхождений: {len(result['mismatches'])}")
+        for mismatch in result['mismatches'][:20]:
+            print(f"  счет {mismatch['account_id']}, бумага {mismatch['stock_id']}: "
+                  f"ожидалось {mismatch['expected']}, в таблице {mismatch['stored']}")
+        if result['success']:
+            return
+        if '--fix' not in sys.argv:
+            sys.exit(1)
+        rebuilt = position_ledger.rebuild()
+        if not rebuilt['success']:
+            print(f"[{datetime.now()}] Ошибка пересчета: {rebuilt['error']}")
+            sys.exit(1)
+        print(f"[{datetime.now()}] Позиции пересчитаны: {rebuilt['positions']}, открытых {rebuilt['open']}")
+
+
+if __name__ == "__main__":
+    rebuild_positions()
@@ -0,0 +1,214 @@
+"""
+Планировщик приоритетов обновления цен
+Бумаги делятся на уровни по интересу пользователей (позиции, оповещения, избранное, просмотры):
+hot обновляются каждый цикл, warm - раз в несколько циклов, cold - раз в полдня
+"""
+
+import os
+import threading
+import time
+import logging
+from datetime import date, timedelta
+from database import db, Stock, Transaction, Watchlist, Alert, StockView
+import bulk_upsert
+from quote_snapshot import quote_snapshot
+from shared_quotes import TIERS
+
+logger = logging.getLogger(__name__)
+
+# Веса источников интереса к бумаге
+SCORE_HOLDING = 10
+SCORE_ALERT = 8
+SCORE_WATCHLIST = 5
+SCORE_VIEW = 1
+# За сколько дней учитываются просмотры страниц
+VIEWS_WINDOW_DAYS = 7
+# Как часто воркер записывает накопленные в памяти просмотры в БД (секунды)
+VIEWS_FLUSH_INTERVAL = 60
+
+
+class RefreshPlanner:
+    """Распределяет бумаги по уровням и обновляет их с разной частотой"""
+
+    def __init__(self):
+        self.tiers = {tier: [] for tier in TIERS}
+        self.scores = {}
+        self._built_at = 0
+        self._lock = threading.Lock()
+        self.cycle = 0
+        # Как часто пересчитывать уровни (секунды)
+        self.rebuild_interval = 600
+        # warm обновляется раз в столько циклов, cold - раз в столько секунд
+        try:
+            self.warm_every = max(1, int(os.environ.get('REFRESH_WARM_EVERY', '5')))
+        except ValueError:
+            self.warm_every = 5
+        try:
+            self.cold_interval = max(60, int(os.environ.get('REFRESH_COLD_INTERVAL', '43200')))
+        except ValueError:
+            self.cold_interval = 43200
+        # Статистика по уровням: размер, время последнего обновления, длительность
+        self.stats = {tier: {'runs': 0, 'last_refreshed_at': None, 'last_duration_sec': None,
+                             'avg_duration_sec': None, 'last_updated_count': None,
+                             'last_changed_count': None} for tier in TIERS}
+        # Просмотры страниц, еще не записанные в БД: (stock_id, day) -> количество
+        self._views = {}
+        self._views_lock = threading.Lock()
+        self._views_flushed_at = time.time()
+
+    # ----- Учет просмотров -----
+
+    def record_view(self, stock_id):
+        """Засчитывает просмотр страницы бумаги в памяти процесса; в БД просмотры пишутся
+        пачкой раз в VIEWS_FLUSH_INTERVAL секунд, а не при каждом открытии страницы
+        """
+        if not stock_id:
+            return
+        key = (stock_id, date.today())
+        with self._views_lock:
+            self._views[key] = self._views.get(key, 0) + 1
+            due = time.time() - self._views_flushed_at >= VIEWS_FLUSH_INTERVAL
+        if due:
+            self.flush_views()
+
+    def flush_views(self):
+        """Записывает накопленные просмотры одной транзакцией (нужен контекст приложения).
+        Возвращает число записанных пар (бумага, день)
+        """
+        with self._views_lock:
+            views, self._views = self._views, {}
+            self._views_flushed_at = time.time()
+        if not views:
+            return 0
+        try:
+            # Строки дня создаются без конфликтов с другими воркерами, затем счетчики увеличиваются
+            bulk_upsert.insert_ignore(StockView, [
+                {'stock_id': stock_id, 'day': day, 'views': 0} for stock_id, day in views
+            ], ('stock_id', 'day'))
+            for (stock_id, day), count in views.items():
+                StockView.query.filter_by(stock_id=stock_id, day=day).update(
+                    {StockView.views: StockView.views + count}, synchronize_session=False
+                )
+            db.session.commit()
+            return len(views)
+        except Exception as e:
+            # Нет таблицы или БД недоступна - эти просмотры просто не засчитаются
+            db.session.rollback()
+            logger.debug(f"Не удалось записать просмотры бумаг: {e}")
+            return 0
+
+    # ----- Уровни -----
+
+    def _compute_scores(self):
+        """Оценка интереса к каждой бумаге по позициям, оповещениям, избранному и просмотрам"""
+        scores = {}
+
+        def add(rows, weight):
+            for stock_id, count in rows:
+                if stock_id is not None:
+                    scores[stock_id] = scores.get(stock_id, 0) + weight * (count or 1)
+
+        # Открытые позиции: сумма купленного минус проданное по всем счетам
+        qty = db.func.sum(db.case((Transaction.type == 'buy', Transaction.quantity), else_=-Transaction.quantity))
+        held = db.session.query(Transaction.stock_id).filter(
+            Transaction.type.in_(['buy', 'sell'])
+        ).group_by(Transaction.stock_id).having(qty > 0).all()
+        add(((r[0], 1) for r in held), SCORE_HOLDING)
+        add(db.session.query(Alert.stock_id, db.func.count()).filter(Alert.active == True).group_by(Alert.stock_id).all(), SCORE_ALERT)
+        add(db.session.query(Watchlist.stock_id, db.func.count()).group_by(Watchlist.stock_id).all(), SCORE_WATCHLIST)
+        since = date.today() - timedelta(days=VIEWS_WINDOW_DAYS)
+        add(db.session.query(StockView.stock_id, db.func.sum(StockView.views)).filter(StockView.day >= since).group_by(StockView.stock_id).all(), SCORE_VIEW)
+        return scores
+
+    def rebuild(self):
+        """Пересчитывает уровни (нужен контекст приложения).
+        hot - бумаги с интересом пользователей; warm - остальные акции; cold - остальные облигации
+        """
+        self.flush_views()
+        scores = self._compute_scores()
+        tiers = {tier: [] for tier in TIERS}
+        for stock_id, ticker, instrument_type in db.session.query(Stock.id, Stock.ticker, Stock.instrument_type).all():
+            if scores.get(stock_id, 0) > 0:
+                tiers['hot'].append((scores[stock_id], ticker))
+            elif (instrument_type or 'share') == 'share':
+                tiers['warm'].append(ticker)
+            else:
+                tiers['cold'].append(ticker)
+        # Самые востребованные бумаги - первыми
+        tiers['hot'] = [ticker for _, ticker in sorted(tiers['hot'], reverse=True)]
+        with self._lock:
+            self.tiers = tiers
+            self.scores = scores
+            self._built_at = time.time()
+        logger.info(f"Уровни обновления цен: hot {len(tiers['hot'])}, warm {len(tiers['warm'])}, cold {len(tiers['cold'])}")
+        return {tier: len(tickers) for tier, tickers in tiers.items()}
+
+    def max_age(self, tier, base):
+        """Допустимый возраст цен уровня, если для hot допустим возраст base (секунды)"""
+        if tier == 'warm':
+            return base * self.warm_every
+        if tier == 'cold':
+            return self.cold_interval + base
+        return base
+
+    def due_tiers(self, now=None):
+        """Уровни, которые нужно обновить в текущем цикле"""
+        now = now or time.time()
+        due = ['hot']
+        if self.cycle % self.warm_every == 0:
+            due.append('warm')
+        last_cold = self.stats['cold']['last_refreshed_at']
+        if last_cold is None or now - last_cold >= self.cold_interval:
+            due.append('cold')
+        return due
+
+    def run_cycle(self):
+        """Один цикл обновления цен: пересчет уровней по необходимости и обновление подошедших уровней"""
+        if time.time() - self._built_at > self.rebuild_interval:
+            self.rebuild()
+        result = {}
+        for tier in self.due_tiers():
+            tickers = self.tiers.get(tier) or []
+            if not tickers:
+                # Пустой уровень свежий - иначе читатели сочли бы снимок устаревшим
+                quote_snapshot.mark_fresh(tier)
+                continue
+            started = time.perf_counter()
+            outcome = quote_snapshot.refresh(tickers, tier)
+            elapsed = time.perf_counter() - started
+            stat = self.stats[tier]
+            stat['runs'] += 1
+            stat['last_refreshed_at'] = time.time()
+            stat['last_duration_sec'] = round(elapsed, 3)
+            # Скользящее среднее длительности обновления уровня
+            prev = stat['avg_duration_sec']
+            stat['avg_duration_sec'] = round(elapsed if prev is None else prev * 0.8 + elapsed * 0.2, 3)
+            stat['last_updated_count'] = outcome.get('updated_count')
+            stat['last_changed_count'] = outcome.get('changed_count')
+            result[tier] = {k: outcome.get(k) for k in ('success', 'updated_count', 'changed_count', 'failed_count', 'execution_time', 'error') if k in outcome}
+        self.cycle += 1
+        return result
+
+    def status(self):
+        """Размеры уровней и задержки их обновления (для админки)"""
+        now = time.time()
+        tiers = {}
+        for tier in TIERS:
+            stat = dict(self.stats[tier])
+            last = stat['last_refreshed_at']
+            stat['size'] = len(self.tiers.get(tier) or [])
+            stat['age_sec'] = round(now - last, 1) if last else None
+            stat['last_refreshed_at'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(last)) if last else None
+            tiers[tier] = stat
+        return {
+            'cycle': self.cycle,
+            'warm_every_cycles': self.warm_every,
+            'cold_interval_sec': self.cold_interval,
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._built_at)) if self._built_at else None,
+            'tiers': tiers,
+            'hot_top': (self.tiers.get('hot') or [])[:50],
+        }
+
+
+# Глобальный экземпляр планировщика приоритетов
+refresh_planner = RefreshPlanner()
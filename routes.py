@@ -1,14 +1,31 @@
-from flask import render_template, request, jsonify, redirect, url_for, session
-from database import db, User, Account, Stock, Transaction, Watchlist, Alert, CashFlow
-from utils import calculate_portfolio_stats, get_top_stocks, calculate_account_stats
+from flask import render_template, request, jsonify, redirect, url_for, session, current_app, Response, stream_with_context
+from database import db, User, Account, Stock, StockQuote, Transaction, Position, Watchlist, Alert, CashFlow
+from sqlalchemy.orm import contains_eager
+from utils import calculate_portfolio_stats, get_top_stocks, calculate_account_stats, portfolio_positions, portfolio_valuation
+import position_ledger
 import datetime
+import json
 import logging
 import requests
 import os
+import time
+import threading
 
 # Fixed alerts routing issue - all @app.route decorators are now inside init_routes()
 logger = logging.getLogger(__name__)
 
+# Окно свежести цены одной бумаги для /api/stock_price (секунды)
+STOCK_PRICE_TTL = int(os.getenv('STOCK_PRICE_TTL', '15'))
+# Потоки SSE: интервал keepalive и максимальная длительность одного соединения (секунды)
+SSE_KEEPALIVE = 15
+SSE_MAX_DURATION = int(os.getenv('SSE_MAX_DURATION', '120'))
+# Сколько потоков SSE одновременно держит один воркер: каждый занимает поток gthread,
+# остальные клиенты получают 503 и переходят на опрос /api/quotes
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', '4'))
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+# Telegram ID пользователей, которым доступны изменяющие состояние административные действия (через запятую)
+ADMIN_TELEGRAM_IDS = {t.strip() for t in os.getenv('ADMIN_TELEGRAM_IDS', '').split(',') if t.strip()}
+
 def send_telegram_message(telegram_id, message):
     """Отправка сообщения в Telegram"""
     try:
@@ -82,7 +99,7 @@ def init_routes(app):
             if result and result.get('success'):
                 return jsonify({
                     'status': 'success',
-                    'message': f'Синхронизация завершена. Добавлено: {result["added"]}, обновлено: {result["updated"]}, всего: {result["total"]} акций'
+                    'message': f'Синхронизация завершена. Добавлено: {result["added"]}, обновлено: {result["updated"]}, без изменений: {result["unchanged"]}, всего: {result["total"]} акций ({result["elapsed"]} с)'
                 })
             else:
                 error_msg = result.get('error', 'Неизвестная ошибка') if result else 'Не удалось получить результат'
@@ -1000,7 +1017,8 @@ def init_routes(app):
             except Exception:
                 pass
 
-        query = Stock.query
+        # Котировки - из узкой таблицы stock_quote: сортировка и фильтры по ним идут через один JOIN
+        query = Stock.query.outerjoin(Stock.quote).options(contains_eager(Stock.quote))
         # Автосинхронизация облигаций при первом заходе на вкладку Облигации
         try:
             if ins_type == 'bond':
@@ -1029,9 +1047,9 @@ def init_routes(app):
 
             # Сортировка
             if sort == 'price_desc':
-                query_filtered = query_filtered.order_by(Stock.price.desc())
+                query_filtered = query_filtered.order_by(StockQuote.price.desc().nulls_last())
             elif sort == 'price_asc':
-                query_filtered = query_filtered.order_by(Stock.price.asc())
+                query_filtered = query_filtered.order_by(StockQuote.price.asc().nulls_last())
             elif sort == 'name_asc':
                 query_filtered = query_filtered.order_by(Stock.name.asc())
             elif sort == 'name_desc':
@@ -1046,36 +1064,36 @@ def init_routes(app):
                 query_filtered = query_filtered.order_by(Stock.sector.desc().nulls_last()) if hasattr(Stock.sector, 'desc') else query_filtered.order_by(Stock.sector)
             elif sort == 'turnover_desc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.turnover != None).order_by(Stock.turnover.desc())
+                    query_filtered = query_filtered.filter(StockQuote.turnover != None).order_by(StockQuote.turnover.desc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.desc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.desc().nulls_last())
             elif sort == 'turnover_asc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.turnover != None).order_by(Stock.turnover.asc())
+                    query_filtered = query_filtered.filter(StockQuote.turnover != None).order_by(StockQuote.turnover.asc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.asc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.asc().nulls_last())
             elif sort == 'volume_desc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.volume != None).order_by(Stock.volume.desc())
+                    query_filtered = query_filtered.filter(StockQuote.volume != None).order_by(StockQuote.volume.desc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.desc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.desc().nulls_last())
             elif sort == 'volume_asc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.volume != None).order_by(Stock.volume.asc())
+                    query_filtered = query_filtered.filter(StockQuote.volume != None).order_by(StockQuote.volume.asc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.asc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.asc().nulls_last())
             elif sort == 'change_desc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.change_pct != None).order_by(Stock.change_pct.desc())
+                    query_filtered = query_filtered.filter(StockQuote.change_pct != None).order_by(StockQuote.change_pct.desc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.desc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.desc().nulls_last())
             elif sort == 'change_asc':
                 try:
-                    query_filtered = query_filtered.filter(Stock.change_pct != None).order_by(Stock.change_pct.asc())
+                    query_filtered = query_filtered.filter(StockQuote.change_pct != None).order_by(StockQuote.change_pct.asc())
                 except Exception:
-                    query_filtered = query_filtered.order_by(Stock.price.asc())
+                    query_filtered = query_filtered.order_by(StockQuote.price.asc().nulls_last())
             else:
-                query_filtered = query_filtered.order_by(Stock.price.desc())
+                query_filtered = query_filtered.order_by(StockQuote.price.desc().nulls_last())
 
             stocks = query_filtered.paginate(
                 page=page, per_page=50, error_out=False
@@ -1086,7 +1104,7 @@ def init_routes(app):
             except Exception:
                 pass
             # Без фильтра и с базовой сортировкой
-            base_q = query.order_by(Stock.price.desc()) if sort == 'price_desc' else query
+            base_q = query.order_by(StockQuote.price.desc().nulls_last()) if sort == 'price_desc' else query
             stocks = base_q.paginate(
                 page=page, per_page=50, error_out=False
             )
@@ -1100,8 +1118,8 @@ def init_routes(app):
         try:
             if ins_type == 'share':
                 # Берем больше, затем агрегируем и оставляем лучшие 12
-                raw_top = Stock.query.filter(Stock.turnover != None, Stock.turnover > 0)
-                raw_top = raw_top.order_by(Stock.turnover.desc()).limit(50).all()
+                raw_top = Stock.query.join(Stock.quote).options(contains_eager(Stock.quote)).filter(StockQuote.turnover != None, StockQuote.turnover > 0)
+                raw_top = raw_top.order_by(StockQuote.turnover.desc()).limit(50).all()
                 import re
                 def norm_company_key(st):
                     name = (getattr(st, 'name', None) or getattr(st, 'ticker', '') or '').lower()
@@ -1119,6 +1137,10 @@ def init_routes(app):
         except Exception:
             top_by_turnover = []
 
+        # Живые котировки из общей таблицы (без записи в БД)
+        from shared_quotes import shared_quotes
+        shared_quotes.apply_to(list(stocks.items) + list(top_by_turnover))
+
         return render_template('stocks.html', stocks=stocks, search=search, accounts=accounts, ins_type=ins_type, sort=sort, top_by_turnover=top_by_turnover)
 
     @app.route('/portfolio-analysis')
@@ -1138,109 +1160,18 @@ def init_routes(app):
         # Расчет общей статистики портфеля
         portfolio_stats = calculate_portfolio_stats(user_id)
         
-        # Анализ по секторам
-        sector_analysis = {}
-        total_portfolio_value = 0
-        
-        # Анализ позиций по инструментам
-        positions_analysis = []
-        
-        for account in accounts:
-            # Получаем все транзакции покупки/продажи
-            transactions = Transaction.query.filter_by(
-                account_id=account.id,
-                type='buy'
-            ).join(Stock).all()
-            
-            # Группируем по акциям
-            stock_positions = {}
-            for tx in transactions:
-                if tx.stock_id not in stock_positions:
-                    stock_positions[tx.stock_id] = {
-                        'stock': tx.stock,
-                        'quantity': 0,
-                        'total_cost': 0,
-                        'transactions': []
-                    }
-                
-                stock_positions[tx.stock_id]['quantity'] += tx.quantity or 0
-                stock_positions[tx.stock_id]['total_cost'] += (tx.quantity or 0) * (tx.price or 0)
-                stock_positions[tx.stock_id]['transactions'].append(tx)
-            
-            # Учитываем продажи
-            sell_transactions = Transaction.query.filter_by(
-                account_id=account.id,
-                type='sell'
-            ).join(Stock).all()
-            
-            for tx in sell_transactions:
-                if tx.stock_id in stock_positions:
-                    stock_positions[tx.stock_id]['quantity'] -= tx.quantity or 0
-                    stock_positions[tx.stock_id]['total_cost'] -= (tx.quantity or 0) * (tx.price or 0)
-            
-            # Анализируем каждую позицию
-            for stock_id, position in stock_positions.items():
-                if position['quantity'] > 0:
-                    stock = position['stock']
-                    current_price = stock.price or 0
-                    current_value = position['quantity'] * current_price
-                    avg_price = position['total_cost'] / position['quantity'] if position['quantity'] > 0 else 0
-                    profit_loss = current_value - position['total_cost']
-                    profit_loss_pct = (profit_loss / position['total_cost'] * 100) if position['total_cost'] > 0 else 0
-                    
-                    position_data = {
-                        'stock': stock,
-                        'quantity': position['quantity'],
-                        'avg_price': avg_price,
-                        'current_price': current_price,
-                        'current_value': current_value,
-                        'total_cost': position['total_cost'],
-                        'profit_loss': profit_loss,
-                        'profit_loss_pct': profit_loss_pct,
-                        'account': account
-                    }
-                    positions_analysis.append(position_data)
-                    
-                    # Анализ по секторам
-                    sector = stock.sector or 'Прочее'
-                    if sector not in sector_analysis:
-                        sector_analysis[sector] = {
-                            'value': 0,
-                            'cost': 0,
-                            'profit_loss': 0,
-                            'positions': []
-                        }
-                    
-                    sector_analysis[sector]['value'] += current_value
-                    sector_analysis[sector]['cost'] += position['total_cost']
-                    sector_analysis[sector]['profit_loss'] += profit_loss
-                    sector_analysis[sector]['positions'].append(position_data)
-                    
-                    total_portfolio_value += current_value
-        
-        # Расчет процентного распределения по секторам
-        for sector in sector_analysis:
-            if total_portfolio_value > 0:
-                sector_analysis[sector]['percentage'] = (sector_analysis[sector]['value'] / total_portfolio_value) * 100
-            else:
-                sector_analysis[sector]['percentage'] = 0
-        
-        # Сортируем позиции по убыванию стоимости
-        positions_analysis.sort(key=lambda x: x['current_value'], reverse=True)
+        # Позиции по счетам, сектора и типы инструментов - из того же расчета, что и статистика портфеля
+        valuation = portfolio_valuation(user_id, accounts)
+        positions_analysis, sector_analysis, instrument_analysis = valuation.analysis(
+            {account.id: account for account in accounts}
+        )
+        total_portfolio_value = valuation.total_value
         
-        # Топ и худшие позиции
+        # Топ и худшие позиции (positions_analysis - по убыванию стоимости)
         top_positions = positions_analysis[:5]
         worst_positions = sorted(positions_analysis, key=lambda x: x['profit_loss_pct'])[:5]
         best_positions = sorted(positions_analysis, key=lambda x: x['profit_loss_pct'], reverse=True)[:5]
         
-        # Анализ типов инструментов (акции vs облигации)
-        instrument_analysis = {'share': {'value': 0, 'count': 0}, 'bond': {'value': 0, 'count': 0}}
-        for pos in positions_analysis:
-            inst_type = getattr(pos['stock'], 'instrument_type', 'share') or 'share'
-            if inst_type in instrument_analysis:
-                instrument_analysis[inst_type]['value'] += pos['current_value']
-                instrument_analysis[inst_type]['count'] += 1
-        
         return render_template('portfolio_analysis.html',
                              user=user,
                              portfolio_stats=portfolio_stats,
@@ -1258,26 +1189,19 @@ def init_routes(app):
         stock = Stock.query.filter_by(ticker=ticker).first()
         if not stock:
             return redirect(url_for('stocks'))
+        # Просмотры поднимают приоритет обновления цены бумаги
+        from refresh_planner import refresh_planner
+        refresh_planner.record_view(stock.id)
 
         user_positions = None
         if 'user_id' in session:
-            # Собираем позиции пользователя по данной бумаге
-            txs = Transaction.query.join(Account).filter(
-                Account.user_id == session['user_id'],
-                Transaction.stock_id == stock.id,
-                Transaction.type.in_(['buy', 'sell'])
-            ).all()
+            # Позиции пользователя по данной бумаге на всех счетах
             qty = 0
             total_cost = 0.0
-            for t in txs:
-                q = (t.quantity or 0)
-                p = (t.price or 0.0)
-                if t.type == 'buy':
-                    qty += q
-                    total_cost += q * p
-                elif t.type == 'sell':
-                    qty -= q
-                    total_cost -= q * p
+            for open_position in portfolio_positions(session['user_id']):
+                if open_position['stock_id'] == stock.id:
+                    qty += open_position['quantity']
+                    total_cost += open_position['total_cost']
             if qty > 0:
                 avg_price = total_cost / qty if qty else 0
                 current_value = qty * (stock.price or 0.0)
@@ -1351,7 +1275,18 @@ def init_routes(app):
     app.add_url_rule('/api/create_account', view_func=create_account, methods=['POST'])
     app.add_url_rule('/api/stock_price/<ticker>', view_func=get_stock_price)
     app.add_url_rule('/api/update_all_prices', view_func=update_all_prices)
+    app.add_url_rule('/api/quotes', view_func=get_quotes)
+    app.add_url_rule('/api/stream/quotes', view_func=stream_quotes)
     app.add_url_rule('/admin/sync-bonds', view_func=sync_bonds)
+    app.add_url_rule('/admin/refresh-security-master', view_func=refresh_security_master)
+    app.add_url_rule('/admin/scheduler', view_func=admin_scheduler)
+    app.add_url_rule('/admin/refresh-tiers', view_func=admin_refresh_tiers)
+    app.add_url_rule('/admin/job-runs', view_func=admin_job_runs)
+    app.add_url_rule('/admin/history-backfill', view_func=admin_history_backfill)
+    app.add_url_rule('/admin/positions/verify', view_func=admin_verify_positions)
+    app.add_url_rule('/admin/positions/rebuild', view_func=admin_rebuild_positions, methods=['POST'])
+    app.add_url_rule('/admin/valuation-cache', view_func=admin_valuation_cache)
+    app.add_url_rule('/admin/valuation-cache/clear', view_func=admin_clear_valuation_cache, methods=['POST'])
     app.add_url_rule('/api/portfolio_history', view_func=get_portfolio_history)
     app.add_url_rule('/api/income_summary', view_func=get_income_summary)
     # Watchlist & Alerts
@@ -1402,6 +1337,7 @@ def deposit():
     account.balance += amount
     
     db.session.add(transaction)
+    position_ledger.touch(account.user_id)
     db.session.commit()
     
     return jsonify({'success': True, 'new_balance': account.balance})
@@ -1488,11 +1424,16 @@ def check_alerts():
     if 'user_id' not in session:
         return jsonify({'error': 'Не авторизован'}), 401
     import datetime as dt
+    from shared_quotes import shared_quotes
     alerts = Alert.query.filter_by(user_id=session['user_id'], active=True).all()
     triggered = []
     for a in alerts:
         st = Stock.query.get(a.stock_id)
-        if not st or st.price is None:
+        if not st:
+            continue
+        # Живая цена из общей таблицы котировок, без нее - из БД
+        shared_quotes.apply_to([st])
+        if st.price is None:
             continue
         hit = (a.direction == 'above' and st.price >= a.price) or (a.direction == 'below' and st.price <= a.price)
         if hit:
@@ -1621,6 +1562,7 @@ def withdraw():
     transaction = Transaction(type='withdrawal', amount=amount, account=account)
     account.balance -= amount
     db.session.add(transaction)
+    position_ledger.touch(account.user_id)
     db.session.commit()
     return jsonify({'success': True, 'new_balance': account.balance})
 
@@ -1644,6 +1586,8 @@ def buy_stock():
     transaction = Transaction(type='buy', amount=total_cost, price=stock.price, quantity=quantity, account=account, stock_id=stock.id)
     account.balance -= total_cost
     db.session.add(transaction)
+    position_ledger.apply(account.id, stock.id, 'buy', quantity, stock.price)
+    position_ledger.touch(account.user_id)
     db.session.commit()
     return jsonify({'success': True, 'new_balance': account.balance})
 
@@ -1673,8 +1617,11 @@ def add_historical_buy():
     except ValueError:
         return jsonify({'error': 'Неверный формат даты'}), 400
     total_cost = quantity * price
-    transaction = Transaction(type='buy', amount=total_cost, price=price, quantity=quantity, account=account, stock_id=stock.id, timestamp=purchase_datetime)
+    transaction = Transaction(type='buy', amount=total_cost, price=price, quantity=quantity, account=account, stock_id=stock.id, timestamp=purchase_datetime, cash_settled=False)
     db.session.add(transaction)
+    # Покупка могла предшествовать уже записанным продажам - позиция пересчитывается по времени операций
+    position_ledger.reapply(account.id, stock.id)
+    position_ledger.touch(account.user_id)
     db.session.commit()
     return jsonify({'success': True, 'message': 'Историческая покупка добавлена', 'total_cost': total_cost, 'transaction_id': transaction.id})
 
@@ -1692,17 +1639,17 @@ def sell_stock():
     stock = Stock.query.get(stock_id)
     if not account or not stock:
         return jsonify({'error': 'Счет или акция не найдены'}), 404
-    buy_transactions = Transaction.query.filter_by(account_id=account_id, stock_id=stock_id, type='buy').all()
-    sell_transactions = Transaction.query.filter_by(account_id=account_id, stock_id=stock_id, type='sell').all()
-    total_bought = sum(t.quantity for t in buy_transactions)
-    total_sold = sum(t.quantity for t in sell_transactions)
-    available_quantity = total_bought - total_sold
-    if available_quantity < quantity:
+    # Позиция блокируется до commit: параллельная продажа не пройдет проверку остатка дважды
+    position = position_ledger.lock(account.id, stock.id)
+    if position is None or position.quantity < quantity:
+        db.session.rollback()
         return jsonify({'error': 'Недостаточно акций для продажи'}), 400
     total_revenue = quantity * stock.price
     transaction = Transaction(type='sell', amount=total_revenue, price=stock.price, quantity=quantity, account=account, stock_id=stock.id)
     account.balance += total_revenue
     db.session.add(transaction)
+    position_ledger.apply(account.id, stock.id, 'sell', quantity, stock.price)
+    position_ledger.touch(account.user_id)
     db.session.commit()
     return jsonify({'success': True, 'new_balance': account.balance})
 
@@ -1718,8 +1665,8 @@ def get_stock_history_api(ticker):
     try:
         from stock_api import stock_api_service
         days = request.args.get('days', 7, type=int)
-        if days > 120:
-            days = 120
+        # История хранится локально и грузится с MOEX постранично, поэтому доступны многолетние периоды
+        days = min(max(days, 1), 3650)
         history = stock_api_service.get_stock_history(ticker, days)
         if history:
             return jsonify({'success': True, 'ticker': ticker, 'days': days, 'data': history})
@@ -1791,25 +1738,35 @@ def create_account():
     return jsonify({'success': True, 'account': {'id': new_account.id, 'name': new_account.name, 'balance': new_account.balance}})
 
 def get_stock_price(ticker):
-    """API для получения актуальной цены акции"""
+    """API для получения актуальной цены акции.
+    Одновременные запросы одной бумаги склеиваются в один запрос к MOEX, результат живет STOCK_PRICE_TTL секунд.
+    """
     try:
         from stock_api import stock_api_service
+        from single_flight import single_flight
         stock = Stock.query.filter_by(ticker=ticker).first()
-        current_price = None
-        if stock and getattr(stock, 'instrument_type', 'share') == 'bond':
-            current_price = stock_api_service._get_bond_price(ticker, getattr(stock, 'face_value', None))
-        else:
-            current_price = stock_api_service._get_stock_price(ticker)
-        if current_price and current_price > 0:
-            if stock:
-                stock.price = current_price
+        is_bond = bool(stock and getattr(stock, 'instrument_type', 'share') == 'bond')
+
+        def fetch():
+            if is_bond:
+                price = stock_api_service._get_bond_price(ticker, getattr(stock, 'face_value', None))
+            else:
+                price = stock_api_service._get_stock_price(ticker)
+            # В БД пишет только лидер и только изменившуюся цену
+            if price and price > 0 and stock and stock.price != price:
+                stock.price = price
                 db.session.commit()
+            return price
+
+        current_price = single_flight.do(('bond' if is_bond else 'share', ticker), fetch, ttl=STOCK_PRICE_TTL)
+        if current_price and current_price > 0:
             return jsonify({'success': True, 'ticker': ticker, 'price': current_price, 'source': 'moex_api'})
         if stock and stock.price:
             return jsonify({'success': True, 'ticker': ticker, 'price': stock.price, 'cached': True, 'source': 'database'})
         return jsonify({'success': False, 'error': 'Stock not found or no price available'}), 404
     except Exception as e:
         logger.error(f"Ошибка получения цены для {ticker}: {e}")
+        db.session.rollback()
         stock = Stock.query.filter_by(ticker=ticker).first()
         if stock and stock.price:
             return jsonify({'success': True, 'ticker': ticker, 'price': stock.price, 'cached': True, 'error': str(e), 'source': 'database_fallback'})
@@ -1819,7 +1776,6 @@ def update_all_prices():
     """API для быстрого обновления цен популярных акций"""
     try:
         from stock_api import stock_api_service
-        import time
         # Гарантируем корректные типы колонок в Postgres (volume: BIGINT, turnover: DOUBLE PRECISION)
         try:
             bind = db.session.get_bind() if hasattr(db.session, 'get_bind') else db.session.bind
@@ -1842,119 +1798,260 @@ def update_all_prices():
                 db.session.rollback()
             except Exception:
                 pass
-        stocks = Stock.query.all()
-        updated_count = 0
-        failed_count = 0
-        results = []
-        start_time = time.time()
-        share_tickers = [s.ticker for s in stocks if getattr(s, 'instrument_type', 'share') == 'share']
-        bond_tickers = [s.ticker for s in stocks if getattr(s, 'instrument_type', 'share') == 'bond']
-        face_values_map = {s.ticker: getattr(s, 'face_value', None) for s in stocks if getattr(s, 'instrument_type', 'share') == 'bond'}
-        metrics = {}
-        if share_tickers:
-            # Получаем метрики торгов для акций (включая цену)
-            m = stock_api_service.get_multiple_stock_trade_metrics(share_tickers, timeout=10)
-            if m:
-                metrics.update(m)
-        if bond_tickers:
-            # Для облигаций только цена
-            bond_prices = stock_api_service.get_multiple_bond_prices(bond_tickers, face_values_map=face_values_map, timeout=10)
-            for t, p in bond_prices.items():
-                metrics[t] = {'price': p}
-
-        for stock in stocks:
-            try:
-                if stock.ticker in metrics and metrics[stock.ticker].get('price'):
-                    new_price = metrics[stock.ticker]['price']
-                    old_price = stock.price
-                    stock.price = new_price
-                    # Дополнительные метрики для акций
-                    data = metrics.get(stock.ticker, {})
-                    if getattr(stock, 'instrument_type', 'share') == 'share':
-                        if 'turnover' in data:
-                            stock.turnover = data.get('turnover')
-                        if 'volume' in data:
-                            stock.volume = data.get('volume')
-                        if 'change_pct' in data:
-                            stock.change_pct = data.get('change_pct')
-                    updated_count += 1
-                    results.append({'ticker': stock.ticker, 'old_price': old_price, 'new_price': new_price, 'status': 'updated', 'turnover': stock.turnover, 'volume': stock.volume, 'change_pct': stock.change_pct})
-                    logger.info(f"Обновлена цена {stock.ticker}: {old_price} → {new_price}")
-                else:
-                    failed_count += 1
-                    results.append({'ticker': stock.ticker, 'status': 'failed', 'error': 'No price received'})
-                    logger.warning(f"Не удалось получить цену для {stock.ticker}")
-            except Exception as e:
-                failed_count += 1
-                results.append({'ticker': stock.ticker, 'status': 'error', 'error': str(e)})
-                logger.error(f"Ошибка обновления {stock.ticker}: {e}")
-        db.session.commit()
-        return jsonify({'success': True, 'message': f'Обновлено: {updated_count} акций, ошибок: {failed_count}, всего: {len(stocks)}', 'updated_count': updated_count, 'failed_count': failed_count, 'total_count': len(stocks), 'results': results[:10], 'execution_time': round(time.time() - start_time, 2)})
+        # Обновление выполняется один раз на все вкладки: параллельные вызовы ждут текущее
+        from quote_snapshot import quote_snapshot
+        result = quote_snapshot.refresh()
+        if not result.get('success'):
+            return jsonify({'success': False, 'error': result.get('error', 'Неизвестная ошибка')}), 500
+        return jsonify({'success': True, 'message': f"Обновлено: {result['updated_count']} акций, изменилось: {result['changed_count']}, ошибок: {result['failed_count']}, всего: {result['total_count']}", 'updated_count': result['updated_count'], 'changed_count': result['changed_count'], 'failed_count': result['failed_count'], 'total_count': result['total_count'], 'results': result['results'][:10], 'execution_time': result['execution_time'], 'epoch': result['epoch'], 'refresh_stats': stock_api_service.last_refresh_stats})
     except Exception as e:
         db.session.rollback()
         logger.error(f"Ошибка массового обновления цен: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def get_quotes():
+    """API: котировки из снимка в памяти (только чтение, без обращений к MOEX).
+    ?tickers=SBER,GAZP - ограничить список; ?since=<epoch> - вернуть пустой список, если снимок не менялся
+    """
+    try:
+        from quote_snapshot import quote_snapshot
+        quote_snapshot.ensure_fresh()
+        tickers = [t.strip().upper() for t in request.args.get('tickers', '').split(',') if t.strip()]
+        snapshot = quote_snapshot.get(tickers or None)
+        # Цены обновляет только лидер планировщика; stale - он давно их не обновлял
+        snapshot['stale'] = quote_snapshot.is_stale()
+        # Запросы клиента попадают в разные воркеры - версия берется из общей таблицы котировок,
+        # а не из снимка процесса (0 - таблица недоступна, сравнивать не с чем)
+        snapshot['epoch'] = snapshot.pop('shared_epoch')
+        since = request.args.get('since', type=int)
+        if since is not None and snapshot['epoch'] and since == snapshot['epoch']:
+            snapshot['quotes'] = {}
+            snapshot['not_modified'] = True
+        return jsonify({'success': True, **snapshot})
+    except Exception as e:
+        logger.error(f"Ошибка чтения снимка котировок: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def _stream_scope_tickers(scope):
+    """Тикеры для подписки SSE по области: watchlist или holdings текущего пользователя"""
+    if 'user_id' not in session:
+        return []
+    if scope == 'watchlist':
+        rows = db.session.query(Stock.ticker).join(Watchlist, Watchlist.stock_id == Stock.id).filter(
+            Watchlist.user_id == session['user_id']
+        ).all()
+        return [r[0] for r in rows]
+    if scope == 'holdings':
+        rows = db.session.query(Stock.ticker).join(Position, Position.stock_id == Stock.id).join(
+            Account, Position.account_id == Account.id
+        ).filter(
+            Account.user_id == session['user_id'],
+            Position.quantity > 0
+        ).distinct().all()
+        return [r[0] for r in rows]
+    return []
+
+def stream_quotes():
+    """SSE: поток котировок из снимка. При каждой новой версии снимка клиент получает
+    только изменившиеся цены выбранных бумаг (?tickers=SBER,GAZP или ?scope=watchlist|holdings; без параметров - все)
+    """
+    from quote_snapshot import quote_snapshot
+    tickers = [t.strip().upper() for t in request.args.get('tickers', '').split(',') if t.strip()]
+    scope = request.args.get('scope')
+    if scope:
+        tickers = sorted(set(tickers) | set(_stream_scope_tickers(scope)))
+        if not tickers:
+            return jsonify({'success': False, 'error': 'Нет бумаг для подписки'}), 404
+    if not _sse_slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'error': 'Слишком много потоков котировок, используйте /api/quotes'})
+        response.headers['Retry-After'] = str(SSE_MAX_DURATION)
+        return response, 503
+    # Соединение с БД не держим открытым на все время потока
+    db.session.remove()
+
+    def generate():
+        sent = {}
+        epoch = None
+        started = time.time()
+        yield 'retry: 5000\n\n'
+        while time.time() - started < SSE_MAX_DURATION:
+            try:
+                quote_snapshot.ensure_fresh()
+            finally:
+                db.session.remove()
+            with quote_snapshot.cond:
+                if quote_snapshot.epoch == epoch:
+                    quote_snapshot.cond.wait(timeout=SSE_KEEPALIVE)
+            snapshot = quote_snapshot.get(tickers or None)
+            if snapshot['epoch'] != epoch:
+                epoch = snapshot['epoch']
+                delta = {t: q for t, q in snapshot['quotes'].items() if sent.get(t) != q}
+                if delta:
+                    sent.update(delta)
+                    # Клиенту отдается версия общей таблицы - с ней он продолжит опрос /api/quotes?since=
+                    payload = json.dumps({'epoch': snapshot['shared_epoch'], 'updated_at': snapshot['updated_at'], 'quotes': delta})
+                    yield f"id: {epoch}\nevent: quotes\ndata: {payload}\n\n"
+                    continue
+            # Комментарий SSE не дает прокси закрыть простаивающее соединение
+            yield ': keepalive\n\n'
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # Слот освобождается, когда сервер закрывает ответ: по окончании потока или при обрыве соединения
+    response.call_on_close(_sse_slots.release)
+    return response
+
 def sync_bonds():
     """Синхронизация облигаций с MOEX API"""
     try:
         from stock_api import stock_api_service
         result = stock_api_service.sync_bonds_to_database()
         if result and result.get('success'):
-            return jsonify({'status': 'success', 'message': f"Синхронизация облигаций завершена. Добавлено: {result['added']}, обновлено: {result['updated']}, всего бумаг: {result['total']}"})
+            return jsonify({'status': 'success', 'message': f"Синхронизация облигаций завершена. Добавлено: {result['added']}, обновлено: {result['updated']}, без изменений: {result['unchanged']}, всего бумаг: {result['total']} ({result['elapsed']} с)"})
         else:
             error_msg = result.get('error', 'Неизвестная ошибка') if result else 'Не удалось получить результат'
             return jsonify({'status': 'error', 'message': f'Ошибка синхронизации облигаций: {error_msg}'}), 500
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Ошибка синхронизации облигаций: {str(e)}'}), 500
 
+def refresh_security_master():
+    """Полное обновление справочника бумаг MOEX (площадки, ISIN, переименования)"""
+    try:
+        from security_master import security_master
+        result = security_master.refresh()
+        if result and result.get('success'):
+            return jsonify({'status': 'success', 'message': f"Справочник бумаг обновлен. Добавлено: {result['added']}, обновлено: {result['updated']}, всего бумаг: {result['total']}"})
+        else:
+            error_msg = result.get('error', 'Неизвестная ошибка') if result else 'Не удалось получить результат'
+            return jsonify({'status': 'error', 'message': f'Ошибка обновления справочника: {error_msg}'}), 500
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка обновления справочника: {str(e)}'}), 500
+
+def admin_scheduler():
+    """Состояние планировщика: задачи по истории запусков (JobRun), общей для всех воркеров,
+    и лидерство ответившего воркера"""
+    try:
+        from scheduler import scheduler
+        return jsonify({'status': 'success', 'scheduler': scheduler.status()})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка получения состояния планировщика: {str(e)}'}), 500
+
+def admin_refresh_tiers():
+    """Уровни приоритета обновления цен: размеры и задержка обновления каждого уровня"""
+    try:
+        from refresh_planner import refresh_planner
+        from scheduler import scheduler
+        # В процессе, который не обновляет цены, уровни считаем по запросу (задержки видны только у лидера)
+        if not refresh_planner.cycle and request.args.get('rebuild', '1') != '0':
+            refresh_planner.rebuild()
+        return jsonify({'status': 'success', 'is_leader': scheduler.is_leader, 'planner': refresh_planner.status()})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка получения уровней обновления: {str(e)}'}), 500
+
+def admin_job_runs():
+    """История запусков фоновых задач (?job= - только одна задача, ?limit= - сколько последних запусков)"""
+    try:
+        from database import JobRun
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        query = JobRun.query
+        job = request.args.get('job')
+        if job:
+            query = query.filter_by(job=job)
+        runs = query.order_by(JobRun.started_at.desc()).limit(limit).all()
+        return jsonify({'status': 'success', 'runs': [{
+            'id': run.id,
+            'job': run.job,
+            'status': run.status,
+            'started_at': run.started_at.isoformat(timespec='seconds') if run.started_at else None,
+            'finished_at': run.finished_at.isoformat(timespec='seconds') if run.finished_at else None,
+            'duration_sec': run.duration_sec,
+            'rows': run.rows,
+            'upstream_calls': run.upstream_calls,
+            'error': run.error,
+            'pid': run.pid,
+        } for run in runs]})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка получения истории задач: {str(e)}'}), 500
+
+def admin_history_backfill():
+    """Загрузка дневной истории рынка по датам: контрольные точки и скорость (строк/с)"""
+    try:
+        from price_backfill import market_backfill
+        return jsonify({'status': 'success', 'default_start': market_backfill.default_start().isoformat(),
+                        'checkpoints': market_backfill.status()})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка получения состояния загрузки истории: {str(e)}'}), 500
+
+def admin_verify_positions():
+    """Сверка таблицы Position с историей операций (?account_id= - только один счет)"""
+    try:
+        account_id = request.args.get('account_id', type=int)
+        result = position_ledger.verify([account_id] if account_id else None)
+        return jsonify({'status': 'success', **result})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка сверки позиций: {str(e)}'}), 500
+
+def _is_admin():
+    """Текущий пользователь сессии - администратор (его Telegram ID в ADMIN_TELEGRAM_IDS)"""
+    if 'user_id' not in session:
+        return False
+    user = db.session.get(User, session['user_id'])
+    return bool(user and user.telegram_id in ADMIN_TELEGRAM_IDS)
+
+def admin_rebuild_positions():
+    """POST: пересчет таблицы Position по истории операций (account_id - только один счет).
+    Все позиции пересчитывает администратор, позиции своего счета - его владелец
+    """
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'Не авторизован'}), 401
+    account_id = request.values.get('account_id', type=int)
+    if not _is_admin():
+        owned = account_id and Account.query.filter_by(id=account_id, user_id=session['user_id']).first()
+        if not owned:
+            return jsonify({'status': 'error', 'message': 'Недостаточно прав'}), 403
+    result = position_ledger.rebuild([account_id] if account_id else None)
+    if result.get('success'):
+        return jsonify({'status': 'success', 'message': f"Позиции пересчитаны: {result['positions']}, открытых {result['open']}"})
+    return jsonify({'status': 'error', 'message': f"Ошибка пересчета позиций: {result.get('error')}"}), 500
+
+def admin_clear_valuation_cache():
+    """POST: сброс всех оценок портфелей (только администратор)"""
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'Не авторизован'}), 401
+    if not _is_admin():
+        return jsonify({'status': 'error', 'message': 'Недостаточно прав'}), 403
+    try:
+        from valuation_cache import valuation_cache
+        valuation_cache.clear()
+        return jsonify({'status': 'success', 'message': 'Оценки портфелей сброшены'})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка сброса кэша оценок: {str(e)}'}), 500
+
+def admin_valuation_cache():
+    """Кэш оценки портфелей: попадания в память и на диск, промахи, вытеснения - метрики только
+    ответившего воркера (worker), число оценок в общем каталоге - по всем воркерам (shared).
+    Сброс оценок - POST /admin/valuation-cache/clear"""
+    try:
+        from valuation_cache import valuation_cache
+        return jsonify({
+            'status': 'success',
+            'worker': valuation_cache.status(),
+            'shared': {'disk_files': valuation_cache.disk_files(), 'path': valuation_cache.directory()},
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Ошибка получения состояния кэша оценок: {str(e)}'}), 500
+
 def get_portfolio_history():
-    """API: История стоимости портфеля пользователя за N дней (по умолчанию 30),
-    оценивается на основе текущих позиций и дневной истории цен."""
+    """API: История портфеля пользователя за N дней (по умолчанию 30, до 10 лет) по торговым дням:
+    стоимость бумаг с учетом всех покупок и продаж на каждую дату, деньги на счетах и вложенный капитал."""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     try:
-        from stock_api import stock_api_service
-        days = request.args.get('days', 30, type=int)
-        if days > 120:
-            days = 120
-        # Считаем текущие позиции пользователя по всем счетам
-        txs = Transaction.query.join(Account).filter(
-            Account.user_id == session['user_id'],
-            Transaction.type.in_(['buy', 'sell'])
-        ).all()
-        qty_by_stock = {}
-        stock_map = {}
-        for t in txs:
-            sid = t.stock_id
-            if not sid:
-                continue
-            st = stock_map.get(sid) or Stock.query.get(sid)
-            stock_map[sid] = st
-            if not st:
-                continue
-            q = t.quantity or 0
-            if t.type == 'buy':
-                qty_by_stock[sid] = qty_by_stock.get(sid, 0) + q
-            elif t.type == 'sell':
-                qty_by_stock[sid] = qty_by_stock.get(sid, 0) - q
-        # Оставляем только положительные позиции
-        qty_by_stock = {sid: q for sid, q in qty_by_stock.items() if q > 0}
-        if not qty_by_stock:
-            return jsonify({'success': True, 'data': []})
-        # Собираем историю по каждому тикеру и агрегируем по датам
-        history_map = {}
-        for sid, qty in qty_by_stock.items():
-            st = stock_map[sid]
-            if not st:
-                continue
-            hist = stock_api_service.get_stock_history(st.ticker, days)
-            for item in hist:
-                d = item['date']
-                p = float(item['price'])
-                history_map[d] = history_map.get(d, 0.0) + qty * p
-        # Преобразуем в отсортированный список
-        items = sorted([{'date': d, 'value': round(v, 2)} for d, v in history_map.items()], key=lambda x: x['date'])
+        from portfolio_replay import portfolio_replay
+        days = min(max(request.args.get('days', 30, type=int), 1), 3650)
+        items = portfolio_replay.history(session['user_id'], datetime.date.today() - datetime.timedelta(days=days))
         return jsonify({'success': True, 'data': items})
     except Exception as e:
         logger.error(f"Ошибка истории портфеля: {e}")
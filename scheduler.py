@@ -1,88 +1,515 @@
 """
 Планировщик задач для автоматического обновления данных
+Под gunicorn запускается в каждом воркере, но задачи выполняет только лидер:
+процесс, захвативший advisory lock в Postgres (или файловую блокировку для SQLite).
+Каждый запуск задачи записывается в таблицу JobRun; новый лидер продолжает расписание с нее,
+а не запускает все задачи заново после перезапуска или деплоя
 """
 
+import json
+import os
+import tempfile
 import threading
 import time
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+import iss_decoder
 from stock_api import stock_api_service
+from security_master import security_master
+from quote_snapshot import quote_snapshot
+from trading_calendar import trading_calendar
+from refresh_planner import refresh_planner
+from price_backfill import market_backfill
+
+# fcntl есть только на Unix; без него блокировка работает только внутри процесса
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# Ключ advisory lock планировщика в Postgres (произвольная константа приложения)
+SCHEDULER_LOCK_KEY = 7301452
+# Сколько дней хранится история запусков задач
+JOB_RUN_HISTORY_DAYS = 30
+# Ключи результатов задач, в которых задачи сообщают число затронутых строк
+ROW_COUNT_KEYS = ('added', 'updated', 'changed_count', 'created', 'rows')
+
+
+class LeaderLock:
+    """Выбор лидера среди процессов: pg_try_advisory_lock в Postgres, flock на файл для SQLite"""
+
+    def __init__(self, app):
+        self.app = app
+        self._conn = None
+        self._fd = None
+        self.backend = None
+
+    def _is_postgres(self):
+        from database import db
+        with self.app.app_context():
+            return db.engine.dialect.name.startswith('postgres')
+
+    def acquire(self):
+        """Пытается стать лидером, не блокируясь. True - блокировка захвачена"""
+        try:
+            if self._is_postgres():
+                return self._acquire_pg()
+            return self._acquire_file()
+        except Exception as e:
+            logger.warning(f"Не удалось захватить блокировку планировщика: {e}")
+            self.release()
+            return False
+
+    def _acquire_pg(self):
+        from database import db
+        with self.app.app_context():
+            # Отдельное соединение держит блокировку, пока процесс жив. Autocommit - чтобы оно не висело
+            # "idle in transaction" (блокировка сессионная и транзакции не требует)
+            conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        got = conn.exec_driver_sql(f"SELECT pg_try_advisory_lock({SCHEDULER_LOCK_KEY})").scalar()
+        if not got:
+            conn.close()
+            return False
+        self._conn = conn
+        self.backend = 'postgres'
+        return True
+
+    def _acquire_file(self):
+        path = os.environ.get('SCHEDULER_LOCK_PATH', os.path.join(tempfile.gettempdir(), 'investbot_scheduler.lock'))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        self.backend = 'file'
+        return True
+
+    def is_held(self):
+        """Проверяет, что блокировка все еще у нас (соединение с Postgres могло оборваться)"""
+        if self._conn is not None:
+            try:
+                self._conn.exec_driver_sql("SELECT 1")
+                return True
+            except Exception:
+                logger.warning("Соединение с блокировкой планировщика потеряно")
+                self.release()
+                return False
+        return self._fd is not None
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.exec_driver_sql(f"SELECT pg_advisory_unlock({SCHEDULER_LOCK_KEY})")
+            except Exception:
+                pass
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+        if self._fd is not None:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+            except Exception:
+                pass
+            self._fd = None
+        self.backend = None
+
+
+class Job:
+    """Периодическая задача планировщика и статистика ее запусков.
+    adaptive=True - интервал берется из торгового календаря по текущей фазе рынка (interval - запасной);
+    run_on_phase_change=True - задача дополнительно запускается при смене фазы (например, чтобы забрать цены закрытия).
+    """
+
+    def __init__(self, name, interval, fn, adaptive=False, run_on_phase_change=False):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.adaptive = adaptive
+        self.run_on_phase_change = run_on_phase_change
+        self.last_phase = None
+        self.running = False
+        self.last_started = None
+        self.last_finished = None
+        self.last_duration = None
+        self.last_result = None
+        self.last_error = None
+        self.runs = 0
+        self.failures = 0
+        # Сколько раз задача подошла по расписанию, пока предыдущий запуск еще шел
+        self.overlaps = 0
+
+    def current_interval(self, phase):
+        """Интервал в текущей фазе рынка; None - задача сейчас простаивает"""
+        if not self.adaptive:
+            return self.interval
+        return trading_calendar.cadence(self.name, phase)
+
+    def is_due(self, now, phase):
+        if self.run_on_phase_change and self.last_phase is not None and phase != self.last_phase:
+            return True
+        interval = self.current_interval(phase)
+        if interval is None:
+            return False
+        return self.last_started is None or now - self.last_started >= interval
+
+    def status(self, phase=None):
+        return {
+            'name': self.name,
+            'interval_sec': self.current_interval(phase) if phase else self.interval,
+            'adaptive': self.adaptive,
+            'running': self.running,
+            'last_started': datetime.fromtimestamp(self.last_started).isoformat(timespec='seconds') if self.last_started else None,
+            'last_finished': datetime.fromtimestamp(self.last_finished).isoformat(timespec='seconds') if self.last_finished else None,
+            'last_duration_sec': round(self.last_duration, 2) if self.last_duration is not None else None,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+            'runs': self.runs,
+            'failures': self.failures,
+            'overlaps': self.overlaps,
+        }
+
+
+def _count_rows(result):
+    """Сколько строк затронула задача - сумма счетчиков из ее результата (включая вложенные)"""
+    if not isinstance(result, dict):
+        return None
+    total = 0
+    for key, value in result.items():
+        if isinstance(value, dict):
+            total += _count_rows(value) or 0
+        elif key in ROW_COUNT_KEYS and isinstance(value, int) and not isinstance(value, bool):
+            total += value
+    return total
+
+
+def _refresh_prices():
+    # Уровни hot/warm/cold обновляются с разной частотой (см. refresh_planner)
+    result = refresh_planner.run_cycle()
+    summary = ', '.join(f"{tier}: {r.get('updated_count')}, изменилось {r.get('changed_count')}" for tier, r in result.items())
+    logger.info(f"Цены обновлены ({summary or 'нечего обновлять'})")
+    return result
+
+
+def _sync_securities():
+    result = stock_api_service.sync_stocks_to_database() or {}
+    if result.get('success'):
+        logger.info(f"Синхронизация завершена: добавлено {result['added']}, обновлено {result['updated']}")
+    bonds_result = stock_api_service.sync_bonds_to_database() or {}
+    if bonds_result.get('success'):
+        logger.info(f"Синхронизация облигаций завершена: добавлено {bonds_result['added']}, обновлено {bonds_result['updated']}")
+    return {
+        'stocks': {k: result.get(k) for k in ('success', 'added', 'updated', 'unchanged', 'elapsed')},
+        'bonds': {k: bonds_result.get(k) for k in ('success', 'added', 'updated', 'unchanged', 'elapsed')},
+    }
+
+
+def _refresh_security_master():
+    result = security_master.refresh()
+    if result.get('success'):
+        logger.info(f"Справочник бумаг: добавлено {result['added']}, обновлено {result['updated']}")
+    return result
+
+
+def _refresh_trading_calendar():
+    return trading_calendar.refresh()
+
+
+def _backfill_history():
+    # Каждый запуск продолжает загрузку истории рынка с контрольной точки; когда история
+    # загружена, запуск дописывает только прошедшие торговые дни
+    return market_backfill.run()
+
+
+def _register_coupons():
+    created = stock_api_service.register_due_coupons()
+    logger.info(f"Создано записей CashFlow (coupon): {created}")
+    return {'created': created}
+
+
 class StockScheduler:
     """Планировщик для автоматического обновления акций"""
-    
+
     def __init__(self):
         self.running = False
         self.thread = None
-    
-    def start(self):
-        """Запуск планировщика"""
+        self.app = None
+        self.leader_lock = None
+        self.is_leader = False
+        self.leader_since = None
+        # Как часто процессы-последователи пробуют перехватить лидерство
+        self.election_interval = 30
+        # Цены и списки бумаг обновляются по фазам рынка: часто в основную сессию, реже
+        # в аукционы и дополнительные сессии, не обновляются, когда биржа закрыта
+        self.jobs = [
+            Job('prices', 300, _refresh_prices, adaptive=True, run_on_phase_change=True),
+            Job('sync_securities', 21600, _sync_securities, adaptive=True),
+            Job('trading_calendar', 86400, _refresh_trading_calendar),  # 24 часа
+            Job('security_master', 86400, _refresh_security_master),    # 24 часа
+            Job('coupons', 86400, _register_coupons),                   # 24 часа
+            Job('history_backfill', 3600, _backfill_history),           # 1 час
+        ]
+
+    def start(self, app):
+        """Запуск планировщика (в каждом процессе; задачи выполнит только лидер)"""
         if not self.running:
+            self.app = app
+            self.leader_lock = LeaderLock(app)
             self.running = True
-            self.thread = threading.Thread(target=self._run_scheduler, daemon=True)
+            self.thread = threading.Thread(target=self._run_scheduler, name='scheduler', daemon=True)
             self.thread.start()
-            logger.info("Планировщик запущен")
-    
+            logger.info(f"Планировщик запущен (pid {os.getpid()})")
+
     def stop(self):
         """Остановка планировщика"""
         self.running = False
         if self.thread:
             self.thread.join()
+        if self.leader_lock:
+            self.leader_lock.release()
+        self.is_leader = False
         logger.info("Планировщик остановлен")
-    
+
+    def _elect(self):
+        """Обновляет статус лидера: проверяет удержание блокировки или пытается ее захватить"""
+        if self.is_leader and not self.leader_lock.is_held():
+            self.is_leader = False
+            self.leader_since = None
+        if not self.is_leader and self.leader_lock.acquire():
+            self.is_leader = True
+            self.leader_since = time.time()
+            logger.info(f"Процесс {os.getpid()} стал лидером планировщика ({self.leader_lock.backend})")
+            self._restore_state()
+            self._build_positions()
+        return self.is_leader
+
+    def _build_positions(self):
+        """Заполняет позиции счетов по истории операций, если таблица position пуста (первый запуск после
+        деплоя). Выполняется только лидером, а не в каждом воркере при импорте приложения
+        """
+        import position_ledger
+        with self.app.app_context():
+            built = position_ledger.ensure_built()
+            if built:
+                logger.info(f"Позиции счетов пересчитаны по истории операций: {built}")
+
+    def _restore_state(self):
+        """Восстанавливает расписание из истории запусков: задачи, которые недавно отработали
+        в прошлом лидере, не запускаются повторно сразу после перезапуска.
+        Запуски, оборванные вместе с прошлым лидером, помечаются как abandoned и расписание не сдвигают.
+        """
+        from database import db, JobRun
+        with self.app.app_context():
+            try:
+                abandoned = JobRun.query.filter_by(status='running').update(
+                    {'status': 'abandoned', 'error': 'Процесс-лидер завершился во время выполнения'},
+                    synchronize_session=False
+                )
+                JobRun.query.filter(
+                    JobRun.started_at < datetime.now() - timedelta(days=JOB_RUN_HISTORY_DAYS)
+                ).delete(synchronize_session=False)
+                db.session.commit()
+                if abandoned:
+                    logger.warning(f"Оборванных запусков задач прошлого лидера: {abandoned}")
+                for job in self.jobs:
+                    last = JobRun.query.filter(
+                        JobRun.job == job.name, JobRun.status.in_(['success', 'error'])
+                    ).order_by(JobRun.started_at.desc()).first()
+                    if last is None:
+                        continue
+                    started = last.started_at.timestamp()
+                    if job.last_started is None or started > job.last_started:
+                        job.last_started = started
+                        job.last_finished = last.finished_at.timestamp() if last.finished_at else None
+                        job.last_duration = last.duration_sec
+                        job.last_error = last.error
+                        logger.info(f"Задача {job.name}: последний запуск {last.started_at.isoformat(timespec='seconds')} ({last.status})")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Не удалось восстановить расписание из истории запусков: {e}")
+
+    def _record_start(self, job, started):
+        """Создает запись JobRun о начале запуска, возвращает ее id (None - не удалось записать)"""
+        from database import db, JobRun
+        try:
+            run = JobRun(job=job.name, status='running', started_at=datetime.fromtimestamp(started), pid=os.getpid())
+            db.session.add(run)
+            db.session.commit()
+            return run.id
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Не удалось записать запуск задачи {job.name}: {e}")
+            return None
+
+    def _record_finish(self, run_id, job, upstream_calls):
+        """Дописывает в JobRun итог запуска: статус, длительность, строки, запросы к MOEX, ошибку"""
+        from database import db, JobRun
+        if run_id is None:
+            return
+        try:
+            # Задача могла оставить сессию в состоянии ошибки
+            db.session.rollback()
+            details = None
+            if job.last_result is not None:
+                details = json.dumps(job.last_result, ensure_ascii=False, default=str)[:4000]
+            JobRun.query.filter_by(id=run_id).update({
+                'status': 'error' if job.last_error else 'success',
+                'finished_at': datetime.fromtimestamp(job.last_finished),
+                'duration_sec': round(job.last_duration, 3),
+                'rows': None if job.last_error else _count_rows(job.last_result),
+                'upstream_calls': upstream_calls,
+                'error': job.last_error,
+                'details': details,
+            }, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Не удалось записать итог задачи {job.name}: {e}")
+
+    def _run_job(self, job):
+        """Выполняет задачу в контексте приложения и записывает статистику (в памяти и в JobRun).
+        Запросы к MOEX считаются по общему счетчику процесса, поэтому при параллельных задачах
+        в число попадут и запросы соседних задач
+        """
+        started = time.time()
+        calls_before = iss_decoder.upstream_calls.value
+        with self.app.app_context():
+            run_id = self._record_start(job, started)
+            try:
+                logger.info(f"Запуск задачи {job.name}...")
+                job.last_result = job.fn()
+                job.last_error = None
+            except Exception as e:
+                job.failures += 1
+                job.last_result = None
+                job.last_error = str(e)
+                logger.error(f"Ошибка задачи {job.name}: {e}")
+            finally:
+                job.last_finished = time.time()
+                job.last_duration = job.last_finished - started
+                job.runs += 1
+                self._record_finish(run_id, job, iss_decoder.upstream_calls.value - calls_before)
+                job.running = False
+
+    def _dispatch(self, now):
+        """Запускает подошедшие задачи, каждую в своем потоке; занятые задачи не дублируются"""
+        with self.app.app_context():
+            phase = trading_calendar.phase()
+        for job in self.jobs:
+            if not job.is_due(now, phase):
+                job.last_phase = phase
+                continue
+            if job.running:
+                job.overlaps += 1
+                logger.warning(f"Задача {job.name} еще выполняется с прошлого запуска, пропускаем")
+                # Следующая проверка - через интервал, а не на каждой итерации цикла. Фаза не запоминается:
+                # запуск по смене фазы состоится, когда задача освободится
+                job.last_started = now
+                continue
+            job.last_phase = phase
+            job.running = True
+            job.last_started = now
+            threading.Thread(target=self._run_job, args=(job,), name=f'job-{job.name}', daemon=True).start()
+
     def _run_scheduler(self):
         """Основной цикл планировщика"""
-        last_price_update = 0
-        last_sync_update = 0
-        last_coupon_register = 0
-        
+        last_election = 0
         while self.running:
             try:
                 current_time = time.time()
-                
-                # Обновляем цены каждые 5 минут
-                if current_time - last_price_update > 300:  # 5 минут
-                    logger.info("Запуск обновления цен...")
-                    try:
-                        stock_api_service.update_stock_prices()
-                        last_price_update = current_time
-                        logger.info("Цены обновлены успешно")
-                    except Exception as e:
-                        logger.error(f"Ошибка обновления цен: {e}")
-                
-                # Синхронизируем список акций каждые 6 часов
-                if current_time - last_sync_update > 21600:  # 6 часов
-                    logger.info("Запуск синхронизации акций и облигаций...")
-                    try:
-                        result = stock_api_service.sync_stocks_to_database()
-                        if result['success']:
-                            logger.info(f"Синхронизация завершена: добавлено {result['added']}, обновлено {result['updated']}")
-                        # Синхронизация облигаций
-                        bonds_result = stock_api_service.sync_bonds_to_database()
-                        if bonds_result and bonds_result.get('success'):
-                            logger.info(f"Синхронизация облигаций завершена: добавлено {bonds_result['added']}, обновлено {bonds_result['updated']}")
-                        last_sync_update = current_time
-                    except Exception as e:
-                        logger.error(f"Ошибка синхронизации бумаг: {e}")
-
-                # Регистрация купонных выплат раз в сутки
-                if current_time - last_coupon_register > 86400:  # 24 часа
-                    logger.info("Регистрируем купонные выплаты...")
-                    try:
-                        created = stock_api_service.register_due_coupons()
-                        logger.info(f"Создано записей CashFlow (coupon): {created}")
-                        last_coupon_register = current_time
-                    except Exception as e:
-                        logger.error(f"Ошибка регистрации купонов: {e}")
-                
+                if self.is_leader or current_time - last_election >= self.election_interval:
+                    last_election = current_time
+                    if self._elect():
+                        self._dispatch(current_time)
+
                 # Спим 30 секунд перед следующей проверкой
                 time.sleep(30)
-                
+
             except Exception as e:
                 logger.error(f"Ошибка в планировщике: {e}")
                 time.sleep(60)  # Спим минуту при ошибке
 
+    def _job_runs_status(self, phase):
+        """Состояние задач по таблице JobRun - одно и то же, какой бы воркер ни ответил (нужен контекст приложения).
+        Возвращает (pid процесса, последним запускавшего задачи, [состояние задач])
+        """
+        from database import db, JobRun
+        since = datetime.now() - timedelta(days=1)
+        counts = {}
+        for name, status, count in db.session.query(JobRun.job, JobRun.status, db.func.count()).filter(
+            JobRun.started_at >= since
+        ).group_by(JobRun.job, JobRun.status):
+            counts.setdefault(name, {})[status] = count
+        last_ids = [run_id for _, run_id in db.session.query(JobRun.job, db.func.max(JobRun.id)).group_by(JobRun.job)]
+        last_runs = {run.job: run for run in JobRun.query.filter(JobRun.id.in_(last_ids))} if last_ids else {}
+        jobs = []
+        for job in self.jobs:
+            last = last_runs.get(job.name)
+            job_counts = counts.get(job.name, {})
+            result = None
+            if last is not None and last.details:
+                try:
+                    result = json.loads(last.details)
+                except ValueError:
+                    result = last.details
+            jobs.append({
+                'name': job.name,
+                'interval_sec': job.current_interval(phase),
+                'adaptive': job.adaptive,
+                'running': last is not None and last.status == 'running',
+                'last_status': last.status if last else None,
+                'last_started': last.started_at.isoformat(timespec='seconds') if last else None,
+                'last_finished': last.finished_at.isoformat(timespec='seconds') if last and last.finished_at else None,
+                'last_duration_sec': round(last.duration_sec, 2) if last and last.duration_sec is not None else None,
+                'last_result': result,
+                'last_error': last.error if last else None,
+                'last_pid': last.pid if last else None,
+                'runs_24h': sum(job_counts.values()),
+                'failures_24h': job_counts.get('error', 0),
+                'abandoned_24h': job_counts.get('abandoned', 0),
+                # Наложения запусков считает только лидер в памяти
+                'overlaps': job.overlaps if self.is_leader else None,
+            })
+        latest = max(last_runs.values(), key=lambda run: run.id, default=None)
+        return (latest.pid if latest else None), jobs
+
+    def status(self):
+        """Состояние планировщика для /admin/scheduler: задачи - по истории запусков в JobRun (общей для всех
+        воркеров), лидерство и блокировка - этого процесса (worker)
+        """
+        phase = trading_calendar.phase()
+        result = {
+            'worker': {
+                'pid': os.getpid(),
+                'running': self.running,
+                'is_leader': self.is_leader,
+                'lock_backend': self.leader_lock.backend if self.leader_lock else None,
+                'leader_since': datetime.fromtimestamp(self.leader_since).isoformat(timespec='seconds') if self.leader_since else None,
+            },
+            'calendar': trading_calendar.status(),
+        }
+        try:
+            result['leader_pid'], result['jobs'] = self._job_runs_status(phase)
+            result['source'] = 'job_runs'
+        except Exception as e:
+            # Нет таблицы или БД недоступна - хотя бы то, что знает этот процесс
+            from database import db
+            db.session.rollback()
+            logger.warning(f"Не удалось прочитать историю запусков задач: {e}")
+            result['leader_pid'] = os.getpid() if self.is_leader else None
+            result['jobs'] = [job.status(phase) for job in self.jobs]
+            result['source'] = 'worker'
+        return result
+
 # Глобальный экземпляр планировщика
 scheduler = StockScheduler()
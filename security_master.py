@@ -0,0 +1,217 @@
+"""
+Справочник бумаг MOEX (security master)
+Раз в сутки целиком загружается с ISS в таблицу SecurityMaster, а поиск
+площадок и переименованных тикеров идет по словарю в памяти процесса
+"""
+
+import threading
+import time
+import logging
+import requests
+from flask import has_app_context
+import iss_decoder
+from iss_decoder import STR, INT
+from database import db, SecurityMaster
+
+logger = logging.getLogger(__name__)
+
+MOEX_BASE_URL = "https://iss.moex.com/iss"
+
+# Рынки, которые попадают в справочник
+MARKETS = ('shares', 'bonds')
+# Приоритет площадок при выборе основной
+BOARD_PRIORITY = ['TQBR', 'TQPI', 'TQTF', 'TQCB', 'TQOB', 'TQIR']
+# Переименования, известные заранее (дополняются данными MOEX о сменах тикеров)
+BUILTIN_ALIASES = {
+    # Яндекс: исторически YNDX, текущий SECID на MOEX – YDEX
+    'YNDX': 'YDEX',
+}
+LISTING_SCHEMA = {'SECID': STR, 'BOARDID': STR, 'ISIN': STR, 'LOTSIZE': INT}
+CHANGEOVER_SCHEMA = {'old_secid': STR, 'new_secid': STR}
+
+
+class SecurityMasterService:
+    """Справочник бумаг: SECID -> площадки, ISIN, лот; старый тикер -> актуальный SECID"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'InvestBot/1.0'})
+        iss_decoder.upstream_calls.attach(self.session)
+        self._by_secid = {}
+        self._aliases = dict(BUILTIN_ALIASES)
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        # Как часто перечитывать таблицу (ее может обновить другой процесс)
+        self.reload_interval = 3600
+
+    # ----- Чтение -----
+
+    def _ensure_loaded(self):
+        """Лениво загружает справочник из БД (нужен контекст приложения)"""
+        if self._by_secid and time.time() - self._loaded_at < self.reload_interval:
+            return
+        if not has_app_context():
+            return
+        with self._lock:
+            if self._by_secid and time.time() - self._loaded_at < self.reload_interval:
+                return
+            try:
+                self._load_from_db()
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить справочник бумаг из БД: {e}")
+                try:
+                    db.session.rollback()
+                except Exception:
+                    pass
+                # Не долбим БД на каждом запросе, если таблицы еще нет
+                self._loaded_at = time.time()
+
+    def _load_from_db(self):
+        """Строит словари поиска по таблице SecurityMaster"""
+        by_secid = {}
+        aliases = dict(BUILTIN_ALIASES)
+        for row in SecurityMaster.query.all():
+            entry = {
+                'secid': row.secid,
+                'market': row.market,
+                'primary_board': row.primary_board,
+                'boards': [b for b in (row.boards or '').split(',') if b],
+                'isin': row.isin,
+                'lot_size': row.lot_size,
+            }
+            by_secid[row.secid] = entry
+            for alias in (row.aliases or '').split(','):
+                if alias:
+                    aliases[alias] = row.secid
+        self._by_secid = by_secid
+        self._aliases = aliases
+        self._loaded_at = time.time()
+        logger.info(f"Справочник бумаг загружен: {len(by_secid)} бумаг, {len(aliases)} переименований")
+
+    def is_loaded(self):
+        """Есть ли в памяти непустой справочник"""
+        self._ensure_loaded()
+        return bool(self._by_secid)
+
+    def resolve(self, ticker):
+        """Актуальный SECID для тикера (учитывает переименования)"""
+        if not ticker:
+            return ticker
+        self._ensure_loaded()
+        key = ticker.upper()
+        return self._aliases.get(key, ticker)
+
+    def get(self, ticker):
+        """Запись справочника по тикеру или None"""
+        self._ensure_loaded()
+        return self._by_secid.get(self.resolve(ticker))
+
+    def boards(self, ticker):
+        """Площадки бумаги (основная первой). None - если справочник пуст и ответа у него нет"""
+        entry = self.get(ticker)
+        if entry:
+            return list(entry['boards'])
+        return [] if self._by_secid else None
+
+    # ----- Загрузка с MOEX -----
+
+    def _fetch_market(self, market):
+        """Все пары (SECID, BOARDID) рынка постранично"""
+        url = f"{MOEX_BASE_URL}/engines/stock/markets/{market}/securities.json"
+        rows = []
+        seen = set()
+        start = 0
+        while True:
+            params = {
+                'iss.meta': 'off',
+                'iss.only': 'securities',
+                'securities.columns': ','.join(LISTING_SCHEMA.keys()),
+                'start': start,
+            }
+            data = iss_decoder.get_json(self.session, url, params=params, timeout=30)
+            table = iss_decoder.decode_block(data.get('securities'), LISTING_SCHEMA)
+            if not len(table):
+                break
+            page = table.records()
+            new_keys = {(r['SECID'], r['BOARDID']) for r in page} - seen
+            if not new_keys:
+                break
+            seen |= new_keys
+            rows.extend(page)
+            start += len(table)
+        return rows
+
+    def _fetch_changeovers(self):
+        """Смены тикеров по данным MOEX: {старый SECID: новый SECID}"""
+        url = f"{MOEX_BASE_URL}/history/engines/stock/markets/shares/securities/changeover.json"
+        try:
+            data = iss_decoder.get_json(self.session, url, params={'iss.meta': 'off'}, timeout=15)
+            block = data.get('changeover') or {}
+            block = {'columns': [c.lower() for c in block.get('columns') or []], 'data': block.get('data') or []}
+            table = iss_decoder.decode_block(block, CHANGEOVER_SCHEMA)
+            return {old.upper(): new for old, new in zip(table['old_secid'], table['new_secid']) if old and new}
+        except Exception as e:
+            logger.warning(f"Не удалось получить смены тикеров с MOEX: {e}")
+            return {}
+
+    def refresh(self):
+        """Полностью обновляет справочник с MOEX и сохраняет его в БД"""
+        try:
+            started = time.perf_counter()
+            entries = {}
+            for market in MARKETS:
+                for row in self._fetch_market(market):
+                    secid, board = row['SECID'], row['BOARDID']
+                    if not secid:
+                        continue
+                    entry = entries.setdefault(secid, {
+                        'market': market, 'boards': [], 'isin': None, 'lot_size': None
+                    })
+                    if board and board not in entry['boards']:
+                        entry['boards'].append(board)
+                    entry['isin'] = entry['isin'] or row['ISIN']
+                    entry['lot_size'] = entry['lot_size'] or row['LOTSIZE']
+            if not entries:
+                logger.error("MOEX вернула пустой список бумаг, справочник не обновлен")
+                return {'success': False, 'error': 'no_data'}
+
+            aliases_by_secid = {}
+            changeovers = dict(BUILTIN_ALIASES)
+            changeovers.update(self._fetch_changeovers())
+            for old, new in changeovers.items():
+                if new in entries and old != new:
+                    aliases_by_secid.setdefault(new, []).append(old)
+
+            existing = {row.secid: row for row in SecurityMaster.query.all()}
+            added = updated = 0
+            for secid, entry in entries.items():
+                boards = sorted(entry['boards'], key=lambda b: BOARD_PRIORITY.index(b) if b in BOARD_PRIORITY else len(BOARD_PRIORITY))
+                values = {
+                    'market': entry['market'],
+                    'primary_board': boards[0] if boards else None,
+                    'boards': ','.join(boards)[:255],
+                    'isin': entry['isin'],
+                    'lot_size': entry['lot_size'],
+                    'aliases': ','.join(sorted(aliases_by_secid.get(secid, [])))[:255] or None,
+                }
+                row = existing.get(secid)
+                if row is None:
+                    db.session.add(SecurityMaster(secid=secid, **values))
+                    added += 1
+                elif any(getattr(row, k) != v for k, v in values.items()):
+                    for k, v in values.items():
+                        setattr(row, k, v)
+                    updated += 1
+            db.session.commit()
+            self._load_from_db()
+            elapsed = round(time.perf_counter() - started, 2)
+            logger.info(f"Справочник бумаг обновлен за {elapsed} с: добавлено {added}, изменено {updated}, всего {len(entries)}")
+            return {'success': True, 'added': added, 'updated': updated, 'total': len(entries), 'elapsed_sec': elapsed}
+        except Exception as e:
+            logger.error(f"Ошибка обновления справочника бумаг: {e}")
+            db.session.rollback()
+            return {'success': False, 'error': str(e)}
+
+
+# Глобальный экземпляр справочника
+security_master = SecurityMasterService()
@@ -0,0 +1,271 @@
+"""
+Общая для всех процессов таблица котировок в memory-mapped файле
+Фиксированная раскладка struct-of-arrays, индекс строки = Stock.id.
+Пишет один процесс (тот, что обновляет цены с MOEX), читают все воркеры без обращения к БД.
+Согласованность чтения обеспечивается seqlock-счетчиком в заголовке.
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import logging
+import numpy as np
+
+# fcntl есть только на Unix; без него файл не блокируется между писателями
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'IBQUOTE1'
+# Заголовок: magic, capacity, seq (seqlock), epoch, updated_at и время обновления каждого уровня цен
+HEADER = struct.Struct('<8sQQQd')
+HEADER_SIZE = 64
+# Уровни обновления цен (см. refresh_planner): их время хранится в заголовке сразу после updated_at
+TIERS = ('hot', 'warm', 'cold')
+TIERS_OFFSET = HEADER.size
+# Колонки таблицы в порядке размещения в файле
+FIELDS = (
+    ('price', 'f8'),
+    ('change_pct', 'f8'),
+    ('turnover', 'f8'),
+    ('volume', 'f8'),
+    ('updated_at', 'f8'),
+    ('epoch', 'u8'),
+)
+# Сколько раз читатель повторяет чтение, если попал на запись
+READ_RETRIES = 100
+
+
+class SharedQuoteTable:
+    """Котировки в разделяемой памяти: price, change_pct, turnover, volume, updated_at, epoch по Stock.id"""
+
+    def __init__(self, path=None, capacity=None):
+        self.path = path or os.environ.get(
+            'SHARED_QUOTES_PATH', os.path.join(tempfile.gettempdir(), 'investbot_quotes.bin')
+        )
+        try:
+            self.capacity = int(capacity or os.environ.get('SHARED_QUOTES_CAPACITY', '16384'))
+        except ValueError:
+            self.capacity = 16384
+        self._mm = None
+        self._fd = None
+        self._columns = {}
+        self._open_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.available = True
+
+    @property
+    def size(self):
+        return HEADER_SIZE + self.capacity * 8 * len(FIELDS)
+
+    def _create(self):
+        """Размечает новый файл рядом и атомарно подменяет им path, возвращает его дескриптор.
+        Процессы, которые отобразили прежний файл, продолжают работать с ним: размер
+        отображенного файла не меняется, поэтому их чтение не падает с SIGBUS
+        """
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, HEADER.pack(MAGIC, self.capacity, 0, 0, 0.0), 0)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def _open_file(self):
+        """Дескриптор файла с раскладкой этого экземпляра (при необходимости файл создается заново)"""
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            keep = False
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # Пока ждали блокировку, другой процесс мог подменить файл - открываем новый
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                header = os.pread(fd, HEADER.size, 0)
+                valid = (
+                    len(header) == HEADER.size
+                    and HEADER.unpack(header)[:2] == (MAGIC, self.capacity)
+                    and os.fstat(fd).st_size == self.size
+                )
+                if valid:
+                    keep = True
+                    return fd
+                # Новый файл или другая раскладка: размечаем заново в новом файле
+                return self._create()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                if not keep:
+                    os.close(fd)
+
+    def _open(self):
+        """Открывает (или создает) файл и отображает его в память. False - таблица недоступна"""
+        if self._mm is not None:
+            return True
+        if not self.available:
+            return False
+        with self._open_lock:
+            if self._mm is not None:
+                return True
+            try:
+                fd = self._open_file()
+                mm = mmap.mmap(fd, self.size)
+                offset = HEADER_SIZE
+                columns = {}
+                for name, dtype in FIELDS:
+                    columns[name] = np.frombuffer(mm, dtype=dtype, count=self.capacity, offset=offset)
+                    offset += self.capacity * 8
+                self._fd = fd
+                self._columns = columns
+                self._mm = mm
+                return True
+            except Exception as e:
+                logger.warning(f"Общая таблица котировок недоступна ({self.path}): {e}")
+                self.available = False
+                return False
+
+    def _header(self):
+        return HEADER.unpack_from(self._mm, 0)
+
+    def _set_seq(self, seq):
+        struct.pack_into('<Q', self._mm, 16, seq)
+
+    # ----- Запись (один писатель) -----
+
+    def write(self, rows, tiers=TIERS):
+        """Записывает котировки: rows - итерируемое (stock_id, price, change_pct, turnover, volume).
+        tiers - уровни, бумаги которых обновлены этой записью (по умолчанию все - полное обновление).
+        Возвращает новый epoch таблицы или None, если таблица недоступна; без строк epoch не меняется.
+        """
+        if not self._open():
+            return None
+        rows = [r for r in rows if r[0] is not None and 0 <= r[0] < self.capacity]
+        with self._write_lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                _, _, seq, epoch, _ = self._header()
+                now = time.time()
+                for tier in tiers:
+                    struct.pack_into('<d', self._mm, TIERS_OFFSET + 8 * TIERS.index(tier), now)
+                if not rows:
+                    return epoch
+                epoch += 1
+                # Нечетный seq - идет запись, читатели повторят чтение
+                self._set_seq(seq + 1)
+                ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+                for i, name in enumerate(('price', 'change_pct', 'turnover', 'volume'), start=1):
+                    self._columns[name][ids] = np.array(
+                        [np.nan if r[i] is None else r[i] for r in rows], dtype='f8'
+                    )
+                self._columns['updated_at'][ids] = now
+                self._columns['epoch'][ids] = epoch
+                struct.pack_into('<QQd', self._mm, 16, seq + 2, epoch, now)
+                return epoch
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # ----- Чтение -----
+
+    def _read_consistent(self, fn):
+        """Выполняет fn() между двумя чтениями seq; повторяет, если попали на запись"""
+        for _ in range(READ_RETRIES):
+            seq = self._header()[2]
+            if seq % 2:
+                time.sleep(0)
+                continue
+            result = fn()
+            if self._header()[2] == seq:
+                return result
+        return fn()
+
+    def epoch(self):
+        """Номер последней записи (0 - таблица еще не заполнялась)"""
+        if not self._open():
+            return 0
+        return self._header()[3]
+
+    def updated_at(self):
+        """Время последней записи (unix time, 0 - не заполнялась)"""
+        if not self._open():
+            return 0
+        return self._header()[4]
+
+    def tiers_updated_at(self):
+        """Время последнего обновления каждого уровня: {tier: unix time}, 0 - уровень не обновлялся"""
+        if not self._open():
+            return {tier: 0 for tier in TIERS}
+        stamps = struct.unpack_from(f'<{len(TIERS)}d', self._mm, TIERS_OFFSET)
+        return dict(zip(TIERS, stamps))
+
+    def get(self, stock_id):
+        """Котировка бумаги {price, change_pct, turnover, volume, updated_at} или None"""
+        if stock_id is None or not self._open() or not 0 <= stock_id < self.capacity:
+            return None
+        cols = self._columns
+
+        def read():
+            if not cols['epoch'][stock_id]:
+                return None
+            return {name: cols[name][stock_id].item() for name, _ in FIELDS[:5]}
+
+        quote = self._read_consistent(read)
+        if quote is None:
+            return None
+        return {k: (None if v != v else v) for k, v in quote.items()}
+
+    def price(self, stock_id, default=None):
+        """Текущая цена бумаги или default, если в таблице ее нет"""
+        quote = self.get(stock_id)
+        if quote and quote['price']:
+            return quote['price']
+        return default
+
+    def prices(self, stock_ids):
+        """Цены нескольких бумаг одним согласованным чтением: {stock_id: price}"""
+        if not self._open():
+            return {}
+        ids = np.array([i for i in stock_ids if i is not None and 0 <= i < self.capacity], dtype=np.int64)
+        if not len(ids):
+            return {}
+        cols = self._columns
+
+        def read():
+            return cols['price'][ids].copy(), cols['epoch'][ids].copy()
+
+        values, epochs = self._read_consistent(read)
+        return {int(i): float(p) for i, p, e in zip(ids, values, epochs) if e and p == p and p > 0}
+
+    def apply_to(self, stocks):
+        """Подставляет живые котировки в загруженные объекты Stock, не помечая их измененными
+        (в БД при commit ничего не уйдет)
+        """
+        from sqlalchemy.orm.attributes import set_committed_value
+        for stock in stocks:
+            # Котировки Stock хранятся в связанной строке StockQuote; без нее подставлять некуда
+            row = getattr(stock, 'quote', None)
+            quote = self.get(getattr(stock, 'id', None)) if row is not None else None
+            if not quote or not quote['price']:
+                continue
+            set_committed_value(row, 'price', quote['price'])
+            for name in ('change_pct', 'turnover'):
+                if quote[name] is not None:
+                    set_committed_value(row, name, quote[name])
+            if quote['volume'] is not None:
+                set_committed_value(row, 'volume', int(quote['volume']))
+        return stocks
+
+
+# Глобальный экземпляр общей таблицы котировок
+shared_quotes = SharedQuoteTable()
@@ -0,0 +1,80 @@
+"""
+Склейка одинаковых запросов (single-flight)
+Параллельные и почти одновременные запросы с одним ключом выполняются один раз:
+первый запрос (лидер) идет к источнику, остальные ждут и получают его результат
+"""
+
+import threading
+import time
+
+
+class _Call:
+    """Выполняющийся запрос, результата которого ждут ведомые"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Группа запросов с общим результатом на ключ и коротким окном свежести"""
+
+    def __init__(self, max_cached=2048):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Результаты в окне свежести: ключ -> (момент устаревания, значение)
+        self._results = {}
+        self.max_cached = max_cached
+
+    def do(self, key, fn, ttl=0):
+        """Возвращает результат fn() для ключа key.
+        Пока запрос лидера выполняется, остальные ждут его; еще ttl секунд после завершения
+        результат отдается из памяти. Исключение лидера получают все ожидающие, но не кэшируется.
+        """
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and ttl > 0:
+                    self._store(key, call.value, ttl)
+            call.done.set()
+        return call.value
+
+    def _store(self, key, value, ttl):
+        """Сохраняет результат, вычищая устаревшие записи при переполнении"""
+        now = time.time()
+        if len(self._results) >= self.max_cached:
+            self._results = {k: v for k, v in self._results.items() if v[0] > now}
+            if len(self._results) >= self.max_cached:
+                self._results.clear()
+        self._results[key] = (now + ttl, value)
+
+    def forget(self, key):
+        """Сбрасывает закэшированный результат ключа"""
+        with self._lock:
+            self._results.pop(key, None)
+
+
+# Глобальная группа для запросов цен отдельных бумаг
+single_flight = SingleFlight()
@@ -3,23 +3,221 @@
 Использует API MOEX (Московская биржа) и другие источники
 """
 
+import os
+import time
+import threading
 import requests
 import json
-from datetime import datetime, timedelta
-from database import Stock, db, Account, Transaction, CashFlow
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from datetime import datetime, date, timedelta
+from flask import has_app_context
+from database import Stock, StockQuote, db, Position, CashFlow
 import logging
+import numpy as np
+import iss_decoder
+import bulk_upsert
+from iss_decoder import FLOAT, INT, STR
+from security_master import security_master
+from price_bars import price_bars
+from history_fetcher import history_fetcher
+from candle_cache import candle_cache
+from trading_calendar import trading_calendar
 
 logger = logging.getLogger(__name__)
 
+# Площадки, которые опрашиваются при массовом обновлении (в порядке приоритета)
+SHARE_BOARDS = ['TQBR', 'TQPI', 'TQTF']
+BOND_BOARDS = ['TQCB', 'TQOB', 'TQIR']
+# Схемы декодирования блоков ISS (поле -> правило приведения)
+BOND_LISTING_SCHEMA = {
+    'SECID': STR, 'SHORTNAME': STR, 'FACEVALUE': FLOAT, 'PREVPRICE': FLOAT,
+    'COUPONVALUE': FLOAT, 'COUPONPERCENT': FLOAT, 'COUPONPERIOD': INT, 'ACCRUEDINT': FLOAT,
+    'NEXTCOUPON': STR, 'MATDATE': STR, 'LOTSIZE': INT, 'CURRENCYID': STR, 'ISIN': STR,
+}
+TRADE_METRICS_SCHEMA = {
+    'SECID': STR, 'LAST': FLOAT, 'CLOSE': FLOAT, 'OPEN': FLOAT,
+    'VALTODAY': FLOAT, 'VALTODAY_RUR': FLOAT, 'VOLTODAY': INT,
+    'LASTCHANGEPRC': FLOAT, 'LASTTOPREVPRICE': FLOAT,
+}
+BOND_MARKETDATA_SCHEMA = {'SECID': STR, 'LAST': FLOAT, 'CLOSE': FLOAT, 'OPEN': FLOAT}
+# Приоритет полей цены в ответах по одной бумаге
+MARKETDATA_PRICE_FIELDS = ('LAST', 'LCURRENTPRICE', 'CLOSE', 'OPEN', 'WAPRICE', 'MARKETPRICE2')
+SECURITIES_PRICE_FIELDS = (
+    'PREVPRICE', 'LAST', 'MARKETPRICE', 'LCURRENTPRICE', 'MARKETPRICE2', 'CLOSE', 'OPEN', 'PREVADMITTEDQUOTE'
+)
+CANDLES_SCHEMA = {'begin': STR, 'close': FLOAT}
+# MOEX отдает свечи страницами не больше чем по 500 строк
+CANDLES_PAGE_SIZE = 500
+# Сколько секунд после первой цены ждать ответов более приоритетных площадок
+BOARD_PRICE_WINDOW = 0.3
+
+# Урезанный набор колонок marketdata для снимка целой площадки
+SNAPSHOT_COLUMNS = {
+    'shares': 'SECID,LAST,CLOSE,OPEN,VALTODAY,VALTODAY_RUR,VOLTODAY,LASTCHANGEPRC,LASTTOPREVPRICE',
+    'bonds': 'SECID,LAST,CLOSE,OPEN',
+}
+
 class StockAPIService:
     """Сервис для работы с API акций"""
     
     def __init__(self):
         self.moex_base_url = "https://iss.moex.com/iss"
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'InvestBot/1.0'
-        })
+        # Лимит параллельных запросов к MOEX при массовом обновлении
+        try:
+            self.max_workers = max(1, int(os.environ.get('MOEX_MAX_WORKERS', '8')))
+        except ValueError:
+            self.max_workers = 8
+        # MOEX стабильно отвечает на запросы до 20 тикеров
+        self.batch_size = 20
+        self._local = threading.local()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Статистика последних массовых обновлений (по видам: shares/bonds)
+        self.last_refresh_stats = {}
+        # Режим снимка: marketdata целой площадки одним запросом вместо пачек по 20 тикеров
+        self.snapshot_mode = os.environ.get('MOEX_SNAPSHOT_MODE', '1').lower() not in ('0', 'false', 'no', 'off')
+        # Снимок живет недолго, чтобы параллельные обновления не качали площадку повторно
+        self.snapshot_ttl = 20
+        self._board_snapshots = {}
+        self._snapshot_lock = threading.Lock()
+        # Отдельный пул для параллельного опроса площадок по одной бумаге:
+        # _get_stock_price вызывается и из задач общего пула, общий пул здесь привел бы к взаимоблокировке
+        self._probe_executor = None
+        # Негативный кэш: SECID -> момент, до которого бумагу не ищем повторно
+        try:
+            self.negative_ttl = max(0, int(os.environ.get('MOEX_NEGATIVE_TTL', '900')))
+        except ValueError:
+            self.negative_ttl = 900
+        self._missing_tickers = {}
+        self._missing_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """HTTP-сессия текущего потока: у каждого воркера свой пул соединений"""
+        sess = getattr(self._local, 'session', None)
+        if sess is None:
+            sess = requests.Session()
+            sess.headers.update({
+                'User-Agent': 'InvestBot/1.0'
+            })
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            sess.mount('https://', adapter)
+            sess.mount('http://', adapter)
+            # Запросы к MOEX учитываются в статистике задач планировщика
+            iss_decoder.upstream_calls.attach(sess)
+            self._local.session = sess
+        return sess
+
+    def _get_executor(self):
+        """Общий пул потоков для параллельных запросов к MOEX (создается лениво)"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='moex'
+                    )
+        return self._executor
+
+    def _get_probe_executor(self):
+        """Пул потоков для опроса площадок по одной бумаге (создается лениво)"""
+        if self._probe_executor is None:
+            with self._executor_lock:
+                if self._probe_executor is None:
+                    self._probe_executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers * 2,
+                        thread_name_prefix='moex-probe'
+                    )
+        return self._probe_executor
+
+    def _is_known_missing(self, secid):
+        """Проверяет негативный кэш (бумагу недавно искали и не нашли ни на одной площадке)"""
+        with self._missing_lock:
+            expires = self._missing_tickers.get(secid)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._missing_tickers[secid]
+                return False
+            return True
+
+    def _remember_missing(self, secid):
+        """Запоминает бумагу, для которой нет цены ни на одной площадке"""
+        if self.negative_ttl <= 0:
+            return
+        with self._missing_lock:
+            self._missing_tickers[secid] = time.time() + self.negative_ttl
+
+    def _map_parallel(self, fn, items):
+        """Выполняет fn для каждого элемента в пуле потоков.
+        Результаты возвращаются в порядке items (детерминированно), ошибка задачи -> None.
+        """
+        items = list(items)
+        if not items:
+            return []
+        if len(items) == 1 or self.max_workers == 1:
+            results = []
+            for item in items:
+                try:
+                    results.append(fn(item))
+                except Exception as e:
+                    logger.warning(f"Ошибка задачи обновления: {e}")
+                    results.append(None)
+            return results
+        futures = [self._get_executor().submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.warning(f"Ошибка задачи обновления: {e}")
+                results.append(None)
+        return results
+
+    def _chunks(self, items, size=None):
+        """Разбивает список на части по size элементов"""
+        size = size or self.batch_size
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def _record_refresh_stats(self, kind, tickers_count, resolved_count, requests_count, started, mode='batch'):
+        """Сохраняет и логирует пропускную способность массового обновления"""
+        elapsed = time.perf_counter() - started
+        stats = {
+            'mode': mode,
+            'tickers': tickers_count,
+            'resolved': resolved_count,
+            'requests': requests_count,
+            'max_workers': self.max_workers,
+            'elapsed_sec': round(elapsed, 3),
+            'tickers_per_sec': round(tickers_count / elapsed, 1) if elapsed > 0 else None,
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self.last_refresh_stats[kind] = stats
+        logger.info(
+            f"Массовое обновление {kind} ({mode}): {resolved_count}/{tickers_count} тикеров, "
+            f"{requests_count} запросов, {stats['elapsed_sec']} с, {stats['tickers_per_sec']} тикеров/с "
+            f"(потоков: {self.max_workers})"
+        )
+        return stats
+
+    def _fetch_board_marketdata(self, market, board, secids, timeout=10):
+        """Запрашивает marketdata для списка SECID на площадке. Возвращает блок {columns, data} или None"""
+        try:
+            url = f"{self.moex_base_url}/engines/stock/markets/{market}/boards/{board}/securities.json"
+            params = {
+                'securities': ','.join(secids),
+                'iss.meta': 'off',
+                'iss.only': 'marketdata',
+            }
+            data = iss_decoder.get_json(self.session, url, params=params, timeout=timeout)
+            block = data.get('marketdata') or {}
+            if block.get('data'):
+                return block
+            return None
+        except Exception as e:
+            logger.warning(f"Ошибка получения данных с площадки {board} ({market}): {e}")
+            return None
     
     def get_all_stocks(self):
         """Получает список всех акций с MOEX"""
@@ -97,13 +295,8 @@ class StockAPIService:
         try:
             # Облигации на рынке bonds, постранично с минимальными колонками + купонные поля
             base_url = f"{self.moex_base_url}/engines/stock/markets/bonds/securities.json"
-            cols = (
-                'SECID,SHORTNAME,FACEVALUE,PREVPRICE,'
-                'COUPONVALUE,COUPONPERCENT,COUPONPERIOD,ACCRUEDINT,'
-                'NEXTCOUPON,MATDATE,LOTSIZE,CURRENCYID,ISIN'
-            )
+            cols = ','.join(BOND_LISTING_SCHEMA.keys())
             start = 0
-            page_size = 500  # фактический размер определяется сервером; старт меняем по кол-ву строк
             bonds = []
             while True:
                 try:
@@ -113,104 +306,44 @@ class StockAPIService:
                         'securities.columns': cols,
                         'start': start,
                     }
-                    response = self.session.get(base_url, params=params, timeout=30)
-                    response.raise_for_status()
-                    data = response.json()
+                    data = iss_decoder.get_json(self.session, base_url, params=params, timeout=30)
                     if 'securities' not in data or 'data' not in data['securities']:
                         break
-                    rows = data['securities']['data'] or []
-                    columns = data['securities']['columns'] or []
-                    if not rows:
+                    table = iss_decoder.decode_block(data['securities'], BOND_LISTING_SCHEMA)
+                    if not len(table):
                         break
 
-                    # Индексы колонок
-                    idx = {name: (columns.index(name) if name in columns else None) for name in [
-                        'SECID','SHORTNAME','FACEVALUE','PREVPRICE','COUPONVALUE','COUPONPERCENT','COUPONPERIOD',
-                        'ACCRUEDINT','NEXTCOUPON','MATDATE','LOTSIZE','CURRENCYID','ISIN'
-                    ]}
+                    # Цена облигации: PREVPRICE обычно в % от номинала (считаем сразу для всей страницы)
+                    prevprice = table['PREVPRICE']
+                    face_value = table['FACEVALUE']
+                    price = np.where((prevprice > 0) & (face_value > 0), prevprice / 100.0 * face_value, 0.0)
+                    names = table['SHORTNAME'] if 'SHORTNAME' in table else table['SECID']
+                    page = table.records([name for name in BOND_LISTING_SCHEMA if name not in ('SECID', 'SHORTNAME', 'PREVPRICE')])
 
-                    for row in rows:
-                        try:
-                            ticker = row[idx['SECID']] if idx['SECID'] is not None else None
-                            name = row[idx['SHORTNAME']] if idx['SHORTNAME'] is not None else ticker
-                            face_value = None
-                            if idx['FACEVALUE'] is not None and row[idx['FACEVALUE']] not in (None, ''):
-                                try:
-                                    face_value = float(row[idx['FACEVALUE']])
-                                except Exception:
-                                    face_value = None
-                            prevprice = None
-                            if idx['PREVPRICE'] is not None and row[idx['PREVPRICE']] not in (None, ''):
-                                try:
-                                    prevprice = float(row[idx['PREVPRICE']])
-                                except Exception:
-                                    prevprice = None
-
-                            coupon_value = None
-                            if idx['COUPONVALUE'] is not None and row[idx['COUPONVALUE']] not in (None, ''):
-                                try:
-                                    coupon_value = float(row[idx['COUPONVALUE']])
-                                except Exception:
-                                    coupon_value = None
-                            coupon_percent = None
-                            if idx['COUPONPERCENT'] is not None and row[idx['COUPONPERCENT']] not in (None, ''):
-                                try:
-                                    coupon_percent = float(row[idx['COUPONPERCENT']])
-                                except Exception:
-                                    coupon_percent = None
-                            coupon_period = None
-                            if idx['COUPONPERIOD'] is not None and row[idx['COUPONPERIOD']] not in (None, ''):
-                                try:
-                                    coupon_period = int(row[idx['COUPONPERIOD']])
-                                except Exception:
-                                    coupon_period = None
-                            accrued_int = None
-                            if idx['ACCRUEDINT'] is not None and row[idx['ACCRUEDINT']] not in (None, ''):
-                                try:
-                                    accrued_int = float(row[idx['ACCRUEDINT']])
-                                except Exception:
-                                    accrued_int = None
-                            next_coupon = row[idx['NEXTCOUPON']] if idx['NEXTCOUPON'] is not None else None
-                            matdate = row[idx['MATDATE']] if idx['MATDATE'] is not None else None
-                            lot_size = None
-                            if idx['LOTSIZE'] is not None and row[idx['LOTSIZE']] not in (None, ''):
-                                try:
-                                    lot_size = int(row[idx['LOTSIZE']])
-                                except Exception:
-                                    lot_size = None
-                            currency = row[idx['CURRENCYID']] if idx['CURRENCYID'] is not None else None
-                            isin = row[idx['ISIN']] if idx['ISIN'] is not None else None
-
-                            # Цена облигации: PREVPRICE обычно в % от номинала
-                            price = 0.0
-                            if prevprice and face_value:
-                                price = (prevprice / 100.0) * face_value
-
-                            if ticker and name:
-                                bonds.append({
-                                    'ticker': ticker,
-                                    'name': name,
-                                    'price': price,
-                                    'sector': 'Облигации',
-                                    'description': f"Российская облигация {name}",
-                                    'logo_url': self._get_logo_url(ticker),
-                                    'instrument_type': 'bond',
-                                    'face_value': face_value,
-                                    'coupon_value': coupon_value,
-                                    'coupon_percent': coupon_percent,
-                                    'coupon_period': coupon_period,
-                                    'accrued_int': accrued_int,
-                                    'next_coupon_date': next_coupon,
-                                    'maturity_date': matdate,
-                                    'lot_size': lot_size,
-                                    'currency': currency,
-                                    'isin': isin,
-                                })
-                        except Exception as e:
-                            logger.warning(f"Ошибка обработки облигации: {e}")
+                    for ticker, name, bond_price, fields in zip(table['SECID'], names, price, page):
+                        if not (ticker and name):
                             continue
+                        bonds.append({
+                            'ticker': ticker,
+                            'name': name,
+                            'price': float(bond_price),
+                            'sector': 'Облигации',
+                            'description': f"Российская облигация {name}",
+                            'logo_url': self._get_logo_url(ticker),
+                            'instrument_type': 'bond',
+                            'face_value': fields['FACEVALUE'],
+                            'coupon_value': fields['COUPONVALUE'],
+                            'coupon_percent': fields['COUPONPERCENT'],
+                            'coupon_period': fields['COUPONPERIOD'],
+                            'accrued_int': fields['ACCRUEDINT'],
+                            'next_coupon_date': fields['NEXTCOUPON'],
+                            'maturity_date': fields['MATDATE'],
+                            'lot_size': fields['LOTSIZE'],
+                            'currency': fields['CURRENCYID'],
+                            'isin': fields['ISIN'],
+                        })
 
-                    start += len(rows)
+                    start += len(table)
 
                 except Exception as page_e:
                     logger.warning(f"Ошибка страницы облигаций: {page_e}")
@@ -441,155 +574,162 @@ class StockAPIService:
         return fallback_stocks
     
     def get_stock_history(self, ticker, days=1):
-        """Получает историю цен акции с MOEX"""
+        """История цен закрытия за последние days дней: [{'date': 'YYYY-MM-DD', 'price': float}].
+        Для бумаг из БД читается из локального хранилища свечей, с MOEX дозагружаются только недостающие дни
+        """
         try:
-            from datetime import datetime, timedelta
-            
-            # Вычисляем даты
-            end_date = datetime.now()
+            end_date = date.today()
             start_date = end_date - timedelta(days=days)
-            
-            # Форматируем даты для API
-            start_str = start_date.strftime('%Y-%m-%d')
-            end_str = end_date.strftime('%Y-%m-%d')
-            
             # Нормализуем тикер (например YNDX -> YDEX, если требуется)
             norm_ticker = self._normalize_ticker(ticker) or ticker
-            # Собираем список площадок: сначала динамические, затем стандартная TQBR
-            dynamic_boards = self._get_ticker_boards(norm_ticker) or []
-            boards_to_try = []
-            for b in dynamic_boards + ['TQBR']:
-                if b and b not in boards_to_try:
-                    boards_to_try.append(b)
+            fetch = self.history_fetch(norm_ticker)
 
-            # Пробуем последовательно все доступные площадки, пока не получим историю
-            for board in boards_to_try:
-                try:
-                    url = f"{self.moex_base_url}/history/engines/stock/markets/shares/boards/{board}/securities/{norm_ticker}.json"
-                    params = {
-                        'from': start_str,
-                        'till': end_str,
-                        'iss.meta': 'off',
-                        'iss.only': 'history',
-                        'history.columns': 'TRADEDATE,CLOSE'
-                    }
-                    response = self.session.get(url, params=params, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
-                    if 'history' in data and 'data' in data['history'] and data['history']['data']:
-                        history_data = []
-                        for row in data['history']['data']:
-                            if row and len(row) >= 2 and row[1]:
-                                history_data.append({'date': row[0], 'price': float(row[1])})
-                        logger.info(f"Получено {len(history_data)} точек истории для {ticker} с площадки {board}")
-                        if history_data:
-                            return history_data
-                except Exception as e:
-                    logger.warning(f"Ошибка получения истории {ticker} с площадки {board}: {e}")
-                    continue
+            if has_app_context():
+                stock_id = price_bars.stock_id(ticker) or price_bars.stock_id(norm_ticker)
+                if stock_id:
+                    bars = price_bars.history(stock_id, start_date, end_date, fetch)
+                    return [{'date': bar.date.isoformat(), 'price': bar.close} for bar in bars if bar.close and bar.close > 0]
+
+            # Бумаги нет в БД - берем историю напрямую с MOEX
+            bars = []
+            fetch(start_date, end_date, bars.extend)
+            return [{'date': bar['date'].isoformat(), 'price': bar['close']} for bar in bars if bar['close'] and bar['close'] > 0]
 
-            logger.warning(f"Нет данных истории для {ticker} (SECID={norm_ticker}) ни на одной площадке")
-            return []
-            
         except Exception as e:
             logger.error(f"Ошибка получения истории для {ticker}: {e}")
             return []
 
+    def history_fetch(self, ticker):
+        """Загрузчик дневной истории бумаги для price_bars: fetch(start, end, sink) -> число свечей.
+        Площадки определяются при первой загрузке, а не при создании загрузчика
+        """
+        norm_ticker = self._normalize_ticker(ticker) or ticker
+        boards = []
+
+        def fetch(start, end, sink):
+            if not boards:
+                boards.extend(self._history_boards(norm_ticker))
+            return history_fetcher.fetch(norm_ticker, boards, start, end, sink)
+        return fetch
+
+    def _history_boards(self, norm_ticker):
+        """Площадки для запроса истории: сначала из справочника, затем стандартная TQBR"""
+        boards = []
+        for b in (self._get_ticker_boards(norm_ticker) or []) + ['TQBR']:
+            if b and b not in boards:
+                boards.append(b)
+        return boards
+
     def get_intraday_history(self, ticker, interval=10, hours=24):
         """Получает внутридневную историю (свечи) за последние hours часов.
         interval: 1, 10, 60 (минуты)
+        Свечи берутся из кэша процесса (candle_cache), с MOEX дозагружаются только новые.
         Возвращает список [{'time': ISO, 'price': float}].
         """
         try:
-            from datetime import datetime, timedelta
-            now = datetime.now()
-            start_dt = now - timedelta(hours=hours)
-            start_str = start_dt.strftime('%Y-%m-%d')
-            end_str = now.strftime('%Y-%m-%d')
-
+            start_dt = datetime.now() - timedelta(hours=hours)
             # Нормализуем тикер и собираем доски
             norm_ticker = self._normalize_ticker(ticker) or ticker
+
+            def fetch(since, board):
+                return self._fetch_candles(ticker, norm_ticker, interval, since, board)
+
+            candles = candle_cache.get(norm_ticker, interval, start_dt, fetch, trading_calendar.quote_max_age())
+            if not candles:
+                logger.warning(f"Intraday-данные для {ticker} (SECID={norm_ticker}) не найдены")
+            return [{'time': begin, 'price': close} for _, begin, close in candles]
+        except Exception as e:
+            logger.error(f"Ошибка intraday получения для {ticker}: {e}")
+            return []
+
+    def _fetch_candles(self, ticker, norm_ticker, interval, since, board=None):
+        """Свечи с MOEX начиная с since: (площадка, [(begin datetime, begin строкой, close)]).
+        Если площадка известна, запрашивается только она, иначе площадки перебираются по очереди
+        """
+        if board:
+            boards_to_try = [board]
+        else:
             dynamic_boards = self._get_ticker_boards(norm_ticker) or []
             boards_to_try = []
             for b in dynamic_boards + ['TQBR', 'TQTF', 'TQPI']:
                 if b and b not in boards_to_try:
                     boards_to_try.append(b)
 
-            for board in boards_to_try:
-                try:
-                    url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities/{norm_ticker}/candles.json"
+        answered = False
+        for board in boards_to_try:
+            try:
+                url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities/{norm_ticker}/candles.json"
+                candles = []
+                # Смещение страницы считается по строкам ответа MOEX, а не по отобранным свечам
+                offset = 0
+                while True:
                     params = {
-                        'from': start_str,
-                        'till': end_str,
+                        'from': since.strftime('%Y-%m-%d %H:%M:%S'),
+                        'till': datetime.now().strftime('%Y-%m-%d'),
                         'interval': interval,
+                        'start': offset,
                         'iss.meta': 'off',
                         'iss.only': 'candles',
                         # не все инстансы уважают columns, но это не критично
                         'candles.columns': 'begin,close'
                     }
-                    response = self.session.get(url, params=params, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
-                    if 'candles' in data and 'data' in data['candles'] and data['candles']['data']:
-                        cols = data['candles']['columns']
-                        begin_idx = cols.index('begin') if 'begin' in cols else None
-                        close_idx = cols.index('close') if 'close' in cols else None
-                        result = []
-                        for row in data['candles']['data']:
-                            if row is None:
-                                continue
-                            try:
-                                t = row[begin_idx] if begin_idx is not None else None
-                                p = row[close_idx] if close_idx is not None else None
-                                if t and p is not None:
-                                    # Фильтруем по часовому окну
-                                    try:
-                                        # MOEX возвращает 'YYYY-MM-DD HH:MM:SS'
-                                        t_dt = datetime.fromisoformat(t.replace(' ', 'T'))
-                                        if t_dt < start_dt:
-                                            continue
-                                    except Exception:
-                                        pass
-                                    result.append({'time': t, 'price': float(p)})
-                            except Exception:
-                                continue
-                        if result:
-                            logger.info(f"Получено {len(result)} intraday-свечей для {ticker} (SECID={norm_ticker}) с {board} (interval={interval})")
-                            return result
-                except Exception as e:
-                    logger.warning(f"Ошибка intraday для {ticker} на {board}: {e}")
-                    continue
+                    data = iss_decoder.get_json(self.session, url, params=params, timeout=10)
+                    table = iss_decoder.decode_block((data or {}).get('candles'), CANDLES_SCHEMA)
+                    page = table.records()
+                    offset += len(page)
+                    for row in page:
+                        try:
+                            # MOEX возвращает 'YYYY-MM-DD HH:MM:SS'
+                            begin_dt = datetime.strptime(row['begin'], '%Y-%m-%d %H:%M:%S')
+                        except (TypeError, ValueError):
+                            continue
+                        if row['close'] is not None and begin_dt >= since:
+                            candles.append((begin_dt, row['begin'], row['close']))
+                    if len(page) < CANDLES_PAGE_SIZE:
+                        break
+                answered = True
+                if candles:
+                    logger.info(f"Получено {len(candles)} intraday-свечей для {ticker} (SECID={norm_ticker}) с {board} (interval={interval}, с {since})")
+                    return board, candles
+            except Exception as e:
+                logger.warning(f"Ошибка intraday для {ticker} на {board}: {e}")
+                continue
+        if not answered:
+            raise RuntimeError(f"MOEX не вернул свечи {norm_ticker} ни с одной площадки")
+        return board if len(boards_to_try) == 1 else None, []
 
-            logger.warning(f"Intraday-данные для {ticker} (SECID={norm_ticker}) не найдены")
-            return []
-        except Exception as e:
-            logger.error(f"Ошибка intraday получения для {ticker}: {e}")
-            return []
-    
     def update_stock_prices(self):
-        """Обновляет цены существующих акций"""
+        """Обновляет цены существующих акций (в БД пишутся только изменившиеся цены)"""
         try:
             # Получаем список тикеров из базы
-            existing_stocks = Stock.query.all()
+            existing_stocks = db.session.query(
+                Stock.id, Stock.ticker, Stock.instrument_type, Stock.face_value,
+                StockQuote.stock_id.label('quote_id'), StockQuote.price
+            ).outerjoin(StockQuote, StockQuote.stock_id == Stock.id).all()
             if not existing_stocks:
                 return False
 
             updated_count = 0
+            changed = []
             for stock in existing_stocks:
                 try:
-                    if getattr(stock, 'instrument_type', 'share') == 'bond':
-                        price = self._get_bond_price(stock.ticker, getattr(stock, 'face_value', None))
+                    if stock.instrument_type == 'bond':
+                        price = self._get_bond_price(stock.ticker, stock.face_value)
                     else:
                         price = self._get_stock_price(stock.ticker)
                     if price and price > 0:
-                        stock.price = price
                         updated_count += 1
+                        if price != stock.price:
+                            changed.append({'stock_id': stock.id, 'price': price, 'updated_at': datetime.now()})
                 except Exception as e:
                     logger.warning(f"Ошибка обновления цены для {stock.ticker}: {e}")
                     continue
             
+            changed_count = bulk_upsert.update_changed(
+                StockQuote, changed, key='stock_id', existing={s.id for s in existing_stocks if s.quote_id is not None}
+            )
             db.session.commit()
-            logger.info(f"Обновлены цены для {updated_count} акций")
+            logger.info(f"Обновлены цены для {updated_count} акций, изменилось {changed_count}")
             return True
             
         except Exception as e:
@@ -598,330 +738,329 @@ class StockAPIService:
             return False
     
     def get_multiple_stock_prices(self, tickers, timeout=10):
-        """Получает цены нескольких акций одним запросом"""
-        try:
-            # Ограничиваем количество тикеров в одном запросе для стабильности
-            if len(tickers) > 20:
-                # Разбиваем на части по 20 акций
-                all_prices = {}
-                for i in range(0, len(tickers), 20):
-                    batch = tickers[i:i+20]
-                    batch_prices = self.get_multiple_stock_prices(batch, timeout)
-                    all_prices.update(batch_prices)
-                return all_prices
-            
-            # Нормализуем тикеры (например YNDX -> YDEX)
-            norm_map = {}
-            normalized_tickers_list = []
-            normalized_seen = set()
-            for t in tickers:
-                norm = self._normalize_ticker(t) or t
-                norm_map[t] = norm
-                if norm not in normalized_seen:
-                    normalized_seen.add(norm)
-                    normalized_tickers_list.append(norm)
-
-            # Пробуем разные торговые площадки
-            boards = ['TQBR', 'TQPI', 'TQTF']  # Основные площадки для акций
-            prices = {}
-            
-            for board in boards:
-                if len(prices) == len(tickers):  # Если все цены уже получены
-                    break
-                    
-                try:
-                    tickers_str = ','.join(normalized_tickers_list)
-                    url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities.json?securities={tickers_str}"
-                    
-                    response = self.session.get(url, timeout=timeout)
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    logger.info(f"Получен ответ MOEX API для площадки {board}, акций: {len(tickers)}")
-                    
-                    # Обрабатываем marketdata (текущие торговые данные)
-                    if ('marketdata' in data and 'data' in data['marketdata'] and 
-                        len(data['marketdata']['data']) > 0):
-                        
-                        columns = data['marketdata']['columns']
-                        secid_idx = columns.index('SECID') if 'SECID' in columns else None
-                        
-                        # Ищем индексы нужных полей
-                        last_idx = columns.index('LAST') if 'LAST' in columns else None
-                        close_idx = columns.index('CLOSE') if 'CLOSE' in columns else None
-                        open_idx = columns.index('OPEN') if 'OPEN' in columns else None
-                        
-                        for row in data['marketdata']['data']:
-                            if secid_idx is not None:
-                                secid = row[secid_idx]
-                                # Сопоставляем SECID обратно к исходному тикеру
-                                original = None
-                                for orig, norm in norm_map.items():
-                                    if norm == secid:
-                                        original = orig
-                                        break
-                                if not original:
-                                    continue
-                                if original in prices:
-                                    continue
-                                price = None
-                                
-                                # Приоритет: LAST > CLOSE > OPEN
-                                if last_idx is not None and row[last_idx] is not None:
-                                    price = float(row[last_idx])
-                                elif close_idx is not None and row[close_idx] is not None:
-                                    price = float(row[close_idx])
-                                elif open_idx is not None and row[open_idx] is not None:
-                                    price = float(row[open_idx])
-                                
-                                if price and price > 0:
-                                    prices[original] = price
-                                    logger.info(f"Получена цена {original} (SECID={secid}) с площадки {board}: {price}")
-                except Exception as e:
-                    logger.warning(f"Ошибка получения данных с площадки {board}: {e}")
-                    continue
-            
-            # Для акций, которые не найдены, пробуем индивидуальные запросы
-            missing_tickers = [t for t in tickers if t not in prices]
-            if missing_tickers:
-                logger.info(f"Пробуем индивидуальные запросы для {missing_tickers}")
-                for ticker in missing_tickers:
-                    try:
-                        price = self._get_stock_price(ticker, timeout=5)
-                        if price and price > 0:
-                            prices[ticker] = price
-                    except Exception as e:
-                        logger.warning(f"Не удалось получить цену для {ticker}: {e}")
-            
-            return prices
-            
-        except Exception as e:
-            logger.error(f"Ошибка получения массовых цен: {e}")
-            return {}
+        """Получает цены нескольких акций (обертка над get_multiple_stock_trade_metrics)"""
+        metrics = self.get_multiple_stock_trade_metrics(tickers, timeout)
+        return {t: m['price'] for t, m in metrics.items() if m.get('price')}
+
+    def _parse_trade_metrics_block(self, block):
+        """Разбирает блок marketdata акций. Результат: dict[SECID] = {price, turnover, volume, change_pct}"""
+        table = iss_decoder.decode_block(block, TRADE_METRICS_SCHEMA)
+        # Приоритеты полей: LAST > CLOSE > OPEN, оборот в рублях > в валюте, LASTCHANGEPRC > LASTTOPREVPRICE (уже в %)
+        price = table.first_valid('LAST', 'CLOSE', 'OPEN', positive=True)
+        turnover = table.first_valid('VALTODAY_RUR', 'VALTODAY')
+        change_pct = table.first_valid('LASTCHANGEPRC', 'LASTTOPREVPRICE')
+        volume = table['VOLTODAY']
+        secids = table['SECID']
+        parsed = {}
+        for i in np.flatnonzero(price > 0):
+            secid = secids[i]
+            if not secid or secid in parsed:
+                continue
+            parsed[secid] = {
+                'price': float(price[i]),
+                'turnover': iss_decoder.as_float(turnover[i]),
+                'volume': iss_decoder.as_int(volume[i]),
+                'change_pct': iss_decoder.as_float(change_pct[i]),
+            }
+        return parsed
+
+    def _parse_bond_prices_block(self, block):
+        """Разбирает блок marketdata облигаций. Результат: dict[SECID] = цена в % от номинала"""
+        table = iss_decoder.decode_block(block, BOND_MARKETDATA_SCHEMA)
+        raw = table.first_valid('LAST', 'CLOSE', 'OPEN', positive=True)
+        secids = table['SECID']
+        parsed = {}
+        for i in np.flatnonzero(raw > 0):
+            t = secids[i]
+            if t and t not in parsed:
+                parsed[t] = float(raw[i])
+        return parsed
 
     def get_multiple_stock_trade_metrics(self, tickers, timeout=10):
-        """Возвращает метрики торгов для нескольких акций одним запросом.
+        """Возвращает метрики торгов для нескольких акций.
+        Пачки по 20 тикеров и площадки опрашиваются параллельно (не более max_workers запросов одновременно),
+        результаты сливаются в порядке приоритета площадок.
         Результат: dict[ticker] = { 'price': float, 'turnover': float|None, 'volume': int|None, 'change_pct': float|None }
         """
         try:
             if not tickers:
                 return {}
-            # Ограничиваем размер батча для стабильности
-            if len(tickers) > 20:
-                merged = {}
-                for i in range(0, len(tickers), 20):
-                    batch = tickers[i:i+20]
-                    part = self.get_multiple_stock_trade_metrics(batch, timeout)
-                    merged.update(part)
-                return merged
+            started = time.perf_counter()
 
             # Нормализация тикеров -> SECID
-            norm_map = {}
+            originals_by_secid = {}
             normalized = []
-            seen = set()
             for t in tickers:
                 n = self._normalize_ticker(t) or t
-                norm_map[t] = n
-                if n not in seen:
-                    seen.add(n)
+                if n not in originals_by_secid:
+                    originals_by_secid[n] = []
                     normalized.append(n)
+                if t not in originals_by_secid[n]:
+                    originals_by_secid[n].append(t)
 
-            boards = ['TQBR', 'TQPI', 'TQTF']
+            # Задачи упорядочены по приоритету площадок, поэтому слияние детерминировано
+            tasks = [(board, chunk) for board in SHARE_BOARDS for chunk in self._chunks(normalized)]
+            blocks = self._map_parallel(
+                lambda task: self._fetch_board_marketdata('shares', task[0], task[1], timeout),
+                tasks
+            )
             result = {}
-            for board in boards:
-                if len(result) == len(tickers):
-                    break
-                try:
-                    tickers_str = ','.join(normalized)
-                    url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities.json?securities={tickers_str}"
-                    resp = self.session.get(url, timeout=timeout)
-                    resp.raise_for_status()
-                    data = resp.json()
-                    if not ('marketdata' in data and 'data' in data['marketdata'] and data['marketdata']['data']):
-                        continue
-                    cols = data['marketdata']['columns']
-                    idx = {
-                        'SECID': cols.index('SECID') if 'SECID' in cols else None,
-                        'LAST': cols.index('LAST') if 'LAST' in cols else None,
-                        'CLOSE': cols.index('CLOSE') if 'CLOSE' in cols else None,
-                        'OPEN': cols.index('OPEN') if 'OPEN' in cols else None,
-                        'VALTODAY': cols.index('VALTODAY') if 'VALTODAY' in cols else None,
-                        'VALTODAY_RUR': cols.index('VALTODAY_RUR') if 'VALTODAY_RUR' in cols else None,
-                        'VOLTODAY': cols.index('VOLTODAY') if 'VOLTODAY' in cols else None,
-                        'LASTCHANGEPRC': cols.index('LASTCHANGEPRC') if 'LASTCHANGEPRC' in cols else None,
-                        'LASTTOPREVPRICE': cols.index('LASTTOPREVPRICE') if 'LASTTOPREVPRICE' in cols else None,
-                    }
-                    for row in data['marketdata']['data']:
-                        secid = row[idx['SECID']] if idx['SECID'] is not None else None
-                        if not secid:
-                            continue
-                        # Map SECID to original ticker
-                        original = None
-                        for orig, n in norm_map.items():
-                            if n == secid:
-                                original = orig
-                                break
-                        if not original or original in result:
-                            continue
-                        # Price
-                        price = None
-                        for key in ('LAST', 'CLOSE', 'OPEN'):
-                            k = idx[key]
-                            if k is not None and row[k] is not None:
-                                try:
-                                    price = float(row[k])
-                                    break
-                                except Exception:
-                                    pass
-                        # Turnover (prefer RUB)
-                        turnover = None
-                        if idx['VALTODAY_RUR'] is not None and row[idx['VALTODAY_RUR']] is not None:
-                            try:
-                                turnover = float(row[idx['VALTODAY_RUR']])
-                            except Exception:
-                                turnover = None
-                        elif idx['VALTODAY'] is not None and row[idx['VALTODAY']] is not None:
-                            try:
-                                turnover = float(row[idx['VALTODAY']])
-                            except Exception:
-                                turnover = None
-                        # Volume
-                        volume = None
-                        if idx['VOLTODAY'] is not None and row[idx['VOLTODAY']] is not None:
-                            try:
-                                volume = int(row[idx['VOLTODAY']])
-                            except Exception:
-                                try:
-                                    volume = int(float(row[idx['VOLTODAY']]))
-                                except Exception:
-                                    volume = None
-                        # Change percent
-                        change_pct = None
-                        if idx['LASTCHANGEPRC'] is not None and row[idx['LASTCHANGEPRC']] is not None:
-                            try:
-                                change_pct = float(row[idx['LASTCHANGEPRC']])
-                            except Exception:
-                                change_pct = None
-                        elif idx['LASTTOPREVPRICE'] is not None and row[idx['LASTTOPREVPRICE']] is not None:
-                            try:
-                                # LASTTOPREVPRICE уже в %, по спецификации MOEX
-                                change_pct = float(row[idx['LASTTOPREVPRICE']])
-                            except Exception:
-                                change_pct = None
-
-                        if price is not None and price > 0:
-                            result[original] = {
-                                'price': price,
-                                'turnover': turnover,
-                                'volume': volume,
-                                'change_pct': change_pct,
-                            }
-                except Exception as e:
-                    logger.warning(f"Ошибка метрик на борде {board}: {e}")
+            for (board, _chunk), block in zip(tasks, blocks):
+                if not block:
                     continue
+                for secid, metrics in self._parse_trade_metrics_block(block).items():
+                    for original in originals_by_secid.get(secid, []):
+                        if original not in result:
+                            result[original] = dict(metrics)
 
             # Индивидуальные попытки для отсутствующих тикеров (только цена)
             missing = [t for t in tickers if t not in result]
-            for t in missing:
-                try:
-                    p = self._get_stock_price(t, timeout=5)
+            if missing:
+                prices = self._map_parallel(lambda t: self._get_stock_price(t, timeout=5), missing)
+                for t, p in zip(missing, prices):
                     if p and p > 0:
                         result[t] = {'price': p, 'turnover': None, 'volume': None, 'change_pct': None}
-                except Exception:
-                    pass
+
+            self._record_refresh_stats('shares', len(tickers), len(result), len(tasks) + len(missing), started)
             return result
         except Exception as e:
             logger.error(f"Ошибка получения метрик: {e}")
             return {}
 
+    def get_board_snapshot(self, market, board, timeout=30):
+        """Снимок marketdata всей площадки одним запросом, проиндексированный по SECID.
+        Для акций: dict[SECID] = {price, turnover, volume, change_pct}; для облигаций: dict[SECID] = цена в % от номинала.
+        Возвращает None, если площадку получить не удалось.
+        """
+        key = (market, board)
+        cached = self._board_snapshots.get(key)
+        if cached and time.time() - cached['fetched_at'] < self.snapshot_ttl:
+            return cached['index']
+        try:
+            url = f"{self.moex_base_url}/engines/stock/markets/{market}/boards/{board}/securities.json"
+            params = {
+                'iss.meta': 'off',
+                'iss.only': 'marketdata',
+                'marketdata.columns': SNAPSHOT_COLUMNS[market],
+            }
+            block = iss_decoder.get_json(self.session, url, params=params, timeout=timeout).get('marketdata') or {}
+            if market == 'bonds':
+                index = self._parse_bond_prices_block(block)
+            else:
+                index = self._parse_trade_metrics_block(block)
+            with self._snapshot_lock:
+                self._board_snapshots[key] = {'fetched_at': time.time(), 'index': index}
+            logger.info(f"Снимок площадки {board} ({market}): {len(index)} бумаг")
+            return index
+        except Exception as e:
+            logger.warning(f"Ошибка получения снимка площадки {board} ({market}): {e}")
+            return None
+
+    def get_snapshot_trade_metrics(self, tickers, timeout=30):
+        """Метрики торгов для акций из снимков площадок TQBR/TQPI/TQTF (по одному запросу на площадку).
+        Тикеры, которых нет в снимках, добираются обычным пакетным способом.
+        Формат результата совпадает с get_multiple_stock_trade_metrics.
+        """
+        try:
+            if not tickers:
+                return {}
+            started = time.perf_counter()
+            snapshots = self._map_parallel(
+                lambda board: self.get_board_snapshot('shares', board, timeout),
+                SHARE_BOARDS
+            )
+            result = {}
+            for t in tickers:
+                secid = self._normalize_ticker(t) or t
+                for index in snapshots:
+                    if index and secid in index:
+                        result[t] = dict(index[secid])
+                        break
+
+            requests_count = len(SHARE_BOARDS)
+            missing = [t for t in tickers if t not in result]
+            if missing and all(index is not None for index in snapshots):
+                # Площадки получены целиком: недостающие бумаги торгуются где-то еще, ищем их поштучно
+                prices = self._map_parallel(lambda t: self._get_stock_price(t, timeout=5), missing)
+                for t, p in zip(missing, prices):
+                    if p and p > 0:
+                        result[t] = {'price': p, 'turnover': None, 'volume': None, 'change_pct': None}
+                requests_count += len(missing)
+            elif missing:
+                logger.info(f"Снимки площадок получены не полностью, запрашиваем {len(missing)} акций пакетами")
+                result.update(self.get_multiple_stock_trade_metrics(missing, timeout=10))
+                requests_count += self.last_refresh_stats.get('shares', {}).get('requests') or 0
+            # Статистика - после добора недостающих: пакетный запрос выше записывает свою
+            self._record_refresh_stats('shares', len(tickers), len(result), requests_count, started, mode='snapshot')
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка получения метрик из снимка: {e}")
+            return self.get_multiple_stock_trade_metrics(tickers)
+
+    def get_snapshot_bond_prices(self, tickers, face_values_map=None, timeout=30):
+        """Цены облигаций (в рублях) из снимков площадок TQCB/TQOB/TQIR.
+        Тикеры, которых нет в полученных целиком снимках, добираются поштучно,
+        а если часть снимков не получена - обычным пакетным способом.
+        """
+        try:
+            if not tickers:
+                return {}
+            started = time.perf_counter()
+            snapshots = self._map_parallel(
+                lambda board: self.get_board_snapshot('bonds', board, timeout),
+                BOND_BOARDS
+            )
+            prices = {}
+            for t in dict.fromkeys(tickers):
+                for index in snapshots:
+                    if index and t in index:
+                        fv = (face_values_map or {}).get(t)
+                        raw = index[t]
+                        prices[t] = (raw / 100.0 * fv) if fv else raw
+                        break
+
+            requests_count = len(BOND_BOARDS)
+            missing = [t for t in dict.fromkeys(tickers) if t not in prices]
+            if missing and all(index is not None for index in snapshots):
+                # Площадки получены целиком: недостающих облигаций в снимках нет, ищем их поштучно
+                found = self._map_parallel(
+                    lambda t: self._get_bond_price(t, face_value=(face_values_map or {}).get(t), timeout=5),
+                    missing
+                )
+                for t, p in zip(missing, found):
+                    if p and p > 0:
+                        prices[t] = p
+                requests_count += len(missing)
+            elif missing:
+                logger.info(f"Снимки площадок получены не полностью, запрашиваем {len(missing)} облигаций пакетами")
+                prices.update(self.get_multiple_bond_prices(missing, face_values_map=face_values_map, timeout=10))
+                requests_count += self.last_refresh_stats.get('bonds', {}).get('requests') or 0
+            # Статистика - после добора недостающих: пакетный запрос выше записывает свою
+            self._record_refresh_stats('bonds', len(set(tickers)), len(prices), requests_count, started, mode='snapshot')
+            return prices
+        except Exception as e:
+            logger.error(f"Ошибка получения цен облигаций из снимка: {e}")
+            return self.get_multiple_bond_prices(tickers, face_values_map=face_values_map)
+
     def get_multiple_bond_prices(self, tickers, face_values_map=None, timeout=10):
-        """Получает цены нескольких облигаций одним запросом (в рублях)
+        """Получает цены нескольких облигаций (в рублях).
+        Пачки по 20 тикеров и площадки опрашиваются параллельно.
         face_values_map: dict[ticker] -> face_value
         """
         try:
-            if len(tickers) > 20:
-                all_prices = {}
-                for i in range(0, len(tickers), 20):
-                    batch = tickers[i:i+20]
-                    batch_prices = self.get_multiple_bond_prices(batch, face_values_map, timeout)
-                    all_prices.update(batch_prices)
-                return all_prices
-
-            boards = ['TQCB', 'TQOB', 'TQIR']
+            if not tickers:
+                return {}
+            started = time.perf_counter()
+            unique_tickers = list(dict.fromkeys(tickers))
+            tasks = [(board, chunk) for board in BOND_BOARDS for chunk in self._chunks(unique_tickers)]
+            blocks = self._map_parallel(
+                lambda task: self._fetch_board_marketdata('bonds', task[0], task[1], timeout),
+                tasks
+            )
+            wanted = set(unique_tickers)
             prices = {}
-            for board in boards:
-                if len(prices) == len(tickers):
-                    break
-                try:
-                    tickers_str = ','.join(tickers)
-                    url = f"{self.moex_base_url}/engines/stock/markets/bonds/boards/{board}/securities.json?securities={tickers_str}"
-                    response = self.session.get(url, timeout=timeout)
-                    response.raise_for_status()
-                    data = response.json()
-
-                    if ('marketdata' in data and 'data' in data['marketdata'] and len(data['marketdata']['data']) > 0):
-                        columns = data['marketdata']['columns']
-                        secid_idx = columns.index('SECID') if 'SECID' in columns else None
-                        last_idx = columns.index('LAST') if 'LAST' in columns else None
-                        close_idx = columns.index('CLOSE') if 'CLOSE' in columns else None
-                        open_idx = columns.index('OPEN') if 'OPEN' in columns else None
-                        for row in data['marketdata']['data']:
-                            if secid_idx is not None and row[secid_idx] in tickers and row[secid_idx] not in prices:
-                                t = row[secid_idx]
-                                raw = None
-                                if last_idx is not None and row[last_idx] is not None:
-                                    raw = float(row[last_idx])
-                                elif close_idx is not None and row[close_idx] is not None:
-                                    raw = float(row[close_idx])
-                                elif open_idx is not None and row[open_idx] is not None:
-                                    raw = float(row[open_idx])
-                                if raw is not None:
-                                    fv = (face_values_map or {}).get(t)
-                                    price_rub = (raw / 100.0 * fv) if fv else raw
-                                    prices[t] = price_rub
-                except Exception as e:
-                    logger.warning(f"Ошибка получения данных облигаций с площадки {board}: {e}")
+            for (board, _chunk), block in zip(tasks, blocks):
+                if not block:
                     continue
+                for t, raw in self._parse_bond_prices_block(block).items():
+                    if t in wanted and t not in prices:
+                        fv = (face_values_map or {}).get(t)
+                        prices[t] = (raw / 100.0 * fv) if fv else raw
+
+            self._record_refresh_stats('bonds', len(unique_tickers), len(prices), len(tasks), started)
             return prices
         except Exception as e:
             logger.error(f"Ошибка получения массовых цен облигаций: {e}")
             return {}
 
+    def _probe_board(self, ticker, board, timeout, cancel):
+        """Запрашивает цену бумаги на одной площадке.
+        Возвращает (цена, ответ_получен): ответ_получен=False, если запрос упал или был отменен.
+        """
+        if cancel.is_set():
+            return None, False
+        try:
+            url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities/{ticker}.json"
+            data = iss_decoder.get_json(self.session, url, timeout=timeout)
+            logger.info(f"Получен ответ MOEX API для {ticker} с площадки {board}, секции: {list(data.keys())}")
+            price = self._extract_price_from_data(data, ticker, board, cancel=cancel)
+            return price, not cancel.is_set()
+        except Exception as e:
+            logger.warning(f"Ошибка получения {ticker} с площадки {board}: {e}")
+            return None, False
+
+    @staticmethod
+    def _preferred_board_price(boards, prices, pending_boards):
+        """Цена самой приоритетной площадки из полученных, если все площадки выше нее уже ответили.
+        Возвращает (площадка, цена) или None - нужно ждать ответов
+        """
+        for board in boards:
+            if prices.get(board):
+                return board, prices[board]
+            if board in pending_boards:
+                return None
+        return None
+
     def _get_stock_price(self, ticker, timeout=10):
-        """Получает текущую цену акции"""
+        """Получает текущую цену акции.
+        Площадки опрашиваются параллельно; цена берется с самой приоритетной ответившей площадки:
+        после первой цены ответы площадок выше ждутся не дольше BOARD_PRICE_WINDOW, остальные запросы отменяются.
+        """
         try:
             orig_ticker = ticker
             ticker = self._normalize_ticker(ticker) or ticker
-            # Сначала пытаемся определить доступные площадки для данного тикера динамически,
-            # затем добавляем стандартные как запасной вариант
+            if self._is_known_missing(ticker):
+                logger.info(f"{orig_ticker} (SECID={ticker}) недавно не найден ни на одной площадке, пропускаем")
+                return None
+            # Сначала площадки из справочника бумаг, затем стандартные как запасной вариант
             dynamic_boards = self._get_ticker_boards(ticker) or []
             # Пробуем разные торговые площадки (уникально, сохраняя порядок)
             boards = []
             for b in dynamic_boards + ['TQBR', 'TQPI', 'TQTF']:
                 if b and b not in boards:
                     boards.append(b)
-            
+
+            cancel = threading.Event()
+            executor = self._get_probe_executor()
+            pending = {executor.submit(self._probe_board, ticker, board, timeout, cancel): board for board in boards}
+            # Общий лимит: запрос площадки + запрос истории
+            deadline = time.time() + timeout * 2
+            window_end = None
+            prices = {}
+            all_answered = True
+            try:
+                while pending:
+                    chosen = self._preferred_board_price(boards, prices, set(pending.values()))
+                    if chosen:
+                        break
+                    remaining = min(deadline, window_end or deadline) - time.time()
+                    if remaining <= 0:
+                        break
+                    done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        board = pending.pop(future)
+                        price, answered = future.result()
+                        if price and price > 0:
+                            prices[board] = price
+                            if window_end is None:
+                                window_end = time.time() + BOARD_PRICE_WINDOW
+                        all_answered = all_answered and answered
+            finally:
+                cancel.set()
+                for future in pending:
+                    future.cancel()
+
+            # Площадки выше не успели ответить за окно - берем лучшую из полученных цен
             for board in boards:
-                try:
-                    url = f"{self.moex_base_url}/engines/stock/markets/shares/boards/{board}/securities/{ticker}.json"
-                    
-                    response = self.session.get(url, timeout=timeout)
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    logger.info(f"Получен ответ MOEX API для {orig_ticker} (SECID={ticker}) с площадки {board}, секции: {list(data.keys())}")
-                    
-                    # Пробуем получить цену с этой площадки
-                    price = self._extract_price_from_data(data, ticker, board)
-                    if price and price > 0:
-                        return price
-                        
-                except Exception as e:
-                    logger.warning(f"Ошибка получения {ticker} с площадки {board}: {e}")
-                    continue
-            
+                if prices.get(board):
+                    logger.info(f"Цена {orig_ticker} (SECID={ticker}) получена с площадки {board}")
+                    return prices[board]
+
             # Если не получилось ни с одной площадки
             logger.error(f"Не удалось получить цену {ticker} ни с одной площадки")
+            # В негативный кэш попадают только бумаги, по которым все площадки ответили без цены
+            if all_answered and not pending:
+                self._remember_missing(ticker)
             return None
 
         except Exception as e:
@@ -935,9 +1074,7 @@ class StockAPIService:
             for board in boards:
                 try:
                     url = f"{self.moex_base_url}/engines/stock/markets/bonds/boards/{board}/securities/{ticker}.json"
-                    response = self.session.get(url, timeout=timeout)
-                    response.raise_for_status()
-                    data = response.json()
+                    data = iss_decoder.get_json(self.session, url, timeout=timeout)
                     price = self._extract_bond_price_from_data(data, ticker, board, face_value)
                     if price and price > 0:
                         return price
@@ -950,90 +1087,81 @@ class StockAPIService:
             logger.error(f"Общая ошибка получения цены облигации {ticker}: {e}")
             return None
     
-    def _extract_price_from_data(self, data, ticker, board):
-        """Извлекает цену из данных MOEX API"""
-        try:
-            
-            # 1. Пытаемся получить цену из marketdata (текущие торговые данные)
-            if ('marketdata' in data and 'data' in data['marketdata'] and 
-                len(data['marketdata']['data']) > 0):
-                
-                columns = data['marketdata']['columns']
-                row = data['marketdata']['data'][0]
-                market = dict(zip(columns, row))
-                
-                # Расширенный приоритет цен: LAST > LCURRENTPRICE > CLOSE > OPEN > WAPRICE > MARKETPRICE2
-                price = (
-                    market.get('LAST')
-                    or market.get('LCURRENTPRICE')
-                    or market.get('CLOSE')
-                    or market.get('OPEN')
-                    or market.get('WAPRICE')
-                    or market.get('MARKETPRICE2')
-                )
-                if price and price > 0:
-                    logger.info(f"Получена цена {ticker} из marketdata с площадки {board}: {price}")
-                    return float(price)
-            
-            # 2. Пытаемся получить цену из securities (информация о ценных бумагах)
-            if ('securities' in data and 'data' in data['securities'] and 
-                len(data['securities']['data']) > 0):
-                
-                columns = data['securities']['columns']
-                row = data['securities']['data'][0]
-                security = dict(zip(columns, row))
-                
-                # Пытаемся получить цену из разных полей (на случай разных наборов колонок)
-                price = (
-                    security.get('PREVPRICE')
-                    or security.get('LAST')
-                    or security.get('MARKETPRICE')
-                    or security.get('LCURRENTPRICE')
-                    or security.get('MARKETPRICE2')
-                    or security.get('CLOSE')
-                    or security.get('OPEN')
-                    or security.get('PREVADMITTEDQUOTE')
-                )
-                if price and price > 0:
-                    logger.info(f"Получена цена {ticker} из securities с площадки {board}: {price}")
-                    return float(price)
-            
-            # 3. Если не получилось получить из основного запроса, пробуем историю для этой площадки
-            logger.info(f"Пытаемся получить цену {ticker} из истории торгов площадки {board}")
-            history_url = f"{self.moex_base_url}/history/engines/stock/markets/shares/boards/{board}/securities/{ticker}.json"
-            params = {'iss.meta': 'off', 'iss.only': 'history', 'history.columns': 'TRADEDATE,CLOSE', 'limit': 1}
-            
-            response = self.session.get(history_url, params=params, timeout=5)
-            response.raise_for_status()
-            
-            hist_data = response.json()
-            if 'history' in hist_data and 'data' in hist_data['history'] and len(hist_data['history']['data']) > 0:
-                row = hist_data['history']['data'][0]
-                if row and len(row) >= 2 and row[1]:
-                    logger.info(f"Получена цена {ticker} из истории площадки {board}: {row[1]}")
-                    return float(row[1])
-            
-            logger.warning(f"Не удалось получить цену для {ticker} с площадки {board}")
+    def _first_row_price(self, block, fields):
+        """Первая положительная цена из первой строки блока ISS по списку полей (в порядке приоритета)"""
+        if not block or not block.get('data'):
             return None
-            
+        first = {'columns': block.get('columns') or [], 'data': block['data'][:1]}
+        table = iss_decoder.decode_block(first, {name: FLOAT for name in fields})
+        return iss_decoder.as_float(table.first_valid(*fields, positive=True)[0])
+
+    def _extract_price_from_data(self, data, ticker, board, cancel=None):
+        """Извлекает цену из данных MOEX API.
+        cancel - событие отмены: если цену уже нашли на другой площадке, запрос истории не делается.
+        Ошибки (в том числе запроса истории) пробрасываются: площадка, которая не ответила,
+        не должна считаться площадкой без цены.
+        """
+        # 1. Пытаемся получить цену из marketdata (текущие торговые данные)
+        # Расширенный приоритет цен: LAST > LCURRENTPRICE > CLOSE > OPEN > WAPRICE > MARKETPRICE2
+        price = self._first_row_price(data.get('marketdata'), MARKETDATA_PRICE_FIELDS)
+        if price:
+            logger.info(f"Получена цена {ticker} из marketdata с площадки {board}: {price}")
+            return price
+
+        # 2. Пытаемся получить цену из securities (на случай разных наборов колонок)
+        price = self._first_row_price(data.get('securities'), SECURITIES_PRICE_FIELDS)
+        if price:
+            logger.info(f"Получена цена {ticker} из securities с площадки {board}: {price}")
+            return price
+
+        # 3. Если не получилось получить из основного запроса, пробуем историю для этой площадки
+        if cancel is not None and cancel.is_set():
+            return None
+        logger.info(f"Пытаемся получить цену {ticker} из истории торгов площадки {board}")
+        history_url = f"{self.moex_base_url}/history/engines/stock/markets/shares/boards/{board}/securities/{ticker}.json"
+        params = {'iss.meta': 'off', 'iss.only': 'history', 'history.columns': 'TRADEDATE,CLOSE', 'limit': 1}
+
+        hist_data = iss_decoder.get_json(self.session, history_url, params=params, timeout=5)
+        price = self._first_row_price(hist_data.get('history'), ('CLOSE',))
+        if price:
+            logger.info(f"Получена цена {ticker} из истории площадки {board}: {price}")
+            return price
+
+        logger.warning(f"Не удалось получить цену для {ticker} с площадки {board}")
+        return None
+
+    def _extract_bond_price_from_data(self, data, ticker, board, face_value=None):
+        """Извлекает цену облигации в рублях (MOEX отдает цену в % от номинала)"""
+        try:
+            percent = (
+                self._first_row_price(data.get('marketdata'), ('LAST', 'CLOSE', 'OPEN', 'WAPRICE', 'MARKETPRICE2'))
+                or self._first_row_price(data.get('securities'), ('PREVPRICE', 'PREVWAPRICE', 'PREVLEGALCLOSEPRICE'))
+            )
+            if not percent:
+                return None
+            if not face_value:
+                face_value = self._first_row_price(data.get('securities'), ('FACEVALUE',))
+            price = (percent / 100.0 * face_value) if face_value else percent
+            logger.info(f"Получена цена облигации {ticker} с площадки {board}: {price}")
+            return price
         except Exception as e:
-            logger.error(f"Ошибка получения цены для {ticker}: {e}")
+            logger.error(f"Ошибка получения цены облигации {ticker}: {e}")
             return None
 
     def _normalize_ticker(self, ticker: str) -> str:
         """Нормализует тикер для MOEX (например, YNDX -> YDEX). Возвращает SECID для запросов."""
         try:
-            mapping = {
-                # Яндекс: исторически YNDX, текущий SECID на MOEX – YDEX
-                'YNDX': 'YDEX',
-                # Можно добавлять сюда другие переименованные тикеры при необходимости
-            }
-            return mapping.get(ticker.upper(), ticker)
+            return security_master.resolve(ticker)
         except Exception:
             return ticker
 
     def _get_ticker_boards(self, ticker, timeout=5):
-        """Возвращает список доступных торговых площадок (BOARDID) для тикера"""
+        """Возвращает список доступных торговых площадок (BOARDID) для тикера.
+        Берется из справочника бумаг; к MOEX обращаемся, только если справочник еще не загружен.
+        """
+        boards = security_master.boards(ticker)
+        if boards is not None:
+            return boards
         try:
             url = f"{self.moex_base_url}/securities/{ticker}.json"
             params = {
@@ -1058,7 +1186,7 @@ class StockAPIService:
             return []
     
     def sync_stocks_to_database(self):
-        """Синхронизирует акции с базой данных"""
+        """Синхронизирует акции с базой данных (пакетно: пишутся только новые и изменившиеся строки)"""
         try:
             stocks_data = self.get_all_stocks()
             
@@ -1066,140 +1194,95 @@ class StockAPIService:
                 logger.error("Не удалось получить данные об акциях")
                 return False
             
-            added_count = 0
-            updated_count = 0
-            
-            for stock_data in stocks_data:
-                try:
-                    existing_stock = Stock.query.filter_by(ticker=stock_data['ticker']).first()
-                    
-                    if existing_stock:
-                        # Обновляем существующую акцию
-                        existing_stock.name = stock_data['name']
-                        existing_stock.price = stock_data['price']
-                        existing_stock.sector = stock_data['sector']
-                        if stock_data.get('description'):
-                            existing_stock.description = stock_data['description']
-                        if stock_data.get('logo_url'):
-                            existing_stock.logo_url = stock_data['logo_url']
-                        updated_count += 1
-                    else:
-                        # Добавляем новую акцию
-                        new_stock = Stock(
-                            ticker=stock_data['ticker'],
-                            name=stock_data['name'],
-                            price=stock_data['price'],
-                            sector=stock_data['sector'],
-                            description=stock_data.get('description', ''),
-                            logo_url=stock_data.get('logo_url', '')
-                        )
-                        db.session.add(new_stock)
-                        added_count += 1
-                        
-                except Exception as e:
-                    logger.warning(f"Ошибка обработки акции {stock_data.get('ticker', 'unknown')}: {e}")
-                    continue
-            
+            rows = [{
+                'ticker': stock_data['ticker'],
+                'name': stock_data['name'],
+                'price': stock_data['price'],
+                'sector': stock_data['sector'],
+                'description': stock_data.get('description', ''),
+                'logo_url': stock_data.get('logo_url', ''),
+            } for stock_data in stocks_data if stock_data.get('ticker')]
+            # Пустые описание и логотип не затирают уже сохраненные
+            result = bulk_upsert.upsert(
+                Stock, [{k: v for k, v in row.items() if k != 'price'} for row in rows],
+                keep_if_empty=('description', 'logo_url'), insert_defaults={'instrument_type': 'share'}
+            )
+            result['prices_changed'] = self._save_listing_quotes(rows, ('price',))
             db.session.commit()
             
-            total_stocks = Stock.query.count()
-            logger.info(f"Синхронизация завершена. Добавлено: {added_count}, обновлено: {updated_count}, всего: {total_stocks}")
-            
-            return {
-                'success': True,
-                'added': added_count,
-                'updated': updated_count,
-                'total': total_stocks
-            }
+            logger.info(f"Синхронизация завершена. Добавлено: {result['added']}, обновлено: {result['updated']}, "
+                        f"без изменений: {result['unchanged']}, всего: {result['total']} ({result['elapsed']} с)")
+            return result
             
         except Exception as e:
             logger.error(f"Ошибка синхронизации акций: {e}")
             db.session.rollback()
             return {'success': False, 'error': str(e)}
 
+    @staticmethod
+    def _save_listing_quotes(rows, fields):
+        """Пакетно записывает котировки из листинга (fields строк синхронизации) в StockQuote.
+        Возвращает число добавленных и измененных строк котировок
+        """
+        ids = dict(db.session.query(Stock.ticker, Stock.id).all())
+        quote_rows = [
+            {'stock_id': ids[row['ticker']], **{f: row.get(f) for f in fields}}
+            for row in rows if row['ticker'] in ids
+        ]
+        result = bulk_upsert.upsert(StockQuote, quote_rows, key='stock_id')
+        return result['added'] + result['updated']
+
+    @staticmethod
+    def _parse_date(val):
+        """'YYYY-MM-DD' -> date; пустые значения и '0000-00-00' -> None"""
+        try:
+            if isinstance(val, str) and val and val != '0000-00-00':
+                return datetime.strptime(val, '%Y-%m-%d').date()
+        except Exception:
+            return None
+        return val if not isinstance(val, str) else None
+
     def sync_bonds_to_database(self):
-        """Синхронизирует облигации с базой данных"""
+        """Синхронизирует облигации с базой данных (пакетно: пишутся только новые и изменившиеся строки)"""
         try:
             bonds_data = self.get_all_bonds()
             if not bonds_data:
                 logger.error("Не удалось получить данные об облигациях")
                 return {'success': False, 'error': 'no_data'}
 
-            added_count = 0
-            updated_count = 0
+            rows = []
             for bond in bonds_data:
-                try:
-                    existing = Stock.query.filter_by(ticker=bond['ticker']).first()
-                    # Парсинг дат
-                    def _parse_date(val):
-                        try:
-                            if isinstance(val, str) and val and val != '0000-00-00':
-                                return datetime.strptime(val, '%Y-%m-%d').date()
-                        except Exception:
-                            return None
-                        return val if not isinstance(val, str) else None
-
-                    next_coupon_date = _parse_date(bond.get('next_coupon_date'))
-                    maturity_date = _parse_date(bond.get('maturity_date'))
-
-                    if existing:
-                        existing.name = bond['name']
-                        existing.price = bond['price']
-                        existing.sector = bond.get('sector') or 'Облигации'
-                        existing.description = bond.get('description') or existing.description
-                        existing.logo_url = bond.get('logo_url') or existing.logo_url
-                        # Новые поля
-                        if hasattr(existing, 'instrument_type'):
-                            existing.instrument_type = 'bond'
-                        if hasattr(existing, 'face_value'):
-                            existing.face_value = bond.get('face_value')
-                        try:
-                            existing.coupon_value = bond.get('coupon_value')
-                            existing.coupon_percent = bond.get('coupon_percent')
-                            existing.coupon_period = bond.get('coupon_period')
-                            existing.accrued_int = bond.get('accrued_int')
-                            existing.lot_size = bond.get('lot_size')
-                            existing.currency = bond.get('currency')
-                            existing.isin = bond.get('isin')
-                            existing.next_coupon_date = next_coupon_date
-                            existing.maturity_date = maturity_date
-                        except Exception:
-                            pass
-                        updated_count += 1
-                    else:
-                        new_sec = Stock(
-                            ticker=bond['ticker'],
-                            name=bond['name'],
-                            price=bond['price'],
-                            sector=bond.get('sector') or 'Облигации',
-                            description=bond.get('description', ''),
-                            logo_url=bond.get('logo_url', ''),
-                            instrument_type='bond',
-                            face_value=bond.get('face_value')
-                        )
-                        # Доп поля
-                        try:
-                            new_sec.coupon_value = bond.get('coupon_value')
-                            new_sec.coupon_percent = bond.get('coupon_percent')
-                            new_sec.coupon_period = bond.get('coupon_period')
-                            new_sec.accrued_int = bond.get('accrued_int')
-                            new_sec.lot_size = bond.get('lot_size')
-                            new_sec.currency = bond.get('currency')
-                            new_sec.isin = bond.get('isin')
-                            new_sec.next_coupon_date = next_coupon_date
-                            new_sec.maturity_date = maturity_date
-                        except Exception:
-                            pass
-                        db.session.add(new_sec)
-                        added_count += 1
-                except Exception as e:
-                    logger.warning(f"Ошибка обработки облигации {bond.get('ticker', 'unknown')}: {e}")
+                if not bond.get('ticker'):
                     continue
-
+                rows.append({
+                    'ticker': bond['ticker'],
+                    'name': bond['name'],
+                    'price': bond['price'],
+                    'sector': bond.get('sector') or 'Облигации',
+                    'description': bond.get('description') or '',
+                    'logo_url': bond.get('logo_url') or '',
+                    'instrument_type': 'bond',
+                    'face_value': bond.get('face_value'),
+                    'coupon_value': bond.get('coupon_value'),
+                    'coupon_percent': bond.get('coupon_percent'),
+                    'coupon_period': bond.get('coupon_period'),
+                    'accrued_int': bond.get('accrued_int'),
+                    'lot_size': bond.get('lot_size'),
+                    'currency': bond.get('currency'),
+                    'isin': bond.get('isin'),
+                    'next_coupon_date': self._parse_date(bond.get('next_coupon_date')),
+                    'maturity_date': self._parse_date(bond.get('maturity_date')),
+                })
+            quote_fields = ('price', 'accrued_int')
+            result = bulk_upsert.upsert(
+                Stock, [{k: v for k, v in row.items() if k not in quote_fields} for row in rows],
+                keep_if_empty=('description', 'logo_url')
+            )
+            result['prices_changed'] = self._save_listing_quotes(rows, quote_fields)
             db.session.commit()
-            total = Stock.query.count()
-            logger.info(f"Синхронизация облигаций завершена. Добавлено: {added_count}, обновлено: {updated_count}, всего бумаг: {total}")
-            return {'success': True, 'added': added_count, 'updated': updated_count, 'total': total}
+            logger.info(f"Синхронизация облигаций завершена. Добавлено: {result['added']}, обновлено: {result['updated']}, "
+                        f"без изменений: {result['unchanged']}, всего бумаг: {result['total']} ({result['elapsed']} с)")
+            return result
         except Exception as e:
             logger.error(f"Ошибка синхронизации облигаций: {e}")
             db.session.rollback()
@@ -1231,31 +1314,22 @@ class StockAPIService:
                     if not amount_per or amount_per <= 0:
                         continue
 
-                    # По всем аккаунтам считаем позицию и создаем CashFlow при наличии
-                    accounts = Account.query.all()
-                    for acc in accounts:
+                    # Открытые позиции по облигации на всех счетах - CashFlow для каждой
+                    holdings = db.session.query(Position.account_id, Position.quantity).filter(
+                        Position.stock_id == b.id, Position.quantity > 0
+                    ).all()
+                    for account_id, qty in holdings:
                         try:
-                            txs = Transaction.query.filter_by(account_id=acc.id, stock_id=b.id).filter(
-                                Transaction.type.in_(['buy', 'sell'])
-                            ).all()
-                            qty = 0
-                            for t in txs:
-                                if t.type == 'buy':
-                                    qty += (t.quantity or 0)
-                                elif t.type == 'sell':
-                                    qty -= (t.quantity or 0)
-                            if qty <= 0:
-                                continue
                             # Проверяем, не создан ли уже CashFlow
                             exists = CashFlow.query.filter_by(
-                                type='coupon', account_id=acc.id, stock_id=b.id, pay_date=b.next_coupon_date
+                                type='coupon', account_id=account_id, stock_id=b.id, pay_date=b.next_coupon_date
                             ).first()
                             if exists:
                                 continue
                             gross = round(amount_per * qty, 6)
                             cf = CashFlow(
                                 type='coupon',
-                                account_id=acc.id,
+                                account_id=account_id,
                                 stock_id=b.id,
                                 ticker=b.ticker,
                                 currency=b.currency or 'SUR',
@@ -1269,7 +1343,7 @@ class StockAPIService:
                             db.session.add(cf)
                             created += 1
                         except Exception as acc_e:
-                            logger.warning(f"CashFlow coupon error for {b.ticker} acc {acc.id}: {acc_e}")
+                            logger.warning(f"CashFlow coupon error for {b.ticker} acc {account_id}: {acc_e}")
                             continue
                 except Exception as bond_e:
                     logger.warning(f"Coupon register error for {getattr(b, 'ticker', 'unknown')}: {bond_e}")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Тест пакетной синхронизации бумаг (SQLite в памяти, без обращения к MOEX)
+"""
+
+from database import db, Stock, StockQuote
+import bulk_upsert
+
+
+def test_upsert_writes_only_changes(app):
+    """Новые строки вставляются, изменившиеся обновляются, остальные не трогаются"""
+    with app.app_context():
+        db.session.add(Stock(ticker='SBER', name='Сбербанк', sector='Банки', description='Банк', logo_url='sber.png'))
+        db.session.add(Stock(ticker='GAZP', name='Газпром', sector='Прочее'))
+        db.session.commit()
+
+        rows = [
+            {'ticker': 'SBER', 'name': 'Сбербанк', 'sector': 'Банки', 'description': '', 'logo_url': ''},
+            {'ticker': 'GAZP', 'name': 'Газпром', 'sector': 'Нефть и газ', 'description': None, 'logo_url': None},
+            {'ticker': 'LKOH', 'name': 'Лукойл', 'sector': 'Нефть и газ', 'description': 'Нефть', 'logo_url': ''},
+        ]
+        result = bulk_upsert.upsert(Stock, rows, keep_if_empty=('description', 'logo_url'),
+                                    insert_defaults={'instrument_type': 'share'})
+        db.session.commit()
+        assert (result['added'], result['updated'], result['unchanged'], result['total']) == (1, 1, 1, 3)
+
+        sber = Stock.query.filter_by(ticker='SBER').one()
+        # Пустые значения не затерли сохраненные описание и логотип
+        assert (sber.description, sber.logo_url) == ('Банк', 'sber.png')
+        assert Stock.query.filter_by(ticker='GAZP').one().sector == 'Нефть и газ'
+        assert Stock.query.filter_by(ticker='LKOH').one().instrument_type == 'share'
+
+        # Повторная синхронизация тех же данных ничего не пишет
+        result = bulk_upsert.upsert(Stock, rows, keep_if_empty=('description', 'logo_url'),
+                                    insert_defaults={'instrument_type': 'share'})
+        assert (result['added'], result['updated'], result['unchanged']) == (0, 0, 3)
+    print("✅ Пакетная синхронизация пишет только изменения")
+
+
+def test_update_changed(app):
+    """Пакетная запись котировок: существующие строки обновляются, недостающие вставляются"""
+    with app.app_context():
+        db.session.add_all([
+            Stock(ticker='SBER', name='Сбербанк', price=250.0),
+            Stock(ticker='GAZP', name='Газпром', price=150.0, volume=100),
+            Stock(ticker='LKOH', name='Лукойл'),
+        ])
+        db.session.commit()
+        ids = dict(db.session.query(Stock.ticker, Stock.id).all())
+        assert bulk_upsert.update_changed(StockQuote, [], key='stock_id') == 0
+        written = bulk_upsert.update_changed(StockQuote, [
+            {'stock_id': ids['GAZP'], 'price': 151.0, 'volume': None},
+            {'stock_id': ids['LKOH'], 'price': 7000.0, 'volume': 5},
+        ], key='stock_id', existing={ids['SBER'], ids['GAZP']})
+        db.session.commit()
+        db.session.expire_all()
+        assert written == 2
+        gazp = Stock.query.filter_by(ticker='GAZP').one()
+        assert (gazp.price, gazp.volume) == (151.0, None)
+        assert Stock.query.filter_by(ticker='LKOH').one().price == 7000.0
+        assert Stock.query.filter_by(ticker='SBER').one().price == 250.0
+    print("✅ Пакетная запись котировок пишет только изменившиеся цены")
+
+
+def test_quote_compatibility(app):
+    """Поля котировок на Stock читаются и пишутся через StockQuote и работают в запросах"""
+    with app.app_context():
+        db.session.add_all([Stock(ticker='SBER', name='Сбербанк', price=250.0), Stock(ticker='NEW', name='Новая')])
+        db.session.commit()
+        assert db.session.query(StockQuote).count() == 1
+        assert Stock.query.filter_by(ticker='NEW').one().price == 0.0
+        assert [s.ticker for s in Stock.query.filter(Stock.price > 0).all()] == ['SBER']
+        Stock.query.filter_by(ticker='NEW').one().price = 10.0
+        db.session.commit()
+        assert db.session.query(StockQuote).count() == 2
+        assert [s.ticker for s in Stock.query.order_by(Stock.price.desc()).all()] == ['SBER', 'NEW']
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_upsert_writes_only_changes(make_app())
+    test_update_changed(make_app())
+    test_quote_compatibility(make_app())
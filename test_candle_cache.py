@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Тест кэша внутридневных свечей (MOEX подменяется функцией загрузки)
+"""
+
+from datetime import datetime, timedelta
+from candle_cache import CandleCache
+
+NOW = datetime(2024, 3, 1, 18, 0)
+
+
+def _candle(minutes_ago, close):
+    begin = NOW - timedelta(minutes=minutes_ago)
+    return begin, begin.strftime('%Y-%m-%d %H:%M:%S'), close
+
+
+def test_incremental_refresh():
+    """Повторные запросы - срез буфера; обновление дозагружает только свечи после последней"""
+    cache = CandleCache()
+    calls = []
+    day = [_candle(m, 100.0 + m) for m in range(600, -1, -10)]
+
+    def fetch(since, board):
+        calls.append((since, board))
+        if board is None:
+            return 'TQBR', [c for c in day if c[0] >= since]
+        # Последняя свеча обновилась, появилась новая
+        return 'TQBR', [(day[-1][0], day[-1][1], 55.5), _candle(-10, 56.0)]
+
+    start = NOW - timedelta(hours=10)
+    assert len(cache.get('SBER', 10, start, fetch, max_age=60)) == 61
+    # Более короткий период отдается из буфера без запроса к MOEX
+    assert len(cache.get('SBER', 10, NOW - timedelta(hours=1), fetch, max_age=60)) == 7
+    assert len(calls) == 1
+
+    candles = cache.get('SBER', 10, start, fetch, max_age=0)
+    assert calls[1] == (day[-1][0], 'TQBR')
+    assert len(candles) == 62 and [c[2] for c in candles[-2:]] == [55.5, 56.0]
+
+    # Запрошен более ранний период - буфер загружается заново
+    cache.get('SBER', 10, NOW - timedelta(hours=12), fetch, max_age=60)
+    assert calls[2] == (NOW - timedelta(hours=12), None)
+    print("✅ Свечи дозагружаются инкрементально и отдаются срезом буфера")
+
+
+def test_lru_and_capacity():
+    """Старые ряды вытесняются, буфер ряда ограничен MAX_HOURS"""
+    cache = CandleCache()
+    cache.max_series = 2
+    many = [_candle(m, 1.0) for m in range(5000, -1, -1)]
+    fetch = lambda since, board: ('TQBR', [c for c in many if c[0] >= since])
+    candles = cache.get('SBER', 1, NOW - timedelta(hours=100), fetch, max_age=60)
+    assert len(candles) == cache.capacity(1)
+    cache.get('GAZP', 1, NOW - timedelta(hours=1), fetch, max_age=60)
+    cache.get('SBER', 1, NOW - timedelta(hours=1), fetch, max_age=60)
+    cache.get('LKOH', 1, NOW - timedelta(hours=1), fetch, max_age=60)
+    assert list(cache._series) == [('SBER', 1), ('LKOH', 1)]
+    print("✅ Кэш свечей ограничен по числу рядов и длине буфера")
+
+
+if __name__ == '__main__':
+    test_incremental_refresh()
+    test_lru_and_capacity()
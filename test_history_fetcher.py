@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Тест постраничной загрузки длинной истории (MOEX подменяется фиктивной сессией)
+"""
+
+import threading
+from datetime import date, timedelta
+from history_fetcher import HistoryFetcher, HistoryFetchError
+
+COLUMNS = ['TRADEDATE', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOLUME']
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """Отдает по одной строке на каждый календарный день, страницами по page_size с history.cursor"""
+
+    def __init__(self, page_size=100, fail_board=None):
+        self.page_size = page_size
+        self.fail_board = fail_board
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.calls.append((url, dict(params)))
+        if self.fail_board and f"/boards/{self.fail_board}/" in url:
+            raise ConnectionError('площадка недоступна')
+        start = date.fromisoformat(params['from'])
+        till = date.fromisoformat(params['till'])
+        days = [start + timedelta(days=i) for i in range((till - start).days + 1)]
+        index = params['start']
+        page = days[index:index + self.page_size]
+        return FakeResponse({
+            'history': {'columns': COLUMNS, 'data': [[d.isoformat(), 1.0, 2.0, 0.5, 1.5, 10] for d in page]},
+            'history.cursor': {'columns': ['INDEX', 'TOTAL', 'PAGESIZE'], 'data': [[index, len(days), self.page_size]]},
+        })
+
+
+def _fetcher(session):
+    class Fetcher(HistoryFetcher):
+        # Потоки пула берут ту же фиктивную сессию
+        @property
+        def session(self):
+            return session
+    return Fetcher()
+
+
+def test_windows():
+    """Период режется на окна без пропусков и перекрытий"""
+    fetcher = HistoryFetcher()
+    start, end = date(2020, 1, 1), date(2024, 12, 31)
+    windows = fetcher.windows(start, end)
+    assert windows[0][0] == start and windows[-1][1] == end
+    assert all(b[0] - a[1] == timedelta(days=1) for a, b in zip(windows, windows[1:]))
+    assert all((w[1] - w[0]).days < fetcher.window_days for w in windows)
+    assert fetcher.windows(end, start) == []
+    print("✅ Период режется на окна по датам")
+
+
+def test_fetch_pages_by_cursor():
+    """Все страницы всех окон доходят до получателя, каждая дата - один раз"""
+    session = FakeSession()
+    fetcher = _fetcher(session)
+    start, end = date(2020, 1, 1), date(2023, 6, 30)
+    received = []
+    rows = fetcher.fetch('SBER', ['TQBR'], start, end, received.extend)
+    expected = (end - start).days + 1
+    assert rows == expected and len(received) == expected
+    assert sorted(bar['date'] for bar in received) == [start + timedelta(days=i) for i in range(expected)]
+    # Страницы запрашиваются по курсору: 100, 200, ...
+    assert {params['start'] for _, params in session.calls} >= {0, 100, 200, 300}
+    print("✅ История загружается постранично по курсору")
+
+
+def test_fallback_board_and_error():
+    """Недоступная площадка пропускается; если не ответила ни одна - HistoryFetchError"""
+    start, end = date(2024, 1, 1), date(2024, 1, 10)
+    fetcher = _fetcher(FakeSession(fail_board='TQBR'))
+    received = []
+    assert fetcher.fetch('SBER', ['TQBR', 'TQTF'], start, end, received.extend) == 10
+    try:
+        fetcher.fetch('SBER', ['TQBR'], start, end, received.extend)
+        assert False, 'ожидалась HistoryFetchError'
+    except HistoryFetchError:
+        pass
+    print("✅ Ошибки площадок обрабатываются")
+
+
+if __name__ == '__main__':
+    test_windows()
+    test_fetch_pages_by_cursor()
+    test_fallback_board_and_error()
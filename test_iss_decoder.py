@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Тест колоночного декодера ответов MOEX ISS (без обращения к сети)
+"""
+
+import math
+from iss_decoder import decode_block, FLOAT, INT, STR, DATE
+
+
+def test_decode_block():
+    """Пустые значения, мусор и отсутствующие колонки приводятся без исключений"""
+    block = {
+        'columns': ['SECID', 'LAST', 'CLOSE', 'VOLTODAY', 'MATDATE'],
+        'data': [
+            ['SBER', 300.5, None, '12', '2030-01-01'],
+            ['GAZP', None, '150', '', '0000-00-00'],
+            ['', 'abc', 0, None, None],
+        ]
+    }
+    table = decode_block(block, {'SECID': STR, 'LAST': FLOAT, 'CLOSE': FLOAT, 'VOLTODAY': INT,
+                                 'MATDATE': DATE, 'OPEN': FLOAT})
+    assert len(table) == 3
+    assert 'OPEN' not in table and 'LAST' in table
+    assert table['SECID'][2] is None
+    assert math.isnan(table['LAST'][2])
+
+    price = table.first_valid('LAST', 'CLOSE', 'OPEN', positive=True)
+    assert price[0] == 300.5 and price[1] == 150.0 and math.isnan(price[2])
+
+    records = table.records(['SECID', 'VOLTODAY', 'MATDATE'])
+    assert records[0]['VOLTODAY'] == 12 and isinstance(records[0]['VOLTODAY'], int)
+    assert records[0]['MATDATE'].isoformat() == '2030-01-01'
+    assert records[1]['VOLTODAY'] is None and records[1]['MATDATE'] is None
+    print("✅ Декодер ISS работает корректно")
+
+
+def test_decode_empty_block():
+    """Пустой ответ дает пустую таблицу с колонками схемы"""
+    table = decode_block({'columns': ['SECID'], 'data': []}, {'SECID': STR, 'LAST': FLOAT})
+    assert len(table) == 0
+    assert len(table.first_valid('LAST')) == 0
+    assert table.records() == []
+
+
+if __name__ == '__main__':
+    test_decode_block()
+    test_decode_empty_block()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Тест векторного расчета статистики портфеля: те же числа и порядок строк, что у расчета в циклах
+"""
+
+from types import SimpleNamespace
+import portfolio_engine
+from bench_portfolio_engine import synthetic_positions, loop_stats, engine_stats, compare
+
+
+def test_matches_loop_calculation():
+    positions, account_ids = synthetic_positions(1500, 4)
+    assert compare(loop_stats(positions, account_ids), engine_stats(positions, account_ids)) == []
+    print("✅ Векторный расчет совпадает с расчетом в циклах")
+
+
+def test_loop_matches_former_utils():
+    """loop_stats повторяет прежний calculate_portfolio_stats из utils: ожидаемые числа получены им
+    на той же истории (счет 1: SBER 10 x 250, GAZP 20 x 160, SBER 5 x 310; счет 2: SBER 5 x 280)
+    """
+    sber = SimpleNamespace(id=1, ticker='SBER', name='Сбербанк', sector='Финансы', instrument_type='share')
+    gazp = SimpleNamespace(id=2, ticker='GAZP', name='Газпром', sector=None, instrument_type='share')
+    positions = [
+        {'account_id': 1, 'stock_id': 1, 'stock': sber, 'quantity': 15, 'total_cost': 4050.0, 'realized_pnl': 0.0, 'price': 300.0},
+        {'account_id': 1, 'stock_id': 2, 'stock': gazp, 'quantity': 20, 'total_cost': 3200.0, 'realized_pnl': 0.0, 'price': 150.0},
+        {'account_id': 2, 'stock_id': 1, 'stock': sber, 'quantity': 5, 'total_cost': 1400.0, 'realized_pnl': 0.0, 'price': 300.0},
+    ]
+    stats = loop_stats(positions, [1, 2])
+    totals = stats['totals']
+    assert (totals['total_invested'], totals['total_current_value'], totals['total_profit_loss']) == (8650.0, 9000.0, 350.0)
+    assert totals['total_profit_loss_percent'] == 4.046242774566474
+    assert [(p['stock_id'], p['quantity'], p['total_cost'], p['avg_price'], p['current_value'], p['profit_loss'],
+             p['profit_loss_percent']) for p in stats['positions']] == [
+        (1, 20, 5450.0, 272.5, 6000.0, 550.0, 10.091743119266056),
+        (2, 20, 3200.0, 160.0, 3000.0, -200.0, -6.25),
+    ]
+    assert [(a['total_invested'], a['total_current_value'], a['total_profit_loss'], a['total_profit_loss_percent'])
+            for a in stats['accounts'].values()] == [
+        (7250.0, 7500.0, 250.0, 3.4482758620689653),
+        (1400.0, 1500.0, 100.0, 7.142857142857142),
+    ]
+    assert [[(p['stock_id'], p['quantity'], p['total_cost'], p['current_value'], p['profit_loss_percent'])
+             for p in a['positions']] for a in stats['accounts'].values()] == [
+        [(1, 15, 4050.0, 4500.0, 11.11111111111111), (2, 20, 3200.0, 3000.0, -6.25)],
+        [(1, 5, 1400.0, 1500.0, 7.142857142857142)],
+    ]
+    assert compare(stats, engine_stats(positions, [1, 2])) == []
+    print("✅ Расчет в циклах совпадает с прежним расчетом utils")
+
+
+def test_edge_cases():
+    """Пустой портфель, счет без позиций, бумага без цены, нулевая себестоимость"""
+    assert compare(loop_stats([], [1, 2]), engine_stats([], [1, 2])) == []
+
+    stock = SimpleNamespace(id=7, ticker='OFZ', name='ОФЗ', sector=None, instrument_type='bond')
+    positions = [
+        {'account_id': 2, 'stock_id': 7, 'stock': stock, 'quantity': 5, 'total_cost': 0.0, 'realized_pnl': 0.0, 'price': None},
+        {'account_id': 1, 'stock_id': 7, 'stock': stock, 'quantity': 3, 'total_cost': 2700.0, 'realized_pnl': 1.0, 'price': 950.0},
+        # Счета нет среди счетов пользователя - позиция не учитывается
+        {'account_id': 9, 'stock_id': 7, 'stock': stock, 'quantity': 1, 'total_cost': 1.0, 'realized_pnl': 0.0, 'price': 1.0},
+    ]
+    valuation = portfolio_engine.evaluate(positions, [1, 2, 3])
+    assert compare(loop_stats(positions[:2], [1, 2, 3]), engine_stats(positions, [1, 2, 3])) == []
+    # Позиции объединяются в порядке счетов, а не в порядке строк
+    merged = valuation.stock_positions()
+    assert [(p['quantity'], p['total_cost'], p['current_value']) for p in merged] == [(8, 2700.0, 2850.0)]
+    assert valuation.account_totals(3)['total_invested'] == 0
+    positions_analysis, sectors, instruments = valuation.analysis({1: 'a', 2: 'b'})
+    assert [p['account'] for p in positions_analysis] == ['a', 'b']
+    assert list(sectors) == ['Прочее'] and sectors['Прочее']['percentage'] == 100.0
+    assert instruments == {'share': {'value': 0, 'count': 0}, 'bond': {'value': 2850.0, 'count': 2}}
+    print("✅ Пустой портфель и позиции без цены")
+
+
+if __name__ == '__main__':
+    test_matches_loop_calculation()
+    test_loop_matches_former_utils()
+    test_edge_cases()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Тест истории портфеля по операциям (SQLite в памяти, MOEX не вызывается - история уже в PriceBar)
+"""
+
+from datetime import date, datetime
+from sqlalchemy import event
+from database import db, User, Account, Stock, Transaction, PriceBar, PriceBarCoverage
+from portfolio_replay import PortfolioReplay
+from shared_quotes import shared_quotes
+
+
+FETCHED = []
+
+
+def _no_fetch(ticker):
+    """Загрузчик истории с MOEX - записывает вызовы (история уже в БД, вызовов быть не должно)"""
+    def fetch(start, end, sink):
+        FETCHED.append((ticker, start, end))
+        return 0
+    return fetch
+
+
+def _tx(account, tx_type, day, amount, stock=None, quantity=None, cash_settled=True):
+    return Transaction(type=tx_type, amount=amount, quantity=quantity, account_id=account.id,
+                       stock_id=stock.id if stock else None, price=amount / quantity if quantity else None,
+                       timestamp=datetime(2024, 1, day, 12, 0), cash_settled=cash_settled)
+
+
+def test_replay_follows_transactions(app):
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        main = Account(name='Основной', balance=0.0, user_id=user.id)
+        iis = Account(name='ИИС', balance=0.0, user_id=user.id)
+        sber = Stock(ticker='SBER', name='Сбербанк', price=111.0)
+        gazp = Stock(ticker='GAZP', name='Газпром', price=210.0)
+        db.session.add_all([main, iis, sber, gazp])
+        db.session.commit()
+        checked_at = datetime.now()
+        for stock in (sber, gazp):
+            db.session.add(PriceBarCoverage(stock_id=stock.id, first_date=date(2023, 12, 1), checked_at=checked_at))
+        for day in range(2, 11):
+            db.session.add(PriceBar(stock_id=sber.id, date=date(2024, 1, day), close=100.0 + day))
+            # У GAZP история начинается позже покупки - до первой свечи берется первая известная цена
+            if day >= 5:
+                db.session.add(PriceBar(stock_id=gazp.id, date=date(2024, 1, day), close=200.0))
+        db.session.add_all([
+            _tx(main, 'deposit', 2, 10000.0),
+            _tx(main, 'buy', 3, 1000.0, sber, 10),
+            _tx(iis, 'buy', 4, 1000.0, gazp, 5, cash_settled=False),
+            _tx(main, 'sell', 8, 440.0, sber, 4),
+            _tx(main, 'withdrawal', 9, 500.0),
+            # Операция после конца периода не учитывается
+            _tx(main, 'deposit', 11, 99999.0),
+        ])
+        db.session.commit()
+
+        replay = PortfolioReplay()
+        history = replay.history(user.id, date(2024, 1, 2), date(2024, 1, 10), fetch_for=_no_fetch)
+        assert [item['date'] for item in history] == [
+            '2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05', '2024-01-08', '2024-01-09', '2024-01-10'
+        ]
+        assert [item['value'] for item in history] == [0.0, 1030.0, 2040.0, 2050.0, 1648.0, 1654.0, 1660.0]
+        assert [item['cash'] for item in history] == [10000.0, 9000.0, 9000.0, 9000.0, 9440.0, 8940.0, 8940.0]
+        assert [item['invested'] for item in history] == [10000.0, 10000.0, 11000.0, 11000.0, 11000.0, 10500.0, 10500.0]
+        assert FETCHED == []
+
+        # Повторный запрос берет цены из кэша процесса, без чтения PriceBar
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        assert replay.history(user.id, date(2024, 1, 2), date(2024, 1, 10), fetch_for=_no_fetch) == history
+        assert not any('FROM price_bar ' in sql for sql in statements)
+
+        # Период без торговых дней и пользователь без операций
+        assert replay.history(user.id, date(2024, 1, 6), date(2024, 1, 7), fetch_for=_no_fetch) == []
+        empty = replay.history(user.id + 1, date(2024, 1, 2), date(2024, 1, 3), fetch_for=_no_fetch)
+        assert [(item['value'], item['cash'], item['invested']) for item in empty] == [(0.0, 0.0, 0.0)] * 2
+    print("✅ История портфеля учитывает все операции")
+
+
+def test_missing_history_fetched_in_background(app):
+    fetched = []
+
+    def fetch_for(ticker):
+        def fetch(start, end, sink):
+            fetched.append((ticker, start, end))
+            sink([{'date': date(2024, 1, day), 'close': 40.0 + day} for day in range(2, 11)])
+            return 9
+        return fetch
+
+    with app.app_context():
+        user = User(telegram_id='2', username='newcomer')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=0.0, user_id=user.id)
+        stock = Stock(ticker='NVTK', name='Новатэк', price=50.0)
+        db.session.add_all([account, stock])
+        db.session.commit()
+        db.session.add_all([_tx(account, 'deposit', 2, 1000.0), _tx(account, 'buy', 3, 80.0, stock, 2)])
+        db.session.commit()
+
+        replay = PortfolioReplay()
+        # Истории в PriceBar нет: запрос не ждет MOEX и считает по текущей цене
+        first = replay.history(user.id, date(2024, 1, 2), date(2024, 1, 5), fetch_for=fetch_for)
+        current = round(2 * shared_quotes.price(stock.id, default=stock.price), 2)
+        assert [item['value'] for item in first] == [0.0, current, current, current]
+        replay.closes.wait(timeout=10)
+        assert fetched == [('NVTK', date(2023, 12, 19), date(2024, 1, 5))]
+        # Следующий запрос видит дозагруженные цены, повторной загрузки нет
+        second = replay.history(user.id, date(2024, 1, 2), date(2024, 1, 5), fetch_for=fetch_for)
+        assert [item['value'] for item in second] == [0.0, 86.0, 88.0, 90.0]
+        replay.closes.wait(timeout=10)
+        assert len(fetched) == 1
+    print("✅ Недостающая история дозагружается в фоне")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_replay_follows_transactions(make_app())
+    test_missing_history_fetched_in_background(make_app())
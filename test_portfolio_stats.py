@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Тест статистики портфеля (SQLite в памяти): позиции всех счетов читаются одним запросом на запрос Flask
+"""
+
+from sqlalchemy import event
+from database import db, User, Account, Stock, Transaction
+import position_ledger
+from utils import calculate_account_stats, calculate_portfolio_stats
+
+
+def test_positions_loaded_once_per_request(app):
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        accounts = [Account(name=f'Счет {i}', balance=1000.0, user_id=user.id) for i in range(3)]
+        stocks = [Stock(ticker=t, name=t, price=100.0) for t in ('SBER', 'GAZP')]
+        db.session.add_all(accounts + stocks)
+        db.session.commit()
+        for account in accounts:
+            for stock in stocks:
+                db.session.add(Transaction(type='buy', amount=500.0, price=50.0, quantity=10,
+                                           account_id=account.id, stock_id=stock.id))
+                position_ledger.apply(account.id, stock.id, 'buy', 10, 50.0)
+        db.session.commit()
+        account_ids = [account.id for account in accounts]
+        user_id = user.id
+        db.session.expunge_all()
+
+    statements = []
+    with app.test_request_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        # Как на дашборде: статистика каждого счета, затем статистика портфеля
+        for account_id in account_ids:
+            assert calculate_account_stats(account_id)['total_invested'] == 1000.0
+        stats = calculate_portfolio_stats(user_id)
+        assert stats['total_invested'] == 3000.0
+        assert sorted((p['stock'].ticker, p['quantity']) for p in stats['positions']) == [('GAZP', 30), ('SBER', 30)]
+        assert stats['positions'][0]['avg_price'] == 50.0
+        assert sum('FROM position' in sql for sql in statements) == 1
+    print("✅ Позиции портфеля читаются одним запросом")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_positions_loaded_once_per_request(make_app())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Тест позиций счетов (SQLite в памяти): учет покупок и продаж, сверка и пересчет по истории операций
+"""
+
+from datetime import datetime
+from database import db, User, Account, Stock, Transaction, Position
+import position_ledger
+from utils import calculate_account_stats
+
+
+def _trade(account, stock, tx_type, quantity, price, timestamp=None):
+    db.session.add(Transaction(type=tx_type, amount=quantity * price, price=price, quantity=quantity,
+                               account_id=account.id, stock_id=stock.id, timestamp=timestamp))
+    position_ledger.apply(account.id, stock.id, tx_type, quantity, price)
+    position_ledger.touch(account.user_id)
+    db.session.commit()
+
+
+def test_average_cost_and_realized_pnl(app):
+    """Себестоимость по средней цене, результат продажи - в realized_pnl; сверка с историей сходится"""
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=0.0, user_id=user.id)
+        sber = Stock(ticker='SBER', name='Сбербанк', price=300.0)
+        db.session.add_all([account, sber])
+        db.session.commit()
+
+        _trade(account, sber, 'buy', 10, 100.0)
+        _trade(account, sber, 'buy', 10, 200.0)
+        _trade(account, sber, 'sell', 5, 250.0)
+        position = Position.query.one()
+        assert (position.quantity, position.cost_basis, position.realized_pnl) == (15, 2250.0, 500.0)
+        assert position.avg_price == 150.0
+        assert position_ledger.verify()['success']
+
+        stats = calculate_account_stats(account.id)
+        assert stats['total_invested'] == 2250.0
+        assert [(p['quantity'], p['avg_price']) for p in stats['positions']] == [(15, 150.0)]
+
+        # Закрытая позиция не попадает в открытые, но хранит результат
+        _trade(account, sber, 'sell', 15, 100.0)
+        assert position_ledger.open_positions([account.id]) == []
+        assert Position.query.one().realized_pnl == 500.0 - 750.0
+    print("✅ Позиции ведутся по средней цене")
+
+
+def test_verify_and_rebuild(app):
+    """Расхождение с историей операций находится сверкой и исправляется пересчетом"""
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=0.0, user_id=user.id)
+        gazp = Stock(ticker='GAZP', name='Газпром', price=150.0)
+        db.session.add_all([account, gazp])
+        db.session.commit()
+        # Операции записаны в обход учета позиций (как до появления таблицы Position)
+        db.session.add_all([
+            Transaction(type='buy', amount=1000.0, price=100.0, quantity=10, account_id=account.id, stock_id=gazp.id),
+            Transaction(type='sell', amount=480.0, price=120.0, quantity=4, account_id=account.id, stock_id=gazp.id),
+            Transaction(type='deposit', amount=5000.0, account_id=account.id),
+        ])
+        db.session.commit()
+
+        result = position_ledger.verify()
+        assert not result['success'] and len(result['mismatches']) == 1
+        assert position_ledger.ensure_built() == 1
+        assert position_ledger.verify()['success']
+        position = Position.query.one()
+        assert (position.quantity, position.cost_basis, position.realized_pnl) == (6, 600.0, 80.0)
+        # Таблица уже заполнена - повторный запуск ничего не делает
+        assert position_ledger.ensure_built() == 0
+    print("✅ Сверка и пересчет позиций по истории операций")
+
+
+def test_backdated_buy_before_sell(app):
+    """Покупка задним числом раньше уже записанной продажи: позиция и сверка считаются по времени операций"""
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=0.0, user_id=user.id)
+        lkoh = Stock(ticker='LKOH', name='Лукойл', price=120.0)
+        db.session.add_all([account, lkoh])
+        db.session.commit()
+
+        _trade(account, lkoh, 'buy', 10, 100.0, datetime(2024, 1, 10))
+        _trade(account, lkoh, 'sell', 5, 120.0, datetime(2024, 3, 1))
+        # Внесена позже продажи, но совершена раньше нее (как add_historical_buy)
+        db.session.add(Transaction(type='buy', amount=700.0, price=70.0, quantity=10, account_id=account.id,
+                                   stock_id=lkoh.id, timestamp=datetime(2024, 2, 1), cash_settled=False))
+        position_ledger.reapply(account.id, lkoh.id)
+        position_ledger.touch(user.id)
+        db.session.commit()
+
+        # Средняя цена на момент продажи - 85, а не 100
+        position = Position.query.one()
+        assert (position.quantity, position.cost_basis, position.realized_pnl) == (15, 1275.0, 175.0)
+        assert position_ledger.verify()['success']
+        assert position_ledger.rebuild()['success']
+        position = Position.query.one()
+        assert (position.quantity, position.cost_basis, position.realized_pnl) == (15, 1275.0, 175.0)
+    print("✅ Покупка задним числом пересчитывает позицию по времени операций")
+
+
+def test_first_buy_races_another_worker(app):
+    """Позицию успел создать параллельный запрос, пока ее не было: покупка дописывается в нее, а не падает"""
+    real_lock = position_ledger.lock
+    with app.app_context():
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=0.0, user_id=user.id)
+        gazp = Stock(ticker='GAZP', name='Газпром', price=150.0)
+        db.session.add_all([account, gazp])
+        db.session.commit()
+
+        def racing_lock(account_id, stock_id):
+            position_ledger.lock = real_lock
+            # Другой воркер вставил позицию после нашего SELECT ... FOR UPDATE
+            db.session.execute(Position.__table__.insert(), [{'account_id': account_id, 'stock_id': stock_id,
+                                                              'quantity': 5, 'cost_basis': 500.0, 'realized_pnl': 0.0}])
+            return None
+
+        position_ledger.lock = racing_lock
+        try:
+            _trade(account, gazp, 'buy', 5, 110.0)
+        finally:
+            position_ledger.lock = real_lock
+        position = Position.query.one()
+        assert (position.quantity, position.cost_basis) == (10, 1050.0)
+    print("✅ Параллельная первая покупка не нарушает уникальность позиции")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_average_cost_and_realized_pnl(make_app())
+    test_verify_and_rebuild(make_app())
+    test_backdated_buy_before_sell(make_app())
+    test_first_buy_races_another_worker(make_app())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Тест загрузки истории рынка по датам (SQLite в памяти, MOEX подменяется фиктивной сессией)
+"""
+
+from datetime import date, timedelta
+from database import db, Stock, PriceBar, PriceBarCoverage, BackfillCheckpoint
+from history_fetcher import history_fetcher
+from price_backfill import MarketBackfill
+from test_history_fetcher import FakeResponse
+
+COLUMNS = ['SECID', 'TRADEDATE', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOLUME']
+
+
+class BoardSession:
+    """Вся площадка за день: 150 бумаг страницами по 100, одна из них - неизвестная"""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.dates = []
+
+    def get(self, url, params=None, timeout=None):
+        trade_date = params['date']
+        if trade_date == self.fail_on:
+            raise ConnectionError('MOEX недоступен')
+        if params['start'] == 0:
+            self.dates.append(trade_date)
+        secids = ['SBER', 'GAZP', 'UNKNOWN'] + [f'X{i}' for i in range(147)]
+        page = secids[params['start']:params['start'] + 100]
+        return FakeResponse({
+            'history': {'columns': COLUMNS, 'data': [[s, trade_date, 1.0, 2.0, 0.5, 1.5, 10] for s in page]},
+            'history.cursor': {'columns': ['INDEX', 'TOTAL', 'PAGESIZE'], 'data': [[params['start'], len(secids), 100]]},
+        })
+
+
+def test_backfill_resumes_from_checkpoint(app):
+    backfill = MarketBackfill()
+    original = type(history_fetcher).session
+    start = date(2024, 1, 1)    # понедельник
+    end = date(2024, 1, 12)     # 10 будних дней
+    try:
+        with app.app_context():
+            db.session.add_all([Stock(ticker='SBER', name='Сбербанк'), Stock(ticker='GAZP', name='Газпром')])
+            db.session.commit()
+            gazp = Stock.query.filter_by(ticker='GAZP').one().id
+            # По GAZP уже загружалась история с 5 января - покрытие продлевается до начала загрузки
+            db.session.add(PriceBarCoverage(stock_id=gazp, first_date=date(2024, 1, 5)))
+            db.session.commit()
+
+            session = BoardSession(fail_on='2024-01-10')
+            type(history_fetcher).session = property(lambda self: session)
+
+            # Ошибка на 8-м дне: первые 7 дней сохранены вместе с контрольной точкой
+            result = backfill.run(start, end)
+            assert not result['success'] and result['days'] == 7
+            assert db.session.get(BackfillCheckpoint, 'shares:TQBR').last_date == date(2024, 1, 9)
+            assert PriceBar.query.count() == 14
+
+            # Повторный запуск продолжает с 10 января; неизвестные бумаги пропускаются
+            session.fail_on = None
+            session.dates = []
+            result = backfill.run(start, end, max_days=2)
+            assert result['success'] and result['days'] == 2 and result['remaining_days'] == 1
+            assert session.dates == ['2024-01-10', '2024-01-11']
+            result = backfill.run(start, end)
+            assert result['success'] and result['rows'] == 2 and result['remaining_days'] == 0
+            assert PriceBar.query.count() == 20 and result['rows_per_sec'] is not None
+
+            coverage = {c.stock_id: c.first_date for c in PriceBarCoverage.query.all()}
+            assert set(coverage.values()) == {start} and gazp in coverage
+    finally:
+        type(history_fetcher).session = original
+    print("✅ История рынка загружается по датам с продолжением с контрольной точки")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_backfill_resumes_from_checkpoint(make_app())
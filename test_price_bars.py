@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Тест локального хранилища дневных свечей (SQLite в памяти, MOEX подменяется функцией)
+"""
+
+import time
+from datetime import date, datetime, timedelta
+from database import db, Stock, StockQuote, PriceBar, PriceBarCoverage
+from price_bars import PriceBarStore
+from trading_calendar import trading_calendar
+
+
+def _fetcher(calls):
+    def fetch(start, end, sink):
+        calls.append((start, end))
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        sink([{'date': d, 'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': 1.5, 'volume': 10} for d in days])
+        return len(days)
+    return fetch
+
+
+def _failing_fetch(start, end, sink):
+    raise RuntimeError('MOEX недоступен')
+
+
+def test_only_missing_ranges_are_fetched(app):
+    """Повторное чтение идет из БД, с MOEX запрашивается только недостающее начало периода"""
+    store = PriceBarStore()
+    today = date.today()
+    with app.app_context():
+        db.session.add(Stock(ticker='SBER', name='Сбербанк'))
+        db.session.commit()
+        stock_id = Stock.query.one().id
+        calls = []
+        fetch = _fetcher(calls)
+
+        bars = store.history(stock_id, today - timedelta(days=10), today, fetch)
+        # Свеча текущего дня не сохраняется, но отдается последней
+        assert len(bars) == 11 and PriceBar.query.count() == 10
+        assert bars[-1].date == today and bars[-1].close == 1.5
+        assert calls == [(today - timedelta(days=10), today)]
+
+        # Хвост проверен недавно - второй запрос целиком из БД
+        assert len(store.history(stock_id, today - timedelta(days=10), today, fetch)) == 11
+        assert len(calls) == 1
+
+        # Более длинный период: дозагружается только начало
+        bars = store.history(stock_id, today - timedelta(days=20), today, fetch)
+        assert len(bars) == 21
+        assert calls[1] == (today - timedelta(days=20), today - timedelta(days=11))
+
+        # Ошибка MOEX: отдается то, что уже есть
+        store.tail_ttl = 0
+        assert len(store.history(stock_id, today - timedelta(days=30), today, _failing_fetch)) == 21
+    print("✅ С MOEX загружаются только недостающие свечи")
+
+
+def test_short_request_after_idle_fills_gap(app):
+    """Старое покрытие, короткий запрос, затем длинный: хвост дозагружается от последней свечи, без пропуска"""
+    store = PriceBarStore()
+    today = date.today()
+    with app.app_context():
+        db.session.add(Stock(ticker='GAZP', name='Газпром'))
+        db.session.commit()
+        stock_id = Stock.query.one().id
+        db.session.add_all([PriceBar(stock_id=stock_id, date=today - timedelta(days=d), close=1.0) for d in range(100, 131)])
+        db.session.add(PriceBarCoverage(stock_id=stock_id, first_date=today - timedelta(days=130),
+                                        checked_at=datetime.now() - timedelta(days=100)))
+        db.session.commit()
+        calls = []
+        fetch = _fetcher(calls)
+
+        assert len(store.history(stock_id, today - timedelta(days=7), today, fetch)) == 8
+        assert calls == [(today - timedelta(days=99), today)]
+        assert len(store.history(stock_id, today - timedelta(days=130), today, fetch)) == 131
+        assert len(calls) == 1
+    print("✅ Короткий запрос после простоя не оставляет пропуска в истории")
+
+
+def test_today_bar_from_live_quote(app):
+    """Свечи текущего дня в истории MOEX еще нет: последней отдается живая котировка торгового дня"""
+    store = PriceBarStore()
+    today = date.today()
+    saved_days, saved_loaded_at = trading_calendar._days, trading_calendar._loaded_at
+    try:
+        with app.app_context():
+            db.session.add(Stock(ticker='LKOH', name='Лукойл'))
+            db.session.commit()
+            stock_id = Stock.query.one().id
+            calls = []
+            fetch = _fetcher(calls)
+            start = today - timedelta(days=5)
+
+            # Выходной: котировка - цена прошлой сессии, свечу за сегодня не добавляем
+            trading_calendar._days, trading_calendar._loaded_at = {today: (False, None, None)}, time.time()
+            db.session.add(StockQuote(stock_id=stock_id, price=7000.0, updated_at=datetime.now()))
+            db.session.commit()
+            bars = store.history(stock_id, start, today - timedelta(days=1), fetch)
+            assert len(bars) == 5
+            assert len(store.history(stock_id, start, today, fetch)) == 5
+
+            trading_calendar._days = {today: (True, '06:50', '23:50')}
+            bars = store.history(stock_id, start, today, fetch)
+            assert len(bars) == 6 and bars[-1].date == today and bars[-1].close == 7000.0
+            # Котировка не обновлялась сегодня - свечи за сегодня нет
+            db.session.get(StockQuote, stock_id).updated_at = datetime.now() - timedelta(days=1)
+            db.session.commit()
+            assert len(store.history(stock_id, start, today, fetch)) == 5
+            assert PriceBar.query.count() == 5
+    finally:
+        trading_calendar._days, trading_calendar._loaded_at = saved_days, saved_loaded_at
+    print("✅ Свеча текущего дня берется из живой котировки")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_only_missing_ranges_are_fetched(make_app())
+    test_short_request_after_idle_fills_gap(make_app())
+    test_today_bar_from_live_quote(make_app())
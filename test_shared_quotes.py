@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Тест общей таблицы котировок в memory-mapped файле
+"""
+
+import os
+import tempfile
+from shared_quotes import SharedQuoteTable
+
+
+def test_write_and_read_between_instances():
+    """Запись одного экземпляра видна другому, открывшему тот же файл"""
+    path = os.path.join(tempfile.mkdtemp(), 'quotes.bin')
+    writer = SharedQuoteTable(path=path, capacity=128)
+    reader = SharedQuoteTable(path=path, capacity=128)
+
+    assert reader.epoch() == 0
+    assert reader.get(5) is None
+
+    epoch = writer.write([(5, 101.5, 1.2, 1e6, 1000), (7, 50.0, None, None, None), (500, 1.0, None, None, None)])
+    assert epoch == 1
+    assert reader.epoch() == 1 and reader.updated_at() > 0
+
+    quote = reader.get(5)
+    assert quote['price'] == 101.5 and quote['volume'] == 1000
+    assert reader.get(7)['change_pct'] is None
+    # Идентификатор за пределами емкости пропускается
+    assert reader.get(500) is None
+    assert reader.prices([5, 7, 9]) == {5: 101.5, 7: 50.0}
+    assert reader.price(9, default=3.0) == 3.0
+    print("✅ Общая таблица котировок работает корректно")
+
+
+def test_tiers_updated_separately():
+    """Частичная запись отмечает свежим только свой уровень, пустая запись не меняет epoch"""
+    path = os.path.join(tempfile.mkdtemp(), 'quotes.bin')
+    table = SharedQuoteTable(path=path, capacity=16)
+    assert table.tiers_updated_at() == {'hot': 0, 'warm': 0, 'cold': 0}
+
+    table.write([(1, 10.0, None, None, None)], tiers=('hot',))
+    stamps = table.tiers_updated_at()
+    assert stamps['hot'] > 0 and stamps['warm'] == 0 and stamps['cold'] == 0
+
+    assert table.write((), tiers=('cold',)) == 1
+    assert table.tiers_updated_at()['cold'] > 0 and table.tiers_updated_at()['warm'] == 0
+    # Полное обновление - все уровни
+    assert table.write([(2, 20.0, None, None, None)]) == 2
+    assert min(table.tiers_updated_at().values()) > 0
+    print("✅ Время обновления уровней хранится отдельно")
+
+
+def test_layout_change_keeps_old_mapping():
+    """Экземпляр с другой емкостью размечает новый файл, а не обрезает отображенный другими"""
+    path = os.path.join(tempfile.mkdtemp(), 'quotes.bin')
+    old = SharedQuoteTable(path=path, capacity=64)
+    old.write([(40, 12.5, None, None, None)])
+    new = SharedQuoteTable(path=path, capacity=16)
+    assert new.epoch() == 0 and new.get(1) is None
+    # Прежний экземпляр читает свое отображение целиком (обрезанный файл дал бы SIGBUS)
+    assert old.price(40) == 12.5
+    new.write([(3, 7.0, None, None, None)])
+    assert SharedQuoteTable(path=path, capacity=16).price(3) == 7.0
+    assert os.path.getsize(path) == new.size
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith('.tmp')]
+    print("✅ Смена раскладки не обрезает файл под другими процессами")
+
+
+if __name__ == '__main__':
+    test_write_and_read_between_instances()
+    test_tiers_updated_separately()
+    test_layout_change_keeps_old_mapping()
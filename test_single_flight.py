@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Тест склейки одинаковых запросов (single-flight)
+"""
+
+import threading
+import time
+from single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_fetch():
+    """Параллельные запросы одного ключа выполняют fn один раз и получают общий результат"""
+    flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return 42
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('SBER', fetch, ttl=5))) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [42] * 10
+    assert len(calls) == 1
+    # В окне свежести повторный запрос тоже не вызывает fn
+    assert flight.do('SBER', fetch, ttl=5) == 42
+    assert len(calls) == 1
+    print("✅ Одинаковые запросы склеиваются")
+
+
+def test_errors_are_not_cached():
+    """Ошибка лидера не остается в кэше"""
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    try:
+        flight.do('GAZP', fail, ttl=5)
+        assert False, 'ожидалось исключение'
+    except ValueError:
+        pass
+    assert flight.do('GAZP', lambda: 7, ttl=5) == 7
+
+
+if __name__ == '__main__':
+    test_concurrent_calls_share_one_fetch()
+    test_errors_are_not_cached()
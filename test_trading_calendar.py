@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Тест фаз торгового дня и частоты задач по торговому календарю (без обращения к MOEX и БД)
+"""
+
+import time
+from datetime import datetime, date
+from trading_calendar import TradingCalendar, MOSCOW_TZ
+
+
+def _calendar():
+    calendar = TradingCalendar()
+    calendar._days = {
+        date(2026, 10, 19): (True, '06:50', '23:50'),
+        date(2026, 11, 4): (False, '', ''),
+    }
+    calendar._loaded_at = time.time()
+    return calendar
+
+
+def test_phases():
+    """Фазы определяются по времени Москвы и календарю рабочих дней"""
+    calendar = _calendar()
+    at = lambda *args: datetime(*args, tzinfo=MOSCOW_TZ)
+    assert calendar.phase(at(2026, 10, 19, 9, 55)) == 'auction'
+    assert calendar.phase(at(2026, 10, 19, 12, 0)) == 'main'
+    assert calendar.phase(at(2026, 10, 19, 20, 0)) == 'evening'
+    assert calendar.phase(at(2026, 10, 19, 23, 55)) == 'closed'
+    # Праздник из dailytable
+    assert calendar.phase(at(2026, 11, 4, 12, 0)) == 'closed'
+    # Дня нет в кэше: будни считаются рабочими, выходные - нет
+    assert calendar.phase(at(2026, 10, 20, 12, 0)) == 'main'
+    assert calendar.phase(at(2026, 10, 25, 12, 0)) == 'closed'
+    print("✅ Фазы торгового дня определяются корректно")
+
+
+def test_cadence():
+    """Цены обновляются часто в основную сессию и не обновляются, когда биржа закрыта"""
+    calendar = _calendar()
+    assert calendar.cadence('prices', 'main') < calendar.cadence('prices', 'evening')
+    assert calendar.cadence('prices', 'closed') is None
+    assert calendar.cadence('unknown_job', 'main') is None
+
+
+if __name__ == '__main__':
+    test_phases()
+    test_cadence()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Тест кэша оценки портфеля: ключ (пользователь, версия операций, epoch котировок), общий для воркеров
+каталог, вытеснение и повторное использование оценки между запросами (SQLite в памяти)
+"""
+
+import os
+import tempfile
+from sqlalchemy import event
+from database import db, User, Account, Stock, Transaction
+import position_ledger
+import utils
+from valuation_cache import ValuationCache, valuation_cache
+
+
+def test_tiers_and_eviction():
+    path = tempfile.mkdtemp()
+    calls = []
+
+    def compute(value):
+        def run():
+            calls.append(value)
+            return {'value': value}
+        return run
+
+    cache = ValuationCache(path=path, size=2, disk_size=2, ttl=60, prune_every=5)
+    assert cache.get((1, 1, 5), compute('a')) == {'value': 'a'}
+    assert cache.get((1, 1, 5), compute('b')) == {'value': 'a'}
+    # Другой воркер (новый экземпляр с тем же каталогом) находит оценку на диске
+    other = ValuationCache(path=path, size=2, disk_size=2, ttl=60)
+    assert other.get((1, 1, 5), compute('c')) == {'value': 'a'}
+    assert calls == ['a']
+    assert (cache.status()['memory_hits'], other.status()['disk_hits']) == (1, 1)
+
+    # Новая версия операций - промах
+    assert cache.get((1, 2, 5), compute('d')) == {'value': 'd'}
+    # Память ограничена size записями, диск - disk_size файлами (каталог чистится раз в prune_every записей)
+    for user_id in (2, 3):
+        cache.get((user_id, 1, 5), compute(user_id))
+    assert len([name for name in os.listdir(path) if name.endswith('.json')]) == 4
+    cache.get((4, 1, 5), compute(4))
+    assert len([name for name in os.listdir(path) if name.endswith('.json')]) == 2
+    status = cache.status()
+    assert status['entries'] == 2 and status['evictions'] >= 2
+    assert status['misses'] == 5 and status['hit_rate'] == round(1 / 6, 4)
+    # Истекший срок жизни - пересчет, даже если ключ не изменился
+    stale = ValuationCache(path=path, ttl=0)
+    assert stale.get((4, 1, 5), compute('f')) == {'value': 'f'}
+    print("✅ Кэш оценок: память, общий каталог, вытеснение")
+
+
+def test_valuation_reused_until_ledger_changes(app):
+    with app.app_context():
+        # Общий кэш хранит оценки в каталоге этой БД (фикстура app его очистила)
+        assert valuation_cache.directory() != valuation_cache.path
+        user = User(telegram_id='1', username='investor')
+        db.session.add(user)
+        db.session.flush()
+        account = Account(name='Основной', balance=1000.0, user_id=user.id)
+        stock = Stock(ticker='LKOH', name='Лукойл', sector='Нефть', price=100.0)
+        db.session.add_all([account, stock])
+        db.session.commit()
+        db.session.add(Transaction(type='buy', amount=500.0, price=50.0, quantity=10,
+                                   account_id=account.id, stock_id=stock.id))
+        position_ledger.apply(account.id, stock.id, 'buy', 10, 50.0)
+        position_ledger.touch(user.id)
+        db.session.commit()
+        user_id, account_id, stock_id = user.id, account.id, stock.id
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    for _ in range(2):
+        with app.test_request_context():
+            stats = utils.calculate_portfolio_stats(user_id)
+            assert stats['total_invested'] == 500.0
+            position = stats['positions'][0]
+            assert (position['stock'].ticker, position['stock'].sector, position['quantity']) == ('LKOH', 'Нефть', 10)
+    # Второй запрос взял оценку из кэша
+    assert sum('FROM position' in sql for sql in statements) == 1
+
+    # Новая операция увеличивает версию - оценка пересчитывается
+    with app.app_context():
+        db.session.add(Transaction(type='buy', amount=500.0, price=50.0, quantity=10,
+                                   account_id=account_id, stock_id=stock_id))
+        position_ledger.apply(account_id, stock_id, 'buy', 10, 50.0)
+        position_ledger.touch(user_id)
+        db.session.commit()
+    statements.clear()
+    with app.test_request_context():
+        assert utils.calculate_account_stats(account_id)['positions'][0]['quantity'] == 20
+    assert sum('FROM position' in sql for sql in statements) == 1
+    print("✅ Оценка портфеля пересчитывается только после новых операций")
+
+
+if __name__ == '__main__':
+    from conftest import make_app
+    test_tiers_and_eviction()
+    test_valuation_reused_until_ledger_changes(make_app())
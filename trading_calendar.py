@@ -0,0 +1,229 @@
+"""
+Торговый календарь MOEX и фазы торгового дня
+Рабочие дни и границы торгов берутся из ISS (/engines/stock.json: timetable + dailytable),
+кэшируются в таблице TradingDay и определяют частоту фоновых задач планировщика
+"""
+
+import threading
+import time
+import logging
+import requests
+from datetime import datetime, date, timedelta, timezone
+from flask import has_app_context
+import iss_decoder
+from iss_decoder import STR, INT
+from database import db, TradingDay
+
+logger = logging.getLogger(__name__)
+
+MOEX_BASE_URL = "https://iss.moex.com/iss"
+# Москва живет по UTC+3 без перехода на летнее время
+MOSCOW_TZ = timezone(timedelta(hours=3), 'MSK')
+# На сколько дней вперед раскладываем расписание в таблицу
+HORIZON_DAYS = 30
+
+# Фазы торгового дня фондового рынка (время по Москве, [начало, конец))
+PHASES = (
+    ('06:50', '07:00', 'auction'),   # аукцион открытия утренней сессии
+    ('07:00', '09:50', 'morning'),   # утренняя сессия
+    ('09:50', '10:00', 'auction'),   # аукцион открытия основной сессии
+    ('10:00', '18:40', 'main'),      # основная сессия
+    ('18:40', '19:05', 'auction'),   # аукцион закрытия и перерыв
+    ('19:05', '23:50', 'evening'),   # вечерняя сессия
+)
+# Торговый день по умолчанию, пока календарь с MOEX не загружен
+DEFAULT_START, DEFAULT_STOP = '06:50:00', '23:50:00'
+
+# Интервалы задач по фазам (секунды); None - задача простаивает
+CADENCE = {
+    'prices': {'main': 60, 'auction': 180, 'morning': 300, 'evening': 300, 'closed': None},
+    'sync_securities': {'main': 21600, 'auction': 21600, 'morning': 21600, 'evening': 21600, 'closed': None},
+}
+# Допустимый возраст снимка котировок по фазам (для фонового обновления по запросам читателей)
+QUOTE_MAX_AGE = {'main': 60, 'auction': 180, 'morning': 300, 'evening': 300, 'closed': 6 * 3600}
+
+TIMETABLE_SCHEMA = {'week_day': INT, 'is_work_day': INT, 'start_time': STR, 'stop_time': STR}
+DAILYTABLE_SCHEMA = {'date': STR, 'is_work_day': INT, 'start_time': STR, 'stop_time': STR}
+
+
+def _lower_columns(block):
+    """ISS отдает имена колонок то строчными, то прописными - приводим к строчным"""
+    block = block or {}
+    return {'columns': [c.lower() for c in block.get('columns') or []], 'data': block.get('data') or []}
+
+
+def _hhmm(value):
+    """'HH:MM:SS' или 'HH:MM' -> 'HH:MM' для сравнения строк"""
+    return (value or '')[:5]
+
+
+class TradingCalendar:
+    """Календарь торгов: рабочий ли день, текущая фаза и частота задач в этой фазе"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'InvestBot/1.0'})
+        iss_decoder.upstream_calls.attach(self.session)
+        # date -> (is_work_day, start 'HH:MM', stop 'HH:MM')
+        self._days = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self.reload_interval = 3600
+
+    # ----- Загрузка -----
+
+    def _ensure_loaded(self):
+        """Лениво подгружает календарь из БД (нужен контекст приложения)"""
+        if self._days and time.time() - self._loaded_at < self.reload_interval:
+            return
+        if not has_app_context():
+            return
+        with self._lock:
+            if self._days and time.time() - self._loaded_at < self.reload_interval:
+                return
+            try:
+                self.load()
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить торговый календарь из БД: {e}")
+                db.session.rollback()
+                self._loaded_at = time.time()
+
+    def load(self):
+        """Читает календарь из таблицы TradingDay"""
+        days = {}
+        for row in TradingDay.query.filter(TradingDay.date >= self.today() - timedelta(days=1)).all():
+            days[row.date] = (bool(row.is_work_day), _hhmm(row.start_time), _hhmm(row.stop_time))
+        self._days = days
+        self._loaded_at = time.time()
+        return len(days)
+
+    def refresh(self):
+        """Загружает расписание и исключения с MOEX и раскладывает его по датам в TradingDay"""
+        try:
+            data = iss_decoder.get_json(
+                self.session, f"{MOEX_BASE_URL}/engines/stock.json",
+                params={'iss.meta': 'off', 'iss.only': 'timetable,dailytable'}, timeout=15
+            )
+            timetable = iss_decoder.decode_block(_lower_columns(data.get('timetable')), TIMETABLE_SCHEMA)
+            dailytable = iss_decoder.decode_block(_lower_columns(data.get('dailytable')), DAILYTABLE_SCHEMA)
+
+            # Недельное расписание: 1 - понедельник ... 7 - воскресенье
+            weekly = {}
+            for row in timetable.records():
+                if row['week_day']:
+                    weekly[row['week_day']] = (bool(row['is_work_day']), row['start_time'], row['stop_time'])
+            # Исключения: праздники и перенесенные рабочие дни
+            exceptions = {}
+            for row in dailytable.records():
+                try:
+                    d = date.fromisoformat(row['date'])
+                except (TypeError, ValueError):
+                    continue
+                exceptions[d] = (bool(row['is_work_day']), row['start_time'], row['stop_time'])
+            if not weekly and not exceptions:
+                return {'success': False, 'error': 'no_data'}
+
+            today = self.today()
+            plan = {}
+            for offset in range(HORIZON_DAYS):
+                d = today + timedelta(days=offset)
+                if d in exceptions:
+                    plan[d] = exceptions[d] + ('dailytable',)
+                elif d.isoweekday() in weekly:
+                    plan[d] = weekly[d.isoweekday()] + ('timetable',)
+            # Исключения за пределами горизонта тоже сохраняем (известные заранее праздники)
+            for d, value in exceptions.items():
+                if d >= today:
+                    plan.setdefault(d, value + ('dailytable',))
+
+            existing = {row.date: row for row in TradingDay.query.filter(TradingDay.date.in_(list(plan))).all()}
+            added = updated = 0
+            for d, (is_work_day, start, stop, source) in plan.items():
+                values = {'is_work_day': is_work_day, 'start_time': start, 'stop_time': stop, 'source': source}
+                row = existing.get(d)
+                if row is None:
+                    db.session.add(TradingDay(date=d, **values))
+                    added += 1
+                elif any(getattr(row, k) != v for k, v in values.items()):
+                    for k, v in values.items():
+                        setattr(row, k, v)
+                    updated += 1
+            db.session.commit()
+            self.load()
+            logger.info(f"Торговый календарь обновлен: добавлено {added}, изменено {updated} дней")
+            return {'success': True, 'added': added, 'updated': updated, 'days': len(plan)}
+        except Exception as e:
+            logger.error(f"Ошибка обновления торгового календаря: {e}")
+            db.session.rollback()
+            return {'success': False, 'error': str(e)}
+
+    # ----- Фазы -----
+
+    @staticmethod
+    def now():
+        return datetime.now(MOSCOW_TZ)
+
+    def today(self):
+        return self.now().date()
+
+    def trading_day(self, d):
+        """(рабочий ли день, начало, конец торгов 'HH:MM') для даты"""
+        self._ensure_loaded()
+        day = self._days.get(d)
+        if day is not None:
+            return day
+        # Календарь не загружен: будни - рабочие дни со стандартными границами
+        return d.isoweekday() <= 5, _hhmm(DEFAULT_START), _hhmm(DEFAULT_STOP)
+
+    def trading_dates(self, start, end):
+        """Торговые дни в [start, end] (для дат вне загруженного календаря - будни)"""
+        days = []
+        d = start
+        while d <= end:
+            if self.trading_day(d)[0]:
+                days.append(d)
+            d += timedelta(days=1)
+        return days
+
+    def phase(self, at=None):
+        """Фаза торгов в момент at (по умолчанию сейчас): main, auction, morning, evening или closed"""
+        at = (at or self.now()).astimezone(MOSCOW_TZ)
+        is_work_day, start, stop = self.trading_day(at.date())
+        hhmm = at.strftime('%H:%M')
+        if not is_work_day or not start or not stop or hhmm < start or hhmm >= stop:
+            return 'closed'
+        for phase_start, phase_end, phase in PHASES:
+            if phase_start <= hhmm < phase_end:
+                return phase
+        # Время внутри торгового дня, но вне известных фаз (например, выходная сессия с иным расписанием)
+        return 'evening'
+
+    def is_open(self, at=None):
+        return self.phase(at) != 'closed'
+
+    def cadence(self, job, phase=None):
+        """Интервал задачи в текущей фазе (секунды) или None, если задача должна простаивать"""
+        rules = CADENCE.get(job)
+        if rules is None:
+            return None
+        return rules.get(phase or self.phase())
+
+    def quote_max_age(self, phase=None):
+        """Допустимый возраст снимка котировок в текущей фазе"""
+        return QUOTE_MAX_AGE.get(phase or self.phase(), QUOTE_MAX_AGE['main'])
+
+    def status(self):
+        """Текущее состояние календаря (для админки)"""
+        today = self.today()
+        is_work_day, start, stop = self.trading_day(today)
+        return {
+            'now_msk': self.now().isoformat(timespec='seconds'),
+            'phase': self.phase(),
+            'today': {'date': today.isoformat(), 'is_work_day': is_work_day, 'start': start, 'stop': stop},
+            'cached_days': len(self._days),
+            'cadence': {job: self.cadence(job) for job in CADENCE},
+        }
+
+
+# Глобальный экземпляр торгового календаря
+trading_calendar = TradingCalendar()
@@ -1,5 +1,12 @@
-from database import db, User, Account, Stock, Transaction
+from types import SimpleNamespace
+from flask import g
+from database import db, User, Account, Stock, StockQuote, Transaction, Position
 from sqlalchemy import func
+from sqlalchemy.orm import contains_eager
+from shared_quotes import shared_quotes
+from valuation_cache import valuation_cache
+import position_ledger
+import portfolio_engine
 
 def calculate_portfolio_stats(user_id):
     """Расчет статистики портфеля пользователя"""
@@ -8,114 +15,96 @@ def calculate_portfolio_stats(user_id):
         return None
     
     accounts = Account.query.filter_by(user_id=user_id).all()
+    valuation = portfolio_valuation(user_id, accounts)
     
     portfolio_stats = {
-        'total_balance': 0,
-        'total_invested': 0,
-        'total_current_value': 0,
-        'total_profit_loss': 0,
-        'total_profit_loss_percent': 0,
-        'positions': [],
-        'accounts_stats': []
+        'total_balance': sum(account.balance for account in accounts),
+        **valuation.totals,
+        # Позиции, объединенные по бумагам всех счетов
+        'positions': valuation.stock_positions(),
+        'accounts_stats': [calculate_account_stats(account.id) for account in accounts]
     }
     
-    for account in accounts:
-        account_stats = calculate_account_stats(account.id)
-        portfolio_stats['accounts_stats'].append(account_stats)
-        
-        portfolio_stats['total_balance'] += account.balance
-        portfolio_stats['total_invested'] += account_stats['total_invested']
-        portfolio_stats['total_current_value'] += account_stats['total_current_value']
-        
-        # Объединяем позиции по акциям
-        for position in account_stats['positions']:
-            existing_position = next(
-                (p for p in portfolio_stats['positions'] if p['stock_id'] == position['stock_id']), 
-                None
-            )
-            
-            if existing_position:
-                existing_position['quantity'] += position['quantity']
-                existing_position['total_cost'] += position['total_cost']
-                existing_position['current_value'] += position['current_value']
-                existing_position['avg_price'] = existing_position['total_cost'] / existing_position['quantity']
-                existing_position['profit_loss'] = existing_position['current_value'] - existing_position['total_cost']
-                existing_position['profit_loss_percent'] = (existing_position['profit_loss'] / existing_position['total_cost']) * 100 if existing_position['total_cost'] > 0 else 0
-            else:
-                portfolio_stats['positions'].append(position.copy())
-    
-    # Общая прибыль/убыток
-    portfolio_stats['total_profit_loss'] = portfolio_stats['total_current_value'] - portfolio_stats['total_invested']
-    portfolio_stats['total_profit_loss_percent'] = (portfolio_stats['total_profit_loss'] / portfolio_stats['total_invested']) * 100 if portfolio_stats['total_invested'] > 0 else 0
-    
     return portfolio_stats
 
+def portfolio_valuation(user_id, accounts=None):
+    """Статистика всех позиций пользователя (portfolio_engine) - один расчет на запрос Flask.
+    accounts - счета пользователя в порядке вывода (если не переданы - загружаются)
+    """
+    cache = g.setdefault('portfolio_valuation', {})
+    if user_id not in cache:
+        if accounts is None:
+            accounts = Account.query.filter_by(user_id=user_id).all()
+        cache[user_id] = portfolio_engine.evaluate(portfolio_positions(user_id), [account.id for account in accounts])
+    return cache[user_id]
+
+# Поля бумаги, которые сохраняются вместе с оценкой портфеля (их читают страницы портфеля)
+STOCK_SNAPSHOT_FIELDS = ('id', 'ticker', 'name', 'logo_url', 'sector', 'instrument_type',
+                         'face_value', 'currency', 'lot_size', 'change_pct')
+
+def _value_positions(user_id):
+    """Открытые позиции пользователя с ценами в виде данных для valuation_cache"""
+    # Stock грузится вместе с котировкой (Stock.quote - joined), т.е. позиции, бумаги и цены - одним SELECT
+    rows = db.session.query(
+        Position.account_id, Position.stock_id, Position.quantity, Position.cost_basis, Position.realized_pnl, Stock
+    ).join(Stock, Stock.id == Position.stock_id).join(Account, Account.id == Position.account_id).filter(
+        Account.user_id == user_id, Position.quantity > 0
+    ).order_by(Position.id).all()
+    # Живые цены из общей таблицы котировок; если бумаги там нет - цена из stock_quote
+    live_prices = shared_quotes.prices({row.stock_id for row in rows})
+    positions = []
+    for row in rows:
+        stock = {name: getattr(row.Stock, name, None) for name in STOCK_SNAPSHOT_FIELDS}
+        stock['price'] = live_prices.get(row.stock_id, row.Stock.price)
+        positions.append({
+            'account_id': row.account_id,
+            'stock_id': row.stock_id,
+            'stock': stock,
+            'quantity': row.quantity,
+            'total_cost': row.cost_basis,
+            'realized_pnl': row.realized_pnl,
+            'price': stock['price'],
+        })
+    return positions
+
+def portfolio_positions(user_id):
+    """Открытые позиции всех счетов пользователя с бумагами и ценами.
+    Оценка берется из valuation_cache по ключу (пользователь, версия операций, epoch котировок) и
+    пересчитывается одним запросом только после новых операций или обновления цен; в пределах
+    запроса Flask результат хранится в flask.g. Бумага - снимок полей STOCK_SNAPSHOT_FIELDS и price.
+    Возвращает [{'account_id', 'stock_id', 'stock', 'quantity', 'total_cost', 'realized_pnl', 'price'}]
+    """
+    cache = g.setdefault('portfolio_positions', {})
+    if user_id in cache:
+        return cache[user_id]
+    key = (user_id, position_ledger.version(user_id), shared_quotes.epoch())
+    positions = valuation_cache.get(key, lambda: _value_positions(user_id))
+    cache[user_id] = [dict(position, stock=SimpleNamespace(**position['stock'])) for position in positions]
+    return cache[user_id]
+
 def calculate_account_stats(account_id):
-    """Расчет статистики по конкретному счету"""
-    account = Account.query.get(account_id)
+    """Расчет статистики по конкретному счету (из общего для запроса portfolio_valuation)"""
+    cache = g.setdefault('account_stats', {})
+    if account_id in cache:
+        return cache[account_id]
+    account = db.session.get(Account, account_id)
     if not account:
         return None
     
-    # Получаем все транзакции покупки и продажи
-    transactions = Transaction.query.filter_by(
-        account_id=account_id
-    ).filter(
-        Transaction.type.in_(['buy', 'sell'])
-    ).all()
-    
-    # Группируем по акциям
-    stock_positions = {}
-    
-    for transaction in transactions:
-        stock_id = transaction.stock_id
-        
-        if stock_id not in stock_positions:
-            # Получаем объект акции из базы данных
-            from database import Stock
-            stock = Stock.query.get(stock_id)
-            stock_positions[stock_id] = {
-                'stock_id': stock_id,
-                'stock': stock,
-                'quantity': 0,
-                'total_cost': 0
-            }
-        
-        if transaction.type == 'buy':
-            stock_positions[stock_id]['quantity'] += transaction.quantity
-            stock_positions[stock_id]['total_cost'] += transaction.quantity * transaction.price
-        elif transaction.type == 'sell':
-            stock_positions[stock_id]['quantity'] -= transaction.quantity
-            stock_positions[stock_id]['total_cost'] -= transaction.quantity * transaction.price
-    
-    # Убираем позиции с нулевым количеством и рассчитываем статистику
-    active_positions = []
-    total_invested = 0
-    total_current_value = 0
-    
-    for stock_id, position in stock_positions.items():
-        if position['quantity'] > 0:
-            position['avg_price'] = position['total_cost'] / position['quantity']
-            position['current_value'] = position['quantity'] * position['stock'].price
-            position['profit_loss'] = position['current_value'] - position['total_cost']
-            position['profit_loss_percent'] = (position['profit_loss'] / position['total_cost']) * 100 if position['total_cost'] > 0 else 0
-            
-            active_positions.append(position)
-            total_invested += position['total_cost']
-            total_current_value += position['current_value']
-    
-    return {
+    valuation = portfolio_valuation(account.user_id)
+    cache[account_id] = {
         'account': account,
-        'positions': active_positions,
-        'total_invested': total_invested,
-        'total_current_value': total_current_value,
-        'total_profit_loss': total_current_value - total_invested,
-        'total_profit_loss_percent': ((total_current_value - total_invested) / total_invested) * 100 if total_invested > 0 else 0
+        'positions': valuation.account_positions(account_id),
+        **valuation.account_totals(account_id)
     }
+    return cache[account_id]
 
 def get_top_stocks(limit=10):
     """Получить топ акций по объему торгов или другим критериям"""
     # Пока что просто возвращаем акции с самыми высокими ценами
-    return Stock.query.filter(Stock.price > 0).order_by(Stock.price.desc()).limit(limit).all()
+    return Stock.query.join(Stock.quote).options(contains_eager(Stock.quote)).filter(
+        StockQuote.price > 0
+    ).order_by(StockQuote.price.desc()).limit(limit).all()
 
 def get_user_watchlist(user_id):
     """Получить список отслеживаемых акций пользователя"""
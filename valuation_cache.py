@@ -0,0 +1,218 @@
+"""
+Кэш оценки портфеля пользователя
+Ключ - (user_id, версия операций пользователя, epoch общей таблицы котировок): любая запись
+операций увеличивает версию (position_ledger.touch), любое обновление цен - epoch, поэтому
+устаревшая оценка просто перестает находиться по ключу. Дополнительно записи живут не дольше
+VALUATION_CACHE_TTL секунд - цены, попавшие только в БД (без общей таблицы), epoch не меняют.
+Два уровня: LRU в памяти процесса и JSON-файлы в общем каталоге, которые видят все воркеры.
+Каталог общего кэша разделен по адресу БД: версии операций другой БД начинаются заново и не должны
+находить чужие оценки. Устаревшие и лишние файлы удаляются раз в VALUATION_CACHE_PRUNE_EVERY записей.
+В кэше лежат только данные (числа и поля бумаг), а не объекты ORM
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _db_identity():
+    """Короткий хеш адреса БД текущего приложения (None - нет контекста приложения)"""
+    try:
+        from flask import has_app_context
+        if not has_app_context():
+            return None
+        from database import db
+        url = db.engine.url.render_as_string(hide_password=True)
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    except Exception as e:
+        logger.debug(f"Не удалось определить БД для кэша оценок: {e}")
+        return None
+
+
+class ValuationCache:
+    """Оценки портфелей по ключу (user_id, ledger_version, price_epoch) с метриками попаданий.
+    per_database=True - файлы лежат в подкаталоге по адресу БД приложения
+    """
+
+    def __init__(self, path=None, size=None, disk_size=None, ttl=None, prune_every=None, per_database=False):
+        self.path = path or os.environ.get(
+            'VALUATION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'investbot_valuations')
+        )
+        self.size = size if size is not None else _env_int('VALUATION_CACHE_SIZE', 512)
+        self.disk_size = disk_size if disk_size is not None else _env_int('VALUATION_CACHE_DISK_SIZE', 4096)
+        self.ttl = ttl if ttl is not None else _env_int('VALUATION_CACHE_TTL', 300)
+        self.prune_every = max(1, prune_every if prune_every is not None else _env_int('VALUATION_CACHE_PRUNE_EVERY', 64))
+        self.per_database = per_database
+        self._identity = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._writes = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry['computed_at'] < self.ttl
+
+    def directory(self):
+        """Каталог файлов оценок (для per_database - подкаталог БД, как только она известна)"""
+        if self.per_database and self._identity is None:
+            self._identity = _db_identity()
+        return os.path.join(self.path, self._identity) if self._identity else self.path
+
+    def _file(self, key):
+        return os.path.join(self.directory(), '{}-{}-{}.json'.format(*key))
+
+    def _disk(self):
+        directory = self.directory()
+        if directory not in self._ready:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self._ready[directory] = True
+            except OSError as e:
+                logger.warning(f"Каталог кэша оценок недоступен, только память процесса: {e}")
+                self._ready[directory] = False
+        return self._ready[directory]
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _read_disk(self, key):
+        if not self._disk():
+            return None
+        try:
+            with open(self._file(key), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._count('disk_errors')
+            logger.warning(f"Не удалось прочитать оценку портфеля {key} из кэша: {e}")
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self._disk():
+            return
+        path = self._file(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            self._count('disk_errors')
+            logger.warning(f"Не удалось записать оценку портфеля {key} в кэш: {e}")
+            return
+        # Просмотр каталога - не на каждый промах, а раз в prune_every записей процесса
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.prune_every == 0
+        if due:
+            self._prune()
+
+    def _prune(self):
+        """Удаляет оценки старше VALUATION_CACHE_TTL (в том числе прежних версий операций)
+        и самые старые файлы сверх VALUATION_CACHE_DISK_SIZE
+        """
+        expired = time.time() - self.ttl
+        files = []
+        for entry in os.scandir(self.directory()):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+                if mtime < expired:
+                    os.remove(entry.path)
+                    continue
+                files.append((mtime, entry.path))
+            except OSError:
+                continue
+        if len(files) <= self.disk_size:
+            return
+        files.sort()
+        for _, path in files[:len(files) - self.disk_size]:
+            try:
+                os.remove(path)
+                self._count('evictions')
+            except OSError:
+                pass
+
+    def get(self, key, compute):
+        """Оценка по ключу (user_id, ledger_version, price_epoch); при промахе - compute() (данные,
+        сериализуемые в JSON), результат сохраняется в памяти и на диске
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if self._fresh(entry):
+            self._count('memory_hits')
+            return entry['value']
+        entry = self._read_disk(key)
+        if self._fresh(entry):
+            self._count('disk_hits')
+            self._remember(key, entry)
+            return entry['value']
+        self._count('misses')
+        entry = {'computed_at': time.time(), 'value': compute()}
+        self._remember(key, entry)
+        self._write_disk(key, entry)
+        return entry['value']
+
+    def clear(self):
+        """Сбрасывает все оценки - в памяти процесса и в общем каталоге (например, после пересоздания БД
+        по тому же адресу, когда версии операций начинаются заново)
+        """
+        with self._lock:
+            self._entries.clear()
+        if not self._disk():
+            return
+        for entry in os.scandir(self.directory()):
+            if entry.name.endswith('.json'):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def disk_files(self):
+        """Сколько оценок лежит в общем каталоге (общий для всех воркеров показатель)"""
+        if not self._disk():
+            return 0
+        return sum(1 for entry in os.scandir(self.directory()) if entry.name.endswith('.json'))
+
+    def status(self):
+        """Метрики кэша этого процесса: попадания в память и на диск, промахи, вытеснения"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 4) if lookups else None
+        stats.update({'pid': os.getpid(), 'size': self.size, 'disk_size': self.disk_size, 'ttl': self.ttl,
+                      'prune_every': self.prune_every, 'path': self.directory(), 'disk': bool(self._disk())})
+        return stats
+
+
+# Глобальный кэш оценок портфелей (каталог - свой для каждой БД)
+valuation_cache = ValuationCache(per_database=True)
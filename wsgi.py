@@ -18,9 +18,17 @@ app = create_app('production')
 # Автоматическая инициализация при первом запуске
 with app.app_context():
     try:
-        # Создаем все таблицы
-        db.create_all()
+        # Создаем все таблицы; котировки из старых колонок stock переезжают в узкую таблицу stock_quote,
+        # в transaction добавляются новые колонки. Воркеры стартуют одновременно - все это под общей блокировкой
+        from database import run_migrations
+        moved, added = run_migrations()
         logger.info("✅ База данных инициализирована")
+        if moved:
+            logger.info(f"✅ Котировки перенесены в stock_quote: {moved} бумаг")
+        if added:
+            logger.info(f"✅ В таблицу transaction добавлены колонки: {', '.join(added)}")
+
+        # Позиции счетов по истории операций заполняет один процесс - лидер планировщика (или init_after_deploy)
         
         # Проверяем и загружаем данные об акциях
         from database import Stock
@@ -40,6 +48,17 @@ with app.app_context():
                 logger.warning(f"⚠️  Ошибка загрузки данных: {e}")
         else:
             logger.info(f"📊 В базе уже есть {existing_stocks_count} акций")
+
+        # Справочник бумаг нужен для поиска площадок без лишних запросов к MOEX
+        from database import SecurityMaster
+        if SecurityMaster.query.count() == 0:
+            logger.info("📥 Загружаем справочник бумаг MOEX...")
+            from security_master import security_master
+            result = security_master.refresh()
+            if result.get('success'):
+                logger.info(f"✅ Справочник бумаг загружен: {result['total']} бумаг")
+            else:
+                logger.warning(f"⚠️  Справочник бумаг не загружен: {result.get('error')}")
             
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации: {e}")
@@ -65,5 +84,13 @@ with app.app_context():
         except Exception as fallback_error:
             logger.error(f"❌ Ошибка добавления fallback данных: {fallback_error}")
 
+# Планировщик стартует в каждом воркере, задачи выполняет только процесс-лидер
+if os.environ.get('SCHEDULER_ENABLED', '1').lower() not in ('0', 'false', 'no', 'off'):
+    try:
+        from scheduler import scheduler
+        scheduler.start(app)
+    except Exception as e:
+        logger.error(f"❌ Ошибка запуска планировщика: {e}")
+
 if __name__ == "__main__":
     app.run()